@@ -57,6 +57,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'datahub.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -187,6 +188,9 @@ LOGGING = {
         'standard': {
             'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
         },
+        'span': {
+            '()': 'datahub.spans.SpanFormatter'
+        },
     },
     'handlers': {
         'djangofile': {
@@ -205,6 +209,14 @@ LOGGING = {
             'backupCount': 10,
             'formatter': 'standard'
         },
+        'spanfile': {
+            'level': 'INFO',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': os.path.join(BASE_DIR, "logs", "spans.log" if IN_DOCKER else "spans_.log"),
+            'maxBytes': 1024 * 1024 * 10,
+            'backupCount': 10,
+            'formatter': 'span'
+        },
         'console': {
             'class': 'logging.StreamHandler',
         },
@@ -219,6 +231,12 @@ LOGGING = {
             'handlers': ['appfile', 'console'] if DEBUG else ['appfile'],
             'level': ('DEBUG' if DEBUG else os.environ.get("LOGGING_LEVEL", "INFO")),
             'propagate': True,
+        },
+        # Phase timings of the loaders as json lines
+        'datahub.spans': {
+            'handlers': ['spanfile'],
+            'level': 'INFO',
+            'propagate': True,
         }
     },
 }
@@ -228,13 +246,42 @@ CELERY_BROKER_URL = 'redis://redis:6379/0'
 CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
+# Default time between the refreshes of each layer and area, can be set per pair in OsmSyncState
+OSM_REFRESH_INTERVAL_MINUTES = int(os.environ.get("OSM_REFRESH_INTERVAL_MINUTES",
+                                                  os.environ.get("OSM_SCHEDULE_MINUTES", "720")))
+# Scheduler enqueues the due pairs this often and spreads them over the interval
+OSM_SCHEDULER_INTERVAL_MINUTES = int(os.environ.get("OSM_SCHEDULER_INTERVAL_MINUTES", "15"))
 CELERY_BEAT_SCHEDULE = {
-    'load-osm-data': {
-        'task': 'datahub.tasks.load_osm_data',
-        'schedule': int(os.environ.get("OSM_SCHEDULE_MINUTES", "720")) * 60,
+    'schedule-osm-data': {
+        'task': 'datahub.tasks.schedule_osm_data',
+        'schedule': OSM_SCHEDULER_INTERVAL_MINUTES * 60,
         'options': {'queue': 'main'}
     }
 }
+# Locks and claims that keep the workers from loading the same layer and area at the same time
+LOCK_REDIS_URL = os.environ.get("LOCK_REDIS_URL", CELERY_BROKER_URL)
+LOCK_KEY_PREFIX = 'aukigo'
+LOCK_LEASE_SECONDS = int(os.environ.get("LOCK_LEASE_SECONDS", 60))
+# Queued or running loads are not enqueued again until they finish or this time has passed
+LOCK_CLAIM_TTL_SECONDS = int(os.environ.get("LOCK_CLAIM_TTL_SECONDS", 2 * 60 * 60))
+
+# Cache of the API responses shared by all the web workers
+CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL", 'redis://redis:6379/1')
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': CACHE_REDIS_URL,
+        'KEY_PREFIX': 'aukigo',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            # Cache is an optimization, requests and saves that invalidate it must work while Redis is down
+            'IGNORE_EXCEPTIONS': True,
+        }
+    }
+}
+DJANGO_REDIS_LOG_IGNORED_EXCEPTIONS = True
+# Cached capabilities are invalidated whenever the layers, tilesets or basemaps change
+CAPABILITIES_CACHE_SECONDS = int(os.environ.get("CAPABILITIES_CACHE_SECONDS", 24 * 60 * 60))
 
 DEFAULT_BBOX = '60.260904,24.499405,60.352655,24.668588'
 
@@ -248,7 +295,50 @@ FIXTURE_DIRS = [
 
 # OSM API
 OVERPASS_API_URL = 'http://overpass-api.de/api'
+# Initial endpoint pool, endpoints are managed with OverpassEndpoint models once they exist
+OVERPASS_API_URLS = os.environ.get("OVERPASS_API_URLS", OVERPASS_API_URL).split(",")
+# Endpoint is left out of the pool for a while after this many failures in a row
+OVERPASS_CIRCUIT_BREAKER_THRESHOLD = int(os.environ.get("OVERPASS_CIRCUIT_BREAKER_THRESHOLD", 3))
+OVERPASS_CIRCUIT_BREAKER_SECONDS = int(os.environ.get("OVERPASS_CIRCUIT_BREAKER_SECONDS", 5 * 60))
 OSM_CONFIG = os.path.join(DATA_DIR, "osmconf.ini")
+# Fetch only the OSM objects changed since the last synchronization of the layer and area
+OSM_INCREMENTAL_SYNC = bool(int(os.environ.get("OSM_INCREMENTAL_SYNC", 1)))
+# Incremental queries return only the changed objects that still match the tags, so deleted objects and objects
+# whose tags do not match anymore stay in the layer until the next full synchronization. It is done instead of
+# the incremental one once this much time has passed since the last full synchronization of the layer and area.
+OSM_FULL_SYNC_INTERVAL_HOURS = int(os.environ.get("OSM_FULL_SYNC_INTERVAL_HOURS", 24 * 7))
+# Upper limit for simultaneous queries of a single loader, the slots available on the server limit it further
+OVERPASS_MAX_CONCURRENT_QUERIES = int(os.environ.get("OVERPASS_MAX_CONCURRENT_QUERIES", 2))
+# On-disk cache for Overpass responses
+OVERPASS_CACHE_ENABLED = bool(int(os.environ.get("OVERPASS_CACHE_ENABLED", 1)))
+OVERPASS_CACHE_DIR = os.environ.get("OVERPASS_CACHE_DIR", os.path.join(BASE_DIR, "cache", "overpass"))
+OVERPASS_CACHE_TTL_SECONDS = int(os.environ.get("OVERPASS_CACHE_TTL_SECONDS", 60 * 60))
+OVERPASS_CACHE_MAX_BYTES = int(os.environ.get("OVERPASS_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+# Query each area once for all of its layers instead of once per layer and area
+OSM_COMBINED_AREA_QUERIES = bool(int(os.environ.get("OSM_COMBINED_AREA_QUERIES", 0)))
+# Run fetch, parse and sync of each layer as separate tasks on network, cpu and db queues
+OSM_STAGED_LOADING = bool(int(os.environ.get("OSM_STAGED_LOADING", 1)))
+# Storage for the files passed between the stages, must be shared by all the workers
+OSM_STAGING_DIR = os.environ.get("OSM_STAGING_DIR", os.path.join(BASE_DIR, "cache", "staging"))
+# Measure peak memory of the loading phases with tracemalloc, slows down parsing noticeably
+SPAN_TRACE_MEMORY = bool(int(os.environ.get("SPAN_TRACE_MEMORY", 0)))
+
+# Prometheus metrics are shared by the gunicorn and Celery worker processes through files in this directory.
+# prometheus_client reads the environment variable, so it is set before the client is imported.
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR",
+                                                 os.path.join(BASE_DIR, "cache", "metrics"))
+# Addresses and networks allowed to scrape the metrics directly from the web container, for example
+# "127.0.0.1 172.16.0.0/12". Requests forwarded by nginx are not allowed by their address, since the address
+# is the proxy's. They need METRICS_TOKEN as a bearer token (bearer_token in Prometheus). Staff users are
+# allowed from anywhere.
+METRICS_ALLOWED_IPS = os.environ.get("METRICS_ALLOWED_IPS", default='127.0.0.1 ::1').split()
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+# Store the features of each tileset in a materialized view with a spatial index instead of joining the feature
+# and layer tables on every tile request. Each synchronization refreshes the whole views of the layer, and of
+# the other layers that share the changed features, with REFRESH ... CONCURRENTLY. It costs about as much as
+# rebuilding the views even when an incremental synchronization changed only a few features.
+OSM_MATERIALIZED_TILESETS = bool(int(os.environ.get("OSM_MATERIALIZED_TILESETS", 1)))
 
 # pg_tileserv
 PG_TILESERV_POSTFIX = os.environ.get("PG_TILESERV_POSTFIX", ":7800")
@@ -1,7 +1,9 @@
 from django.contrib.gis import admin
+from django.db import transaction
 from django_better_admin_arrayfield.admin.mixins import DynamicArrayMixin
 
-from .models import OsmLayer, AreaOfInterest, Tileset, WMTSBasemap, VectorTileBasemap
+from .models import OsmLayer, AreaOfInterest, Tileset, WMTSBasemap, VectorTileBasemap, OsmSyncState, OverpassEndpoint
+from .tasks import reclassify_osm_layer
 
 
 class OsmAdmin(admin.GeoModelAdmin):
@@ -14,9 +16,26 @@ class ArrayAdmin(admin.ModelAdmin, DynamicArrayMixin):
     pass
 
 
+class OsmLayerAdmin(ArrayAdmin):
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change and 'tags' in form.changed_data:
+            # Stored features can be classified with the new tags without waiting for the next download
+            transaction.on_commit(lambda: reclassify_osm_layer.apply_async((obj.pk,), queue='main'))
+
+
+class OverpassEndpointAdmin(admin.ModelAdmin):
+    list_display = ('url', 'enabled', 'is_available', 'request_count', 'failure_count', 'timeout_count',
+                    'rate_limited_count', 'latency', 'last_success')
+    readonly_fields = ('request_count', 'failure_count', 'timeout_count', 'rate_limited_count', 'latency',
+                       'consecutive_failures', 'last_error', 'last_success')
+
+
 # Register your models here.
 admin.site.register(AreaOfInterest, OsmAdmin)
-admin.site.register(OsmLayer, ArrayAdmin)
+admin.site.register(OsmLayer, OsmLayerAdmin)
 admin.site.register(Tileset)
+admin.site.register(OsmSyncState, ArrayAdmin)
+admin.site.register(OverpassEndpoint, OverpassEndpointAdmin)
 admin.site.register(WMTSBasemap)
 admin.site.register(VectorTileBasemap)
@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class DatahubConfig(AppConfig):
     name = 'datahub'
+
+    def ready(self):
+        # Connects the Celery signal handlers of the metrics
+        from . import metrics  # noqa: F401
+        # Connects the model signal handlers that invalidate the cached capabilities
+        from . import capabilities_cache  # noqa: F401
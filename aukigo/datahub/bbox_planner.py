@@ -0,0 +1,49 @@
+import math
+from typing import Tuple, List
+
+# south, west, north, east
+Bbox = Tuple[float, float, float, float]
+
+
+def split_bbox(bbox: Bbox) -> List[Bbox]:
+    """
+    Splits Overpass bounding box into four quadrants
+    :param bbox: coordinates in south, west, north, east
+    :return: quadrants in south, west, north, east
+    """
+    south, west, north, east = bbox
+    mid_lat = (south + north) / 2
+    mid_lon = (west + east) / 2
+    return [
+        (south, west, mid_lat, mid_lon),
+        (south, mid_lon, mid_lat, east),
+        (mid_lat, west, north, mid_lon),
+        (mid_lat, mid_lon, north, east),
+    ]
+
+
+def split_bbox_to_depth(bbox: Bbox, depth: int) -> List[Bbox]:
+    """
+    Splits Overpass bounding box into a quadtree of given depth
+    :param bbox: coordinates in south, west, north, east
+    :param depth: 0 returns the bbox as is, 1 returns four quadrants, 2 sixteen and so on
+    :return: leaf bounding boxes
+    """
+    bboxes = [bbox]
+    for _ in range(depth):
+        bboxes = [quadrant for bbox in bboxes for quadrant in split_bbox(bbox)]
+    return bboxes
+
+
+def estimate_split_depth(element_count: int, max_elements: int, max_depth: int) -> int:
+    """
+    Estimates how many times the bounding box should be split so that each leaf contains at most max_elements
+    assuming that the elements are distributed evenly
+    :param element_count: number of elements in the whole bounding box
+    :param max_elements: preferred maximum number of elements per query
+    :param max_depth: maximum depth of the quadtree
+    :return: depth of the quadtree
+    """
+    if element_count <= max_elements:
+        return 0
+    return min(max_depth, math.ceil(math.log(element_count / max_elements, 4)))
@@ -0,0 +1,178 @@
+import csv
+import gzip
+import io
+import json
+import logging
+from typing import Dict, Set, Tuple
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from .opening_hours import OPENING_HOURS_TABLE, store_opening_hours
+from .utils import GeomType
+
+logger = logging.getLogger(__name__)
+
+STAGING_TABLE = 'datahub_osm_staging'
+COPY_BATCH_SIZE = 10000
+
+# osmid: (tags, geometry as hex WKB, z_order)
+FeatureRows = Dict[int, Tuple[dict, str, int]]
+
+
+# noinspection SqlNoDataSourceInspection
+def upsert_features(geom_type: GeomType, rows: FeatureRows, using=DEFAULT_DB_ALIAS) -> Tuple[Set[int], Set[int]]:
+    """
+    Inserts or updates features with few set based queries. Rows are streamed with COPY to a temporary
+    staging table and then upserted to the model table with INSERT ... ON CONFLICT.
+    :param geom_type: geometry type of the features
+    :param rows: feature rows keyed by osm id
+    :param using: Database key
+    :return: ids of the features that were created and ids of the existing features that were changed
+    """
+    if not len(rows):
+        return set(), set()
+
+    model = geom_type.osm_model
+    table = model._meta.db_table
+    columns = ['osmid', 'tags', 'geom']
+    if geom_type == GeomType.LINE:
+        columns.append('z_order')
+
+    updated_values = ', '.join(f'{column} = EXCLUDED.{column}' for column in columns[1:])
+    select_values = ', '.join(
+        {'z_order': 'COALESCE(z_order, 0)', 'geom': f'ST_SetSRID(geom, {settings.SRID})'}.get(column, column)
+        for column in columns)
+
+    connection = connections[using]
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute(f'''
+            CREATE TEMPORARY TABLE IF NOT EXISTS {STAGING_TABLE} (
+                osmid bigint, tags jsonb, geom geometry, z_order integer
+            ) ON COMMIT DROP
+        ''')
+        cursor.execute(f'TRUNCATE {STAGING_TABLE}')
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for i, (osmid, (tags, geom, z_order)) in enumerate(rows.items(), 1):
+            writer.writerow((osmid, json.dumps(tags), geom, z_order))
+            if i % COPY_BATCH_SIZE == 0:
+                _copy_to_staging(cursor, buffer)
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+        _copy_to_staging(cursor, buffer)
+
+        # xmax is zero only for freshly inserted rows. Unchanged rows are not rewritten at all.
+        sql = f'''
+            INSERT INTO {table} ({', '.join(columns)})
+            SELECT {select_values} FROM {STAGING_TABLE}
+            ON CONFLICT (osmid) DO UPDATE SET {updated_values}
+            WHERE {table}.tags IS DISTINCT FROM EXCLUDED.tags
+               OR NOT ST_OrderingEquals({table}.geom, EXCLUDED.geom)
+               {f'OR {table}.z_order IS DISTINCT FROM EXCLUDED.z_order' if 'z_order' in columns else ''}
+            RETURNING osmid, (xmax = 0) AS inserted
+        '''
+        logger.debug(sql)
+        cursor.execute(sql)
+        upserted = cursor.fetchall()
+        created_ids = {osmid for osmid, inserted in upserted if inserted}
+        updated_ids = {osmid for osmid, inserted in upserted if not inserted}
+        # Opening hours are parsed once here instead of on every tile request
+        store_opening_hours(geom_type, {osmid: rows[osmid][0] for osmid, _ in upserted}, using)
+
+    logger.debug(f"Upserted {len(rows)} {geom_type.name} features, {len(created_ids)} created")
+    return created_ids, updated_ids
+
+
+def _copy_to_staging(cursor, buffer: io.StringIO) -> None:
+    if buffer.tell() == 0:
+        return
+    buffer.seek(0)
+    cursor.copy_expert(f'COPY {STAGING_TABLE} (osmid, tags, geom, z_order) FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+# noinspection SqlNoDataSourceInspection
+def add_layer_membership(geom_type: GeomType, layer_id: int, ids: Set[int], using=DEFAULT_DB_ALIAS) -> None:
+    """
+    Links features to layer with a single query. Already existing links are left as they are.
+    :param geom_type: geometry type of the features
+    :param layer_id: OsmLayer pk
+    :param ids: feature ids
+    :param using: Database key
+    """
+    if not len(ids):
+        return
+    table, feature_column, layer_column = get_through_table(geom_type)
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'''
+            INSERT INTO {table} ({feature_column}, {layer_column})
+            SELECT unnest(%s::bigint[]), %s
+            ON CONFLICT DO NOTHING
+        ''', [list(ids), layer_id])
+
+
+# noinspection SqlNoDataSourceInspection
+def remove_layer_membership(geom_type: GeomType, layer_id: int, ids: Set[int], using=DEFAULT_DB_ALIAS) -> int:
+    """
+    Unlinks features from layer and deletes the ones that do not belong to any layer anymore.
+    Costs three queries regardless of the amount of features.
+    :param geom_type: geometry type of the features
+    :param layer_id: OsmLayer pk
+    :param ids: feature ids
+    :param using: Database key
+    :return: number of deleted features
+    """
+    if not len(ids):
+        return 0
+    table, feature_column, layer_column = get_through_table(geom_type)
+    feature_table = geom_type.osm_model._meta.db_table
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table} WHERE {layer_column} = %s AND {feature_column} = ANY(%s::bigint[])',
+                       [layer_id, list(ids)])
+        cursor.execute(f'''
+            DELETE FROM {feature_table} f
+            WHERE f.osmid = ANY(%s::bigint[])
+              AND NOT EXISTS (SELECT 1 FROM {table} t WHERE t.{feature_column} = f.osmid)
+            RETURNING f.osmid
+        ''', [list(ids)])
+        deleted_ids = [osmid for osmid, in cursor.fetchall()]
+        cursor.execute(f'DELETE FROM {OPENING_HOURS_TABLE} WHERE geom_type = %s AND osmid = ANY(%s::bigint[])',
+                       [geom_type.name, deleted_ids])
+        deleted = len(deleted_ids)
+
+    logger.debug(f"Removed {len(ids)} {geom_type.name} features from layer {layer_id}, deleted {deleted}")
+    return deleted
+
+
+def write_feature_rows(file_path: str, rows_dict: Dict[GeomType, FeatureRows]) -> None:
+    """
+    Writes feature rows to a gzipped json lines file so that they can be synchronized in another process
+    :param file_path: path of the file to write to
+    :param rows_dict: feature rows by geometry type
+    """
+    with gzip.open(file_path, 'wt') as f:
+        for geom_type, rows in rows_dict.items():
+            for osmid, (tags, geom, z_order) in rows.items():
+                f.write(json.dumps([geom_type.name, osmid, tags, geom, z_order]) + '\n')
+
+
+def read_feature_rows(file_path: str) -> Dict[GeomType, FeatureRows]:
+    """
+    Reads feature rows written with write_feature_rows
+    :param file_path: path of the file
+    :return: feature rows by geometry type
+    """
+    rows_dict = {geom_type: {} for geom_type in GeomType}
+    with gzip.open(file_path, 'rt') as f:
+        for line in f:
+            geom_type, osmid, tags, geom, z_order = json.loads(line)
+            rows_dict[GeomType[geom_type]][osmid] = (tags, geom, z_order)
+    return rows_dict
+
+
+def get_through_table(geom_type: GeomType) -> Tuple[str, str, str]:
+    through = geom_type.osm_model.layers.through
+    feature_field = through._meta.get_field(geom_type.osm_model._meta.model_name)
+    layer_field = through._meta.get_field('osmlayer')
+    return through._meta.db_table, feature_field.column, layer_field.column
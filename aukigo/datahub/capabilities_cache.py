@@ -0,0 +1,70 @@
+import datetime
+import hashlib
+import logging
+import uuid
+from typing import Optional
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+
+from .models import Layer, OsmLayer, Tileset, LayerStatistics, WMTSBasemap, VectorTileBasemap
+
+logger = logging.getLogger(__name__)
+
+CAPABILITIES_VERSION_KEY = 'capabilities:version'
+
+
+def get_capabilities_version() -> dict:
+    """
+    :return: id of the current version of the capabilities and the time it was created
+    """
+    version = cache.get(CAPABILITIES_VERSION_KEY)
+    if version is None:
+        version = _new_version()
+        # Another worker may have created the version at the same time
+        if not cache.add(CAPABILITIES_VERSION_KEY, version, timeout=None):
+            version = cache.get(CAPABILITIES_VERSION_KEY) or version
+    return version
+
+
+def get_capabilities_key(request) -> str:
+    """
+    :param request: capabilities request
+    :return: cache key of the current version of the capabilities for the scheme and host of the request. Tile
+        urls of the response contain the host.
+    """
+    return f"capabilities:{get_capabilities_version()['id']}:{request.scheme}:{request.get_host()}"
+
+
+def get_capabilities_etag(request, *args, **kwargs) -> str:
+    return hashlib.md5(get_capabilities_key(request).encode()).hexdigest()
+
+
+def get_capabilities_last_modified(request, *args, **kwargs) -> Optional[datetime.datetime]:
+    return get_capabilities_version()['modified']
+
+
+def invalidate_capabilities() -> None:
+    """
+    Starts a new version of the capabilities, so that the cached responses are not used anymore
+    """
+    # Replaced only after commit, so that the new version is never cached from the old rows
+    transaction.on_commit(lambda: cache.set(CAPABILITIES_VERSION_KEY, _new_version(), timeout=None))
+
+
+def _new_version() -> dict:
+    # HTTP dates have a resolution of a second
+    return {'id': uuid.uuid4().hex, 'modified': timezone.now().replace(microsecond=0)}
+
+
+def _on_change(sender, **kwargs):
+    logger.debug(f"Capabilities changed by {sender.__name__}")
+    invalidate_capabilities()
+
+
+# Statistics change when a synchronization changes the features of the layer
+for model in (Layer, OsmLayer, Tileset, LayerStatistics, WMTSBasemap, VectorTileBasemap):
+    post_save.connect(_on_change, sender=model, dispatch_uid=f'capabilities_{model.__name__}_save')
+    post_delete.connect(_on_change, sender=model, dispatch_uid=f'capabilities_{model.__name__}_delete')
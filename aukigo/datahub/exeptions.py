@@ -1,2 +1,10 @@
 class TooManyRequests(Exception):
     """Too many requests to Overpass API"""
+
+
+class QueryTooLarge(Exception):
+    """Overpass query timed out or ran out of memory"""
+
+
+class LockNotAcquired(Exception):
+    """Lock is held by another worker"""
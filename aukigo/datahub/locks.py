@@ -0,0 +1,128 @@
+import logging
+import threading
+from contextlib import ExitStack
+from typing import Iterable, Optional, Tuple
+
+import redis
+from django.conf import settings
+from redis.exceptions import LockError
+
+from .exeptions import LockNotAcquired
+
+logger = logging.getLogger(__name__)
+
+_client: Optional[redis.Redis] = None
+
+
+def get_redis() -> redis.Redis:
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.LOCK_REDIS_URL)
+    return _client
+
+
+def pair_key(layer_id: int, area_id: str) -> str:
+    """
+    :return: key for loading of OsmLayer in AreaOfInterest
+    """
+    return f"osm:{layer_id}:{area_id}"
+
+
+def area_key(area_id: str) -> str:
+    """
+    :return: key for loading of all the layers of AreaOfInterest at once
+    """
+    return f"osm-area:{area_id}"
+
+
+class LeasedLock:
+    """
+    Lock stored in Redis so that it is shared by all the workers. The lock is held for a lease that is renewed
+    in a background thread as long as the lock is held, so a worker that dies without releasing the lock
+    blocks the others only until the lease expires.
+
+    Use as a context manager, it raises LockNotAcquired if the lock is held by someone else.
+    """
+
+    def __init__(self, key: str, lease: Optional[int] = None):
+        """
+
+        :param key: name of the locked resource
+        :param lease: seconds the lock is held without renewal, defaults to settings.LOCK_LEASE_SECONDS
+        """
+        self.key = key
+        self.lease = lease or settings.LOCK_LEASE_SECONDS
+        # Token is shared with the renewal thread
+        self._lock = get_redis().lock(f"{settings.LOCK_KEY_PREFIX}:lock:{key}", timeout=self.lease,
+                                      thread_local=False)
+        self._stopped = threading.Event()
+        self._renewer: Optional[threading.Thread] = None
+
+    def acquire(self) -> bool:
+        """
+        :return: Whether the lock was acquired, never waits for it
+        """
+        if not self._lock.acquire(blocking=False):
+            return False
+        self._stopped.clear()
+        self._renewer = threading.Thread(target=self._renew, daemon=True)
+        self._renewer.start()
+        return True
+
+    def release(self) -> None:
+        self._stopped.set()
+        if self._renewer is not None:
+            self._renewer.join()
+            self._renewer = None
+        try:
+            self._lock.release()
+        except LockError:
+            logger.warning(f"Lease of lock {self.key} expired before it was released")
+
+    def __enter__(self) -> 'LeasedLock':
+        if not self.acquire():
+            raise LockNotAcquired(self.key)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.release()
+
+    def _renew(self) -> None:
+        while not self._stopped.wait(self.lease / 3):
+            try:
+                self._lock.reacquire()
+            except LockError:
+                logger.warning(f"Lost lock {self.key}, another worker may have taken it")
+                return
+
+
+def lock_pairs(pairs: Iterable[Tuple[int, str]]) -> ExitStack:
+    """
+    Locks loading of each OsmLayer and AreaOfInterest pair, raises LockNotAcquired if any of them is held by
+    someone else. Locks that were already acquired are released in that case.
+    :param pairs: OsmLayer pks and AreaOfInterest pks
+    :return: context manager that releases the locks
+    """
+    stack = ExitStack()
+    try:
+        for layer_id, area_id in pairs:
+            stack.enter_context(LeasedLock(pair_key(layer_id, area_id)))
+    except LockNotAcquired:
+        stack.close()
+        raise
+    return stack
+
+
+def claim(key: str) -> bool:
+    """
+    Marks the work queued or running so that it is not enqueued twice. Claim expires after
+    settings.LOCK_CLAIM_TTL_SECONDS in case the work is lost without releasing it.
+    :param key: name of the work
+    :return: Whether the claim was made, False if the work is already in flight
+    """
+    return bool(get_redis().set(f"{settings.LOCK_KEY_PREFIX}:claim:{key}", 1, nx=True,
+                                ex=settings.LOCK_CLAIM_TTL_SECONDS))
+
+
+def release_claim(key: str) -> None:
+    get_redis().delete(f"{settings.LOCK_KEY_PREFIX}:claim:{key}")
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from datahub.osm_extract import import_osm_extract
+from datahub.tasks import import_osm_extract_file
+
+
+class Command(BaseCommand):
+    help = "Imports features of all OSM layers from OSM extract (.osm.pbf or .osm) instead of Overpass API"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Path to the extract, for example a Geofabrik .osm.pbf file")
+        parser.add_argument('--processes', type=int, default=None,
+                            help="Number of worker processes, defaults to one per GDAL OSM layer")
+        parser.add_argument('--async', action='store_true', dest='run_async',
+                            help="Run in Celery instead. The file must be accessible to the workers.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if options['run_async']:
+            result = import_osm_extract_file.apply_async((path, options['processes']), queue='cpu')
+            self.stdout.write(f"Started import task {result.id}")
+            return
+
+        try:
+            counts = import_osm_extract(path, options['processes'])
+        except FileNotFoundError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"Imported {sum(counts.values())} features to {len(counts)} layers"))
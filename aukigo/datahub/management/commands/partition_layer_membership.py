@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from datahub.partitions import partition_membership, unpartition_membership
+
+
+class Command(BaseCommand):
+    help = ("Partitions the layer memberships of the features by layer, so that the queries of a layer only read "
+            "its own partition and deleting a layer drops its partitions")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--undo', action='store_true', help="Convert the partitioned tables back to plain tables")
+
+    def handle(self, *args, **options):
+        if options['undo']:
+            converted = unpartition_membership()
+        else:
+            converted = partition_membership()
+        if not converted:
+            self.stdout.write("Nothing to convert")
+            return
+        self.stdout.write(self.style.SUCCESS(f"Converted {', '.join(g.name for g in converted)} layer memberships"))
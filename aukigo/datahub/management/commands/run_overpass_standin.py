@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from datahub.overpass_standin import OverpassStandIn, Faults
+
+
+class Command(BaseCommand):
+    help = ("Runs a local stand-in for Overpass API that serves recorded OSM xml files. "
+            "Point OVERPASS_API_URLS to the printed url to load data offline.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('responses', nargs='+',
+                            help="OSM xml files served in order, relative to the test data directory. "
+                                 "Numbers are served as HTTP status codes.")
+        parser.add_argument('--host', default='localhost')
+        parser.add_argument('--port', type=int, default=8090)
+        parser.add_argument('--scale', type=int, default=1, help="Number of copies of the features in responses")
+        parser.add_argument('--rate-limit-probability', type=float, default=0.0,
+                            help="Probability of responding with 429")
+        parser.add_argument('--timeout-probability', type=float, default=0.0,
+                            help="Probability of responding with 504")
+        parser.add_argument('--latency', type=float, default=0.0, help="Seconds before each response")
+        parser.add_argument('--drip-bytes-per-second', type=int, default=None, help="Throttle response bodies")
+        parser.add_argument('--seed', type=int, default=None, help="Seed for the injected faults")
+
+    def handle(self, *args, **options):
+        responses = [int(response) if response.isdigit() else response for response in options['responses']]
+        faults = Faults(
+            rate_limit_probability=options['rate_limit_probability'],
+            timeout_probability=options['timeout_probability'],
+            latency=options['latency'],
+            drip_bytes_per_second=options['drip_bytes_per_second'],
+            seed=options['seed']
+        )
+        standin = OverpassStandIn(responses, faults=faults, scale=options['scale'], host=options['host'],
+                                  port=options['port'])
+        self.stdout.write(self.style.SUCCESS(f"Serving Overpass stand-in at {standin.url}"))
+        try:
+            standin.serve_forever()
+        except KeyboardInterrupt:
+            pass
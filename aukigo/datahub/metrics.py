@@ -0,0 +1,70 @@
+import logging
+import os
+import time
+
+from celery import signals
+from django.conf import settings
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, multiprocess
+
+logger = logging.getLogger(__name__)
+
+# Gunicorn and Celery workers each write their values to files in PROMETHEUS_MULTIPROC_DIR, which are
+# aggregated when scraped. Metrics are created lazily per label values, so the directory is created here.
+if settings.PROMETHEUS_MULTIPROC_DIR:
+    os.makedirs(settings.PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf'))
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(10)) + (float('inf'),)
+
+REQUEST_LATENCY = Histogram('aukigo_http_request_duration_seconds', 'Latency of the API requests per view',
+                            ['view', 'method', 'status'])
+REQUEST_QUERIES = Histogram('aukigo_http_request_db_queries', 'Database queries per API request',
+                            ['view', 'method'], buckets=QUERY_COUNT_BUCKETS)
+
+TASK_DURATION = Histogram('aukigo_celery_task_duration_seconds', 'Duration of the Celery tasks',
+                          ['task', 'state'], buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600,
+                                                      float('inf')))
+TASK_OUTCOMES = Counter('aukigo_celery_tasks', 'Finished Celery tasks by state', ['task', 'state'])
+TASK_RETRIES = Counter('aukigo_celery_task_retries', 'Retries of the Celery tasks', ['task'])
+
+FEATURES_INGESTED = Counter('aukigo_features_ingested', 'Features synchronized to the layers',
+                            ['layer', 'geom_type'])
+
+OVERPASS_BYTES = Counter('aukigo_overpass_received_bytes', 'Bytes received from Overpass', ['endpoint'])
+OVERPASS_LATENCY = Histogram('aukigo_overpass_request_duration_seconds', 'Duration of the Overpass queries',
+                             ['endpoint', 'outcome'], buckets=(0.5, 1, 5, 10, 30, 60, 120, 300, 600, 900,
+                                                               float('inf')))
+OVERPASS_RESPONSE_SIZE = Histogram('aukigo_overpass_response_bytes', 'Size of the Overpass responses',
+                                   ['endpoint'], buckets=BYTES_BUCKETS)
+
+_task_started = {}
+
+
+def get_registry() -> CollectorRegistry:
+    """
+    :return: registry with the values of all the processes if multiprocess mode is in use
+    """
+    if not settings.PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+@signals.task_prerun.connect
+def _on_task_prerun(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+
+@signals.task_postrun.connect
+def _on_task_postrun(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    state = state or 'UNKNOWN'
+    TASK_OUTCOMES.labels(task=task.name, state=state).inc()
+    if started is not None:
+        TASK_DURATION.labels(task=task.name, state=state).observe(time.perf_counter() - started)
+
+
+@signals.task_retry.connect
+def _on_task_retry(sender=None, **kwargs):
+    TASK_RETRIES.labels(task=sender.name).inc()
@@ -0,0 +1,37 @@
+import time
+
+from django.db import connection
+
+from .metrics import REQUEST_LATENCY, REQUEST_QUERIES
+
+
+class MetricsMiddleware:
+    """
+    Records latency and number of database queries of each request by the name of the view
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(count_query):
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        view = getattr(request, 'metrics_view_name', 'unresolved')
+        REQUEST_LATENCY.labels(view=view, method=request.method, status=response.status_code).observe(duration)
+        REQUEST_QUERIES.labels(view=view, method=request.method).observe(queries[0])
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Class based views and DRF viewsets are named by the class, so that the label values stay bounded
+        view_class = getattr(view_func, 'cls', None) or getattr(view_func, 'view_class', None)
+        request.metrics_view_name = view_class.__name__ if view_class is not None else view_func.__name__
+        return None
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.13 on 2026-10-17 09:12
+
+import django.db.models.deletion
+import django_better_admin_arrayfield.models.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datahub', '0011_layer_style'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OsmSyncState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_sync', models.DateTimeField(blank=True, help_text='OSM data timestamp of the last successful synchronization', null=True)),
+                ('last_full_sync', models.DateTimeField(blank=True, help_text='Time of the last successful full synchronization', null=True)),
+                ('tags', django_better_admin_arrayfield.models.fields.ArrayField(base_field=models.CharField(max_length=200), blank=True, help_text='Layer tags used in the last full synchronization', null=True, size=None)),
+                ('area', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_states', to='datahub.areaofinterest')),
+                ('layer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_states', to='datahub.osmlayer')),
+            ],
+            options={
+                'unique_together': {('layer', 'area')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.1.13 on 2026-10-17 13:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datahub', '0012_osmsyncstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OverpassEndpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.URLField(help_text='Base url of the API, for example https://overpass-api.de/api', unique=True)),
+                ('enabled', models.BooleanField(default=True)),
+                ('request_count', models.PositiveIntegerField(default=0)),
+                ('failure_count', models.PositiveIntegerField(default=0)),
+                ('timeout_count', models.PositiveIntegerField(default=0)),
+                ('rate_limited_count', models.PositiveIntegerField(default=0)),
+                ('latency', models.FloatField(blank=True, help_text='Exponentially weighted moving average of the query duration in seconds', null=True)),
+                ('consecutive_failures', models.PositiveIntegerField(default=0)),
+                ('circuit_open_until', models.DateTimeField(blank=True, help_text='Endpoint is not used until this time after repeated failures', null=True)),
+                ('last_error', models.CharField(blank=True, max_length=500)),
+                ('last_success', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.1.13 on 2026-10-17 20:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datahub', '0013_overpassendpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='osmsyncstate',
+            name='change_rate',
+            field=models.FloatField(blank=True, help_text='Exponentially weighted moving average of changed features per hour', null=True),
+        ),
+        migrations.AddField(
+            model_name='osmsyncstate',
+            name='last_duration',
+            field=models.FloatField(blank=True, help_text='Duration of the last successful synchronization in seconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='osmsyncstate',
+            name='last_scheduled',
+            field=models.DateTimeField(blank=True, help_text='Time when the last refresh was enqueued', null=True),
+        ),
+        migrations.AddField(
+            model_name='osmsyncstate',
+            name='last_success',
+            field=models.DateTimeField(blank=True, help_text='Time of the last successful synchronization', null=True),
+        ),
+        migrations.AddField(
+            model_name='osmsyncstate',
+            name='refresh_interval',
+            field=models.PositiveIntegerField(blank=True, help_text='Minutes between the refreshes. Defaults to OSM_REFRESH_INTERVAL_MINUTES setting.', null=True),
+        ),
+    ]
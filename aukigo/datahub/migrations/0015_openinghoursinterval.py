@@ -0,0 +1,193 @@
+# Generated by Django 3.1.13 on 2026-10-17 22:41
+
+import re
+
+from django.conf import settings
+from django.db import migrations, models
+
+# The parser and the SQL functions are copied here as they were when the migration was written, so that later
+# changes to datahub.opening_hours or datahub.utils do not change what the migration does
+DAYS = ['mo', 'tu', 'we', 'th', 'fr', 'sa', 'su']
+MINUTES_IN_DAY = 24 * 60
+MINUTES_IN_WEEK = 7 * MINUTES_IN_DAY
+DAY_RANGE = re.compile(r'^(mo|tu|we|th|fr|sa|su)(?:-(mo|tu|we|th|fr|sa|su))?$')
+TIME_RANGE = re.compile(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})\+?$')
+SEPARATOR = re.compile(r'\s*-\s*')
+ADDITIONAL_RULE = re.compile(r'(?<=[\d+fd]),\s*(?=(?:mo|tu|we|th|fr|sa|su|ph|sh)[a-z,-]*\s)')
+HOLIDAYS = {'ph', 'sh'}
+CLOSED = {'off', 'closed'}
+
+# Feature model and view postfix of each geometry type
+FEATURE_MODELS = {'POINT': ('OsmPoint', 'p'), 'LINE': ('OsmLine', 'l'), 'POLYGON': ('OsmPolygon', 'pl')}
+
+# noinspection SqlNoDataSourceInspection
+OPENING_HOURS_FUNCTIONS = '''
+CREATE OR REPLACE FUNCTION minute_of_week()
+RETURNS integer
+LANGUAGE sql
+STABLE
+PARALLEL SAFE
+AS $minute_of_week$
+	SELECT ((extract(isodow FROM t) - 1) * 1440 + extract(hour FROM t) * 60 + extract(minute FROM t))::integer
+	FROM (SELECT NOW() AT TIME ZONE 'Europe/Helsinki' AS t) AS current_time_in_zone
+$minute_of_week$;
+
+CREATE OR REPLACE FUNCTION is_open(
+	feature_type varchar,
+	feature_id bigint
+)
+RETURNS bool
+LANGUAGE sql
+STABLE
+PARALLEL SAFE
+AS $is_open$
+	SELECT EXISTS (
+		SELECT 1 FROM datahub_openinghoursinterval
+		WHERE geom_type = feature_type AND osmid = feature_id
+		  AND start_minute <= minute_of_week() AND end_minute > minute_of_week()
+	)
+$is_open$;
+'''
+
+
+class UnsupportedOpeningHours(ValueError):
+    pass
+
+
+def parse_opening_hours(value):
+    hours = {}
+    for rule in re.split(r';|\|\|', value):
+        rule = SEPARATOR.sub('-', rule.strip().lower())
+        if not rule:
+            continue
+        if rule == '24/7':
+            hours = {day: [(0, MINUTES_IN_DAY)] for day in range(7)}
+            continue
+        for i, additional_rule in enumerate(ADDITIONAL_RULE.split(rule)):
+            try:
+                days, times = parse_rule(additional_rule.strip())
+            except UnsupportedOpeningHours:
+                continue
+            for day in days:
+                hours[day] = (hours.get(day, []) if i else []) + times
+
+    intervals = []
+    for day, times in hours.items():
+        for start, end in times:
+            start, end = day * MINUTES_IN_DAY + start, day * MINUTES_IN_DAY + end
+            if end > MINUTES_IN_WEEK:
+                intervals.append((0, end - MINUTES_IN_WEEK))
+                end = MINUTES_IN_WEEK
+            intervals.append((start, end))
+
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def parse_rule(rule):
+    parts = rule.split(None, 1)
+    if all(DAY_RANGE.match(part) or part in HOLIDAYS for part in parts[0].split(',')):
+        days = parse_days(parts[0])
+        times = parts[1].strip() if len(parts) > 1 else '00:00-24:00'
+    else:
+        days = list(range(7))
+        times = rule
+    if times in CLOSED:
+        return days, []
+    return days, [parse_time_range(time_range.strip()) for time_range in times.split(',')]
+
+
+def parse_days(selector):
+    days = []
+    for part in selector.split(','):
+        if part in HOLIDAYS:
+            continue
+        first, last = DAY_RANGE.match(part).groups()
+        first, last = DAYS.index(first), DAYS.index(last or first)
+        days += [day % 7 for day in range(first, last + 1 if last >= first else last + 8)]
+    return days
+
+
+def parse_time_range(time_range):
+    match = TIME_RANGE.match(time_range)
+    if match is None:
+        raise UnsupportedOpeningHours(time_range)
+    start_hour, start_minute, end_hour, end_minute = map(int, match.groups())
+    start, end = start_hour * 60 + start_minute, end_hour * 60 + end_minute
+    if start >= MINUTES_IN_DAY or end > 2 * MINUTES_IN_DAY:
+        raise UnsupportedOpeningHours(time_range)
+    if end <= start:
+        end += MINUTES_IN_DAY
+    return start, end
+
+
+def parse_existing_opening_hours(apps, schema_editor):
+    OpeningHoursInterval = apps.get_model('datahub', 'OpeningHoursInterval')
+    for geom_type, (model_name, postfix) in FEATURE_MODELS.items():
+        model = apps.get_model('datahub', model_name)
+        features = model.objects.filter(tags__has_key='opening_hours').values_list('osmid', 'tags')
+        OpeningHoursInterval.objects.bulk_create(
+            (OpeningHoursInterval(geom_type=geom_type, osmid=osmid, start_minute=start, end_minute=end)
+             for osmid, tags in features.iterator()
+             for start, end in parse_opening_hours(tags['opening_hours'])),
+            batch_size=10000)
+
+
+# noinspection SqlNoDataSourceInspection
+def rebuild_layer_views(apps, schema_editor):
+    """
+    Existing layer views still call is_currently_open, they are replaced with views that look up the intervals.
+    The view of a materialized tileset selects from its materialized view, otherwise the view selects the
+    features of the layer. currently_open is the first column in both, so the views can be replaced in place.
+    """
+    OsmLayer = apps.get_model('datahub', 'OsmLayer')
+    using = schema_editor.connection.alias
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(OPENING_HOURS_FUNCTIONS)
+        for layer in OsmLayer.objects.using(using).all():
+            for geom_type in layer._geom_types or []:
+                model_name, postfix = FEATURE_MODELS[geom_type]
+                view_name = f"{settings.PG_VIEW_PREFIX}_{layer.name.lower()}_{postfix}"
+                materialized_view_name = f"{settings.PG_VIEW_PREFIX}_mv_{layer.name.lower()}_{postfix}"
+                currently_open = f"CASE WHEN tags->>'opening_hours' IS NOT NULL THEN is_open('{geom_type}', osmid) END"
+
+                cursor.execute("SELECT to_regclass(%s)", [materialized_view_name])
+                if cursor.fetchone()[0] is not None:
+                    sql, params = f"SELECT {currently_open} AS currently_open, * FROM {materialized_view_name}", ()
+                else:
+                    queryset = (apps.get_model('datahub', model_name).objects.using(using).filter(layers=layer.pk)
+                                .extra(select={'currently_open': currently_open}))
+                    sql, params = queryset.query.get_compiler(using=using).as_sql()
+                    sql = sql.replace('::bytea', '')
+                cursor.execute(f'CREATE OR REPLACE VIEW {view_name} AS {sql}', params)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datahub', '0014_osmsyncstate_scheduling'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OpeningHoursInterval',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('geom_type', models.CharField(choices=[('POINT', 'POINT'), ('LINE', 'LINE'), ('POLYGON', 'POLYGON')], max_length=10)),
+                ('osmid', models.BigIntegerField()),
+                ('start_minute', models.PositiveSmallIntegerField()),
+                ('end_minute', models.PositiveSmallIntegerField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='openinghoursinterval',
+            index=models.Index(fields=['geom_type', 'osmid', 'start_minute', 'end_minute'], name='datahub_opening_hours_idx'),
+        ),
+        migrations.RunPython(parse_existing_opening_hours, migrations.RunPython.noop),
+        migrations.RunPython(rebuild_layer_views, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 3.1.13 on 2026-10-17 23:30
+
+import django.db.models.deletion
+import django.utils.timezone
+import django_better_admin_arrayfield.models.fields
+from django.contrib.gis.db.models import Extent
+from django.db import migrations, models
+from django.db.models import Count, Func, Sum
+
+from datahub.utils import GeomType
+
+
+def compute_existing_statistics(apps, schema_editor):
+    OsmLayer = apps.get_model('datahub', 'OsmLayer')
+    LayerStatistics = apps.get_model('datahub', 'LayerStatistics')
+    for layer in OsmLayer.objects.all():
+        for geom_type_name in layer._geom_types or []:
+            model = apps.get_model('datahub', GeomType[geom_type_name].osm_model.__name__)
+            values = model.objects.filter(layers=layer.pk).aggregate(
+                extent=Extent('geom'), feature_count=Count('osmid'),
+                total_bytes=Sum(Func('tags', function='pg_column_size') + Func('geom', function='pg_column_size'),
+                                output_field=models.BigIntegerField()))
+            LayerStatistics.objects.create(layer=layer, geom_type=geom_type_name,
+                                           bounds=list(values['extent']) if values['extent'] else None,
+                                           feature_count=values['feature_count'],
+                                           total_bytes=values['total_bytes'] or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datahub', '0015_openinghoursinterval'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LayerStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('geom_type', models.CharField(max_length=10)),
+                ('bounds', django_better_admin_arrayfield.models.fields.ArrayField(base_field=models.FloatField(), blank=True, help_text='Extent of the features as min x, min y, max x and max y', null=True, size=4)),
+                ('feature_count', models.PositiveIntegerField(default=0)),
+                ('total_bytes', models.BigIntegerField(default=0, help_text='Stored size of the tags and geometries')),
+                ('last_modified', models.DateTimeField(default=django.utils.timezone.now, help_text='Time when the statistics last changed')),
+                ('layer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='statistics', to='datahub.osmlayer')),
+            ],
+            options={
+                'unique_together': {('layer', 'geom_type')},
+            },
+        ),
+        migrations.RunPython(compute_existing_statistics, migrations.RunPython.noop),
+    ]
@@ -1,20 +1,27 @@
+import datetime
+import hashlib
 import logging
-from typing import Tuple
+from typing import Iterable, Tuple, Optional
 
 from django.conf import settings
 from django.contrib.gis.db import models
 from django.contrib.gis.db.models import Extent
 from django.contrib.gis.geos import Polygon
 from django.contrib.postgres.fields import JSONField
-from django.db import DEFAULT_DB_ALIAS, connections
-from django.db.models import QuerySet
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import QuerySet, Count, Sum, Func
+from django.utils import timezone
 from django_better_admin_arrayfield.models.fields import ArrayField
 
-from .utils import (GeomType, polygon_to_overpass_bbox, IS_CURRENTLY_OPEN_FUNCTION)
+from .opening_hours import store_opening_hours
+from .partitions import create_layer_partitions, drop_layer_partitions
+from .utils import (GeomType, polygon_to_overpass_bbox, OPENING_HOURS_FUNCTIONS)
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_BOUNDS = (-180.0, -90.0, 180.0, 90.0)
+# Opening hours of a feature whose tags were not loaded from the database, its intervals are always stored on save
+_NOT_LOADED = object()
 
 
 class Layer(models.Model):
@@ -52,13 +59,18 @@ class Layer(models.Model):
 
     @property
     def osm_layer(self):
-        return OsmLayer.objects.filter(name=self.name).first()
+        # Child row of the multi-table inheritance, fetched with select_related('osmlayer')
+        try:
+            return self.osmlayer
+        except OsmLayer.DoesNotExist:
+            return None
 
     def get_bounds(self, geom_type: GeomType) -> Tuple[float, float, float, float]:
         bounds = None
         osm_layer: OsmLayer = self.osm_layer
         if osm_layer:
-            bounds = osm_layer.get_bounds(geom_type)
+            statistics = osm_layer.get_statistics(geom_type)
+            bounds = statistics.bounds if statistics else None
         return bounds if bounds else DEFAULT_BOUNDS
 
     def get_common_bounds(self) -> Tuple[float, float, float, float]:
@@ -132,8 +144,16 @@ class OsmLayer(Layer):
     _geom_types = ArrayField(models.CharField(max_length=10), blank=True, null=True, default=list,
                              help_text="Leave this field empty. It is populated programmatically.")
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding:
+            create_layer_partitions(self.pk)
+
     def delete(self, using=None, keep_parents=False):
         self._drop_views()
+        # Memberships in the layer partitions are dropped at once instead of deleting them row by row
+        drop_layer_partitions(self.pk)
         return super().delete(using, keep_parents)
 
     def get_bounds(self, geom_type: GeomType) -> Tuple[float, float, float, float]:
@@ -142,6 +162,33 @@ class OsmLayer(Layer):
     def get_objects_for_type(self, geom_type: GeomType) -> QuerySet:
         return geom_type.osm_model.objects.filter(layers=self.pk)
 
+    def get_statistics(self, geom_type: GeomType) -> Optional['LayerStatistics']:
+        # Iterating all() uses the statistics of prefetch_related('statistics')
+        return next((statistics for statistics in self.statistics.all() if statistics.geom_type == geom_type.name),
+                    None)
+
+    def update_statistics(self, using=DEFAULT_DB_ALIAS) -> None:
+        """
+        Stores bounds, feature count and size of the features of each geometry type, so that they are not
+        aggregated again whenever the layer is serialized. Last modified time changes only if the statistics do.
+        :param using: Database key
+        """
+        now = timezone.now()
+        self.statistics.using(using).exclude(geom_type__in=self._geom_types or []).delete()
+        for geom_type in self.geom_types:
+            values = self.get_objects_for_type(geom_type).using(using).aggregate(
+                extent=Extent('geom'), feature_count=Count('osmid'),
+                total_bytes=Sum(Func('tags', function='pg_column_size') + Func('geom', function='pg_column_size'),
+                                output_field=models.BigIntegerField()))
+            bounds = list(values['extent']) if values['extent'] else None
+            statistics, created = LayerStatistics.objects.using(using).get_or_create(layer=self,
+                                                                                     geom_type=geom_type.name)
+            current = (bounds, values['feature_count'], values['total_bytes'] or 0)
+            if created or (statistics.bounds, statistics.feature_count, statistics.total_bytes) != current:
+                statistics.bounds, statistics.feature_count, statistics.total_bytes = current
+                statistics.last_modified = now
+                statistics.save(using=using)
+
     def get_related(self, area: AreaOfInterest) -> {GeomType: set}:
         bbox: Polygon = area.bbox.envelope
         return {
@@ -163,23 +210,42 @@ class OsmLayer(Layer):
 
     def add_support_for_type(self, geom_type: GeomType, using=DEFAULT_DB_ALIAS) -> None:
         """
-        Adds view and type for geometry type
+        Adds view and type for geometry type. If settings.OSM_MATERIALIZED_TILESETS is set, features of the
+        layer are stored in a materialized view with a spatial index and the view only adds currently_open
+        on top of it. Materialized view is refreshed if it already exists.
         :param geom_type: geometry type to support
         :param using: Database key
         :return:
         """
-        # Inspired by https://adamj.eu/tech/2019/04/29/create-table-as-select-in-django/
-        queryset = (geom_type.osm_model.objects.filter(layers=self)
-                    .extra(select={'currently_open': "is_currently_open(tags->>'opening_hours')"}))
-        compiler = queryset.query.get_compiler(using=using)
-        sql, params = compiler.as_sql()
-        connection = connections[DEFAULT_DB_ALIAS]
-        sql = sql.replace('::bytea', '')  # Use geom as is, do not convert it to byte array
         view_name = self._get_view_name_for_type(geom_type)
-        sql = IS_CURRENTLY_OPEN_FUNCTION + f'\n CREATE OR REPLACE VIEW {view_name} AS {sql}'
+        materialized_view_name = self._get_materialized_view_name_for_type(geom_type)
+        connection = connections[DEFAULT_DB_ALIAS]
+
+        if settings.OSM_MATERIALIZED_TILESETS:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT to_regclass(%s)", [materialized_view_name])
+                exists = cursor.fetchone()[0] is not None
+            if exists:
+                self._refresh_materialized_view(geom_type)
+            else:
+                self._create_materialized_view(geom_type, using)
+            # Opening hours depend on the current time, so they are evaluated when the tiles are queried
+            sql = (OPENING_HOURS_FUNCTIONS + f"\n CREATE OR REPLACE VIEW {view_name} AS SELECT "
+                   f"{self._get_currently_open_sql(geom_type)} AS currently_open, * FROM {materialized_view_name}")
+            params = ()
+        else:
+            # Inspired by https://adamj.eu/tech/2019/04/29/create-table-as-select-in-django/
+            queryset = (geom_type.osm_model.objects.filter(layers=self)
+                        .extra(select={'currently_open': self._get_currently_open_sql(geom_type)}))
+            sql, params = self._compile_queryset(queryset, using)
+            sql = OPENING_HOURS_FUNCTIONS + f'\n CREATE OR REPLACE VIEW {view_name} AS {sql}'
+
         logger.debug(sql)
         with connection.cursor() as cursor:
             cursor.execute(sql, params)
+            if not settings.OSM_MATERIALIZED_TILESETS:
+                # Left over if the setting was turned off, the view does not depend on it anymore
+                cursor.execute(f'DROP MATERIALIZED VIEW IF EXISTS {materialized_view_name}')
 
         if geom_type not in self.geom_types:
             if self.attribution is None or "osm" not in self.attribution or "open" not in self.attribution.lower():
@@ -200,31 +266,233 @@ class OsmLayer(Layer):
         if geom_type in self.geom_types:
             connection = connections[using]
             with connection.cursor() as cursor:
-                sql = f'DROP VIEW IF EXISTS {self._get_view_name_for_type(geom_type)}'
-                logger.debug(sql)
-                cursor.execute(sql)
+                self._drop_view(cursor, geom_type)
 
             self._geom_types.remove(geom_type.name)
             self.save()
 
             Tileset.objects.filter(layer=self, geom_type=geom_type.name).delete()
+            self.statistics.filter(geom_type=geom_type.name).delete()
 
     def _get_view_name_for_type(self, geom_type: GeomType) -> str:
         return f"{settings.PG_VIEW_PREFIX}_{self.name.lower()}_{geom_type.value['postfix']}"
 
+    def _get_materialized_view_name_for_type(self, geom_type: GeomType) -> str:
+        return f"{settings.PG_VIEW_PREFIX}_mv_{self.name.lower()}_{geom_type.value['postfix']}"
+
+    @staticmethod
+    def _get_currently_open_sql(geom_type: GeomType) -> str:
+        # Indexed lookup of the intervals parsed when the features were saved
+        return f"CASE WHEN tags->>'opening_hours' IS NOT NULL THEN is_open('{geom_type.name}', osmid) END"
+
+    @staticmethod
+    def _compile_queryset(queryset: QuerySet, using: str) -> Tuple[str, tuple]:
+        sql, params = queryset.query.get_compiler(using=using).as_sql()
+        return sql.replace('::bytea', ''), params  # Use geom as is, do not convert it to byte array
+
+    def _create_materialized_view(self, geom_type: GeomType, using=DEFAULT_DB_ALIAS) -> None:
+        name = self._get_materialized_view_name_for_type(geom_type)
+        sql, params = self._compile_queryset(geom_type.osm_model.objects.filter(layers=self), using)
+        # Identifiers longer than 63 characters would be truncated and could collide
+        index_prefix = f"{settings.PG_VIEW_PREFIX}_{hashlib.md5(name.encode()).hexdigest()[:16]}"
+        statements = [
+            (f'CREATE MATERIALIZED VIEW {name} AS {sql}', params),
+            # Unique index is required for refreshing concurrently
+            (f'CREATE UNIQUE INDEX {index_prefix}_osmid ON {name} (osmid)', ()),
+            (f'CREATE INDEX {index_prefix}_geom ON {name} USING GIST (geom)', ()),
+        ]
+        with connections[using].cursor() as cursor:
+            for statement, statement_params in statements:
+                logger.debug(statement)
+                cursor.execute(statement, statement_params)
+
+    def refresh_materialized_view(self, geom_type: GeomType, using=DEFAULT_DB_ALIAS) -> None:
+        """
+        Refreshes the materialized view of the geometry type if the layer has one
+        :param geom_type: geometry type of the view
+        :param using: Database key
+        """
+        with connections[using].cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)", [self._get_materialized_view_name_for_type(geom_type)])
+            exists = cursor.fetchone()[0] is not None
+        if exists:
+            self._refresh_materialized_view(geom_type, using)
+
+    @classmethod
+    def refresh_views_of_features(cls, id_dict: {GeomType: set}, exclude: Iterable[int] = (),
+                                  using=DEFAULT_DB_ALIAS) -> None:
+        """
+        Refreshes the materialized views of the layers that contain some of the features. Layers share the
+        features, so the other layers would serve the old rows until their own synchronization otherwise.
+        :param id_dict: ids of the changed features by geometry type
+        :param exclude: pks of the layers whose views are already up to date
+        :param using: Database key
+        """
+        if not settings.OSM_MATERIALIZED_TILESETS:
+            return
+        for geom_type, ids in id_dict.items():
+            if not len(ids):
+                continue
+            layers = (cls.objects.using(using)
+                      .filter(**{f'{geom_type.osm_model._meta.model_name}__in': list(ids)})
+                      .exclude(pk__in=list(exclude)).distinct())
+            for layer in layers:
+                logger.debug(f"Refreshing {geom_type.name} view of layer '{layer}' that shares changed features")
+                layer.refresh_materialized_view(geom_type, using)
+
+    def _refresh_materialized_view(self, geom_type: GeomType, using=DEFAULT_DB_ALIAS) -> None:
+        # Tiles can be served from the old rows while the view is refreshed
+        sql = f'REFRESH MATERIALIZED VIEW CONCURRENTLY {self._get_materialized_view_name_for_type(geom_type)}'
+        logger.debug(sql)
+        with connections[using].cursor() as cursor:
+            cursor.execute(sql)
+
+    def _drop_view(self, cursor, geom_type: GeomType) -> None:
+        for sql in (f'DROP VIEW IF EXISTS {self._get_view_name_for_type(geom_type)}',
+                    f'DROP MATERIALIZED VIEW IF EXISTS {self._get_materialized_view_name_for_type(geom_type)}'):
+            logger.debug(sql)
+            cursor.execute(sql)
+
     def _drop_views(self):
         connection = connections[DEFAULT_DB_ALIAS]
 
         with connection.cursor() as cursor:
             for geom_type in self.geom_types:
-                sql = f'DROP VIEW IF EXISTS {self._get_view_name_for_type(geom_type)}'
-                logger.debug(sql)
-                cursor.execute(sql)
+                self._drop_view(cursor, geom_type)
 
     def __str__(self):
         return self.name
 
 
+class OsmSyncState(models.Model):
+    """
+    Synchronization state of OsmLayer in AreaOfInterest. Used to fetch only the changed OSM objects and to
+    schedule the refreshes of the pair.
+    """
+    CHANGE_RATE_SMOOTHING = 0.3
+
+    layer = models.ForeignKey(OsmLayer, related_name='sync_states', on_delete=models.CASCADE)
+    area = models.ForeignKey(AreaOfInterest, related_name='sync_states', on_delete=models.CASCADE)
+    last_sync = models.DateTimeField(blank=True, null=True,
+                                     help_text="OSM data timestamp of the last successful synchronization")
+    last_full_sync = models.DateTimeField(blank=True, null=True,
+                                          help_text="Time of the last successful full synchronization")
+    tags = ArrayField(models.CharField(max_length=200), blank=True, null=True,
+                      help_text="Layer tags used in the last full synchronization")
+    last_success = models.DateTimeField(blank=True, null=True, help_text="Time of the last successful synchronization")
+    last_scheduled = models.DateTimeField(blank=True, null=True, help_text="Time when the last refresh was enqueued")
+    last_duration = models.FloatField(blank=True, null=True,
+                                      help_text="Duration of the last successful synchronization in seconds")
+    change_rate = models.FloatField(blank=True, null=True,
+                                    help_text="Exponentially weighted moving average of changed features per hour")
+    refresh_interval = models.PositiveIntegerField(blank=True, null=True,
+                                                   help_text="Minutes between the refreshes. Defaults to "
+                                                             "OSM_REFRESH_INTERVAL_MINUTES setting.")
+
+    class Meta:
+        unique_together = ('layer', 'area')
+
+    def get_changes_since(self) -> Optional[datetime.datetime]:
+        """
+        :return: timestamp to fetch changes from or None if full synchronization is needed
+        """
+        if self.last_sync is None or self.last_full_sync is None or self.tags != self.layer.tags:
+            return None
+        full_sync_interval = datetime.timedelta(hours=settings.OSM_FULL_SYNC_INTERVAL_HOURS)
+        if timezone.now() - self.last_full_sync >= full_sync_interval:
+            return None
+        return self.last_sync
+
+    def mark_synced(self, timestamp: datetime.datetime, full: bool, changed: Optional[int] = None) -> None:
+        """
+        :param timestamp: OSM data timestamp of the synchronized data
+        :param full: Whether all the features were synchronized or only the changed ones
+        :param changed: number of changed features in incremental synchronization
+        """
+        if not full and changed is not None and self.last_sync is not None and timestamp > self.last_sync:
+            rate = changed / ((timestamp - self.last_sync).total_seconds() / 3600)
+            self.change_rate = rate if self.change_rate is None else (
+                    self.CHANGE_RATE_SMOOTHING * rate + (1 - self.CHANGE_RATE_SMOOTHING) * self.change_rate)
+        self.last_sync = timestamp
+        self.last_success = timezone.now()
+        if full:
+            self.last_full_sync = self.last_success
+            self.tags = self.layer.tags
+        self.save()
+
+    def get_refresh_interval(self) -> datetime.timedelta:
+        return datetime.timedelta(minutes=self.refresh_interval or settings.OSM_REFRESH_INTERVAL_MINUTES)
+
+    def get_staleness(self, now: datetime.datetime) -> float:
+        """
+        :return: time since the last success relative to the refresh interval, infinite if never synchronized
+        """
+        if self.last_success is None:
+            return float('inf')
+        return (now - self.last_success) / self.get_refresh_interval()
+
+    def is_due(self, now: datetime.datetime) -> bool:
+        """
+        :return: Whether the pair should be refreshed
+        """
+        interval = self.get_refresh_interval()
+        pending = self.last_scheduled is not None and (self.last_success is None
+                                                       or self.last_scheduled > self.last_success)
+        if pending and now - self.last_scheduled < interval:
+            # Refresh is still queued or running, it is given up after an interval
+            return False
+        return self.last_success is None or now - self.last_success >= interval
+
+    def __str__(self):
+        return f"{self.layer} ({self.area}): {self.last_sync}"
+
+
+class OverpassEndpoint(models.Model):
+    """
+    Overpass API server in the pool that the queries are distributed to. Statistics are updated by OsmLoader.
+    """
+    url = models.URLField(unique=True, help_text="Base url of the API, for example https://overpass-api.de/api")
+    enabled = models.BooleanField(default=True)
+
+    request_count = models.PositiveIntegerField(default=0)
+    failure_count = models.PositiveIntegerField(default=0)
+    timeout_count = models.PositiveIntegerField(default=0)
+    rate_limited_count = models.PositiveIntegerField(default=0)
+    latency = models.FloatField(blank=True, null=True,
+                                help_text="Exponentially weighted moving average of the query duration in seconds")
+    consecutive_failures = models.PositiveIntegerField(default=0)
+    circuit_open_until = models.DateTimeField(blank=True, null=True,
+                                              help_text="Endpoint is not used until this time after repeated failures")
+    last_error = models.CharField(max_length=500, blank=True)
+    last_success = models.DateTimeField(blank=True, null=True)
+
+    @property
+    def is_available(self) -> bool:
+        return self.enabled and (self.circuit_open_until is None or self.circuit_open_until <= timezone.now())
+
+    def __str__(self):
+        return self.url
+
+
+class LayerStatistics(models.Model):
+    """
+    Statistics of the features of OsmLayer by geometry type. Updated at the end of each synchronization.
+    """
+    layer = models.ForeignKey(OsmLayer, related_name='statistics', on_delete=models.CASCADE)
+    geom_type = models.CharField(max_length=10)
+    bounds = ArrayField(models.FloatField(), size=4, blank=True, null=True,
+                        help_text="Extent of the features as min x, min y, max x and max y")
+    feature_count = models.PositiveIntegerField(default=0)
+    total_bytes = models.BigIntegerField(default=0, help_text="Stored size of the tags and geometries")
+    last_modified = models.DateTimeField(default=timezone.now, help_text="Time when the statistics last changed")
+
+    class Meta:
+        unique_together = ('layer', 'geom_type')
+
+    def __str__(self):
+        return f"{self.layer} ({self.geom_type}): {self.feature_count} features"
+
+
 class Tileset(models.Model):
     """
     Serialized as Json following the TileJSON 2.2.0 Spec
@@ -249,11 +517,23 @@ class Tileset(models.Model):
         return f"{self.layer} ({self.geom_type}): {self.table}"
 
 
+class OsmFeatureQuerySet(QuerySet):
+    def delete(self):
+        # Opening hours intervals do not have a foreign key to the features, so they are not cascaded
+        geom_type = next(geom_type for geom_type in GeomType if geom_type.osm_model is self.model)
+        with transaction.atomic(using=self.db):
+            OpeningHoursInterval.objects.using(self.db).filter(
+                geom_type=geom_type.name, osmid__in=self.values('osmid')).delete()
+            return super().delete()
+
+
 class OsmFeature(models.Model):
     osmid = models.BigIntegerField(primary_key=True)
     layers = models.ManyToManyField(OsmLayer, blank=True)
     tags = JSONField()
 
+    objects = OsmFeatureQuerySet.as_manager()
+
     class Meta:
         abstract = True
 
@@ -270,6 +550,31 @@ class OsmFeature(models.Model):
             logger.debug(f"Deleted feature {self}")
             self.delete()
 
+    @property
+    def geom_type(self) -> GeomType:
+        return next(geom_type for geom_type in GeomType if geom_type.osm_model is type(self))
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Deferred tags are not loaded just to compare them, the intervals are stored on save instead
+        tags = instance.__dict__.get('tags')
+        instance._stored_opening_hours = tags.get('opening_hours') if isinstance(tags, dict) else _NOT_LOADED
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        opening_hours = (self.tags or {}).get('opening_hours')
+        if (update_fields is None or 'tags' in update_fields) and (
+                opening_hours != getattr(self, '_stored_opening_hours', _NOT_LOADED)):
+            store_opening_hours(self.geom_type, {self.osmid: self.tags}, using=self._state.db)
+            self._stored_opening_hours = opening_hours
+
+    def delete(self, using=None, keep_parents=False):
+        OpeningHoursInterval.objects.filter(geom_type=self.geom_type.name, osmid=self.osmid).delete()
+        return super().delete(using, keep_parents)
+
 
 class OsmPoint(OsmFeature):
     geom = models.PointField(srid=settings.SRID)
@@ -284,6 +589,24 @@ class OsmPolygon(OsmFeature):
     geom = models.MultiPolygonField(srid=settings.SRID)
 
 
+class OpeningHoursInterval(models.Model):
+    """
+    Weekly interval when a feature is open, parsed from its opening_hours tag when the feature is saved.
+    Minutes are counted from the midnight of Monday.
+    """
+    geom_type = models.CharField(max_length=10, choices=[(geom_type.name, geom_type.name) for geom_type in GeomType])
+    osmid = models.BigIntegerField()
+    start_minute = models.PositiveSmallIntegerField()
+    end_minute = models.PositiveSmallIntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=['geom_type', 'osmid', 'start_minute', 'end_minute'],
+                                name='datahub_opening_hours_idx')]
+
+    def __str__(self):
+        return f"{self.geom_type} {self.osmid}: {self.start_minute}-{self.end_minute}"
+
+
 class Basemap(models.Model):
     name = models.CharField(max_length=50)
     attribution = models.CharField(max_length=200, blank=True, null=True,
@@ -0,0 +1,150 @@
+import logging
+import re
+from typing import Dict, List, Tuple
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .utils import GeomType
+
+logger = logging.getLogger(__name__)
+
+DAYS = ['mo', 'tu', 'we', 'th', 'fr', 'sa', 'su']
+MINUTES_IN_DAY = 24 * 60
+MINUTES_IN_WEEK = 7 * MINUTES_IN_DAY
+OPENING_HOURS_TABLE = 'datahub_openinghoursinterval'
+
+# (start, end) in minutes since Monday midnight
+Interval = Tuple[int, int]
+
+_DAY_RANGE = re.compile(r'^(mo|tu|we|th|fr|sa|su)(?:-(mo|tu|we|th|fr|sa|su))?$')
+_TIME_RANGE = re.compile(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})\+?$')
+_SEPARATOR = re.compile(r'\s*-\s*')
+# Comma after a time range or "off" followed by a day selector, for example "Mo-Fr 08:00-16:00, Sa 10:00-14:00"
+_ADDITIONAL_RULE = re.compile(r'(?<=[\d+fd]),\s*(?=(?:mo|tu|we|th|fr|sa|su|ph|sh)[a-z,-]*\s)')
+_HOLIDAYS = {'ph', 'sh'}
+_CLOSED = {'off', 'closed'}
+
+
+class UnsupportedOpeningHours(ValueError):
+    pass
+
+
+def parse_opening_hours(value: str) -> List[Interval]:
+    """
+    Parses the common subset of OSM opening_hours syntax, for example "Mo-Fr 08:00-16:00; Sa 10:00-14:00; Su off".
+    Like in the full syntax, a later rule replaces the hours of the days it mentions. Rules with selectors
+    that are not supported, such as months or sunrise, are left out.
+    :param value: value of opening_hours tag
+    :return: sorted weekly intervals when the feature is open, empty if it is never open or cannot be parsed
+    """
+    hours: Dict[int, List[Interval]] = {}
+    for rule in re.split(r';|\|\|', value):
+        rule = _SEPARATOR.sub('-', rule.strip().lower())
+        if not rule:
+            continue
+        if rule == '24/7':
+            hours = {day: [(0, MINUTES_IN_DAY)] for day in range(7)}
+            continue
+        # Additional rules separated by commas add to the hours of the rule instead of replacing them
+        for i, additional_rule in enumerate(_ADDITIONAL_RULE.split(rule)):
+            try:
+                days, times = _parse_rule(additional_rule.strip())
+            except UnsupportedOpeningHours:
+                logger.debug(f"Unsupported opening_hours rule '{additional_rule}'")
+                continue
+            for day in days:
+                hours[day] = (hours.get(day, []) if i else []) + times
+
+    intervals = []
+    for day, times in hours.items():
+        for start, end in times:
+            # Intervals past midnight of Sunday continue on Monday
+            start, end = day * MINUTES_IN_DAY + start, day * MINUTES_IN_DAY + end
+            if end > MINUTES_IN_WEEK:
+                intervals.append((0, end - MINUTES_IN_WEEK))
+                end = MINUTES_IN_WEEK
+            intervals.append((start, end))
+    return _merge(intervals)
+
+
+def is_open_at(intervals: List[Interval], minute_of_week: int) -> bool:
+    return any(start <= minute_of_week < end for start, end in intervals)
+
+
+# noinspection SqlNoDataSourceInspection
+def store_opening_hours(geom_type: GeomType, tags_by_id: Dict[int, dict], using=DEFAULT_DB_ALIAS) -> int:
+    """
+    Replaces the opening hour intervals of the features with a couple of queries
+    :param geom_type: geometry type of the features
+    :param tags_by_id: current tags keyed by osm id
+    :param using: Database key
+    :return: number of stored intervals
+    """
+    if not len(tags_by_id):
+        return 0
+    table = OPENING_HOURS_TABLE
+    rows = [(osmid, start, end) for osmid, tags in tags_by_id.items() if tags.get('opening_hours')
+            for start, end in parse_opening_hours(tags['opening_hours'])]
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table} WHERE geom_type = %s AND osmid = ANY(%s::bigint[])',
+                       [geom_type.name, list(tags_by_id.keys())])
+        if rows:
+            cursor.execute(f'''
+                INSERT INTO {table} (geom_type, osmid, start_minute, end_minute)
+                SELECT %s, unnest(%s::bigint[]), unnest(%s::integer[]), unnest(%s::integer[])
+            ''', [geom_type.name, *map(list, zip(*rows))])
+    return len(rows)
+
+
+def _parse_rule(rule: str) -> Tuple[List[int], List[Interval]]:
+    parts = rule.split(None, 1)
+    if _is_day_selector(parts[0]):
+        days = _parse_days(parts[0])
+        times = parts[1].strip() if len(parts) > 1 else '00:00-24:00'
+    else:
+        days = list(range(7))
+        times = rule
+    if times in _CLOSED:
+        return days, []
+    return days, [_parse_time_range(time_range.strip()) for time_range in times.split(',')]
+
+
+def _is_day_selector(selector: str) -> bool:
+    return all(_DAY_RANGE.match(part) or part in _HOLIDAYS for part in selector.split(','))
+
+
+def _parse_days(selector: str) -> List[int]:
+    days = []
+    for part in selector.split(','):
+        if part in _HOLIDAYS:
+            # Public and school holidays are not known, so their hours are not used
+            continue
+        first, last = _DAY_RANGE.match(part).groups()
+        first, last = DAYS.index(first), DAYS.index(last or first)
+        # Ranges such as Su-Mo wrap over the end of the week
+        days += [day % 7 for day in range(first, last + 1 if last >= first else last + 8)]
+    return days
+
+
+def _parse_time_range(time_range: str) -> Interval:
+    match = _TIME_RANGE.match(time_range)
+    if match is None:
+        raise UnsupportedOpeningHours(time_range)
+    start_hour, start_minute, end_hour, end_minute = map(int, match.groups())
+    start, end = start_hour * 60 + start_minute, end_hour * 60 + end_minute
+    if start >= MINUTES_IN_DAY or end > 2 * MINUTES_IN_DAY:
+        raise UnsupportedOpeningHours(time_range)
+    if end <= start:
+        # Open past midnight
+        end += MINUTES_IN_DAY
+    return start, end
+
+
+def _merge(intervals: List[Interval]) -> List[Interval]:
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
@@ -0,0 +1,117 @@
+import datetime
+import logging
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+from billiard import Pool
+from django.db import connections
+from osgeo import ogr
+
+from .bulk import upsert_features
+from .locks import lock_pairs
+from .models import OsmLayer, OsmSyncState
+from .osm_loader import OsmLoader
+from .osm_reader import read_osm_features
+from .tag_matcher import compile_tags
+from .utils import GeomType
+
+logger = logging.getLogger(__name__)
+
+UPSERT_BATCH_SIZE = 50000
+
+# layer pk, layer tags, [(area pk, area extent as xmin, ymin, xmax, ymax)]
+LayerFilter = Tuple[int, Tuple[str], List[Tuple[int, Tuple[float, float, float, float]]]]
+# layer pk: area pk: geometry type: feature ids
+ImportedIds = Dict[int, Dict[int, Dict[GeomType, Set[int]]]]
+
+
+def import_osm_extract(path: str, processes: Optional[int] = None) -> Dict[int, int]:
+    """
+    Imports features of all OsmLayers from OSM extract, for example from Geofabrik .osm.pbf file, instead of
+    querying them from Overpass. The file is read once per GDAL OSM layer and the layers are processed in
+    parallel. Features are kept only if they intersect the bounding box of an area of the matching layer.
+    Layers are fully synchronized, so features missing from the extract are removed from the areas. Raises
+    LockNotAcquired if some layer and area is being loaded by a worker.
+    :param path: Path to the extract
+    :param processes: Number of worker processes. With 1 everything runs in the current process.
+    :return: number of features in each layer pk
+    """
+    if not os.path.isfile(path):
+        # Otherwise all the features would be removed as missing from the extract
+        raise FileNotFoundError(f"OSM extract {path} does not exist")
+
+    layers = [layer for layer in OsmLayer.objects.prefetch_related('areas') if layer.tags]
+    layer_filters = [(layer.pk, tuple(layer.tags), [(area.pk, area.bbox.extent) for area in layer.areas.all()])
+                     for layer in layers]
+    osm_layers = [osm_layer for geom_type in GeomType for osm_layer in geom_type.value['osm_layers']]
+    args = [(path, osm_layer, layer_filters) for osm_layer in osm_layers]
+    # Extract does not tell when its data was taken, but the data is not newer than the file
+    timestamp = datetime.datetime.fromtimestamp(os.path.getmtime(path), tz=datetime.timezone.utc)
+
+    counts = {}
+    with lock_pairs((layer.pk, area.pk) for layer in layers for area in layer.areas.all()):
+        processes = processes or min(len(osm_layers), os.cpu_count() or 1)
+        if processes == 1:
+            results = [_import_osm_layer(*arg) for arg in args]
+        else:
+            # Forked workers must not share the database connections of the parent
+            connections.close_all()
+            # billiard allows creating the pool also inside a daemonic Celery worker process
+            with Pool(processes) as pool:
+                results = pool.starmap(_import_osm_layer, args)
+
+        for layer in layers:
+            all_ids = set()
+            for area in layer.areas.all():
+                id_dict = GeomType.get_empty_dict()
+                for result in results:
+                    for geom_type, ids in result.get(layer.pk, {}).get(area.pk, {}).items():
+                        id_dict[geom_type].update(ids)
+                ids, new_ids = OsmLoader._synchronize_layer(layer, area, id_dict)
+                OsmSyncState.objects.get_or_create(layer=layer, area=area)[0].mark_synced(timestamp, full=True)
+                all_ids.update(ids)
+            logger.info(f"Imported layer '{layer}' from {path}: {len(all_ids)} features")
+            counts[layer.pk] = len(all_ids)
+    return counts
+
+
+def _import_osm_layer(path: str, osm_layer: str, layer_filters: List[LayerFilter]) -> ImportedIds:
+    """
+    Reads single GDAL OSM layer from the extract and upserts the features that belong to some layer and area
+    :return: ids of the features by layer and area
+    """
+    matchers = [(layer_id, compile_tags(tags), areas) for layer_id, tags, areas in layer_filters]
+    imported_ids: ImportedIds = {}
+    rows_dict = {geom_type: {} for geom_type in GeomType}
+    count = 0
+
+    for feature in read_osm_features(path, [osm_layer], custom_indexing=True):
+        extent = None
+        for layer_id, matches, areas in matchers:
+            if not matches(feature.tags):
+                continue
+            if extent is None:
+                # Envelope is only needed for the features that match a layer
+                extent = ogr.CreateGeometryFromWkb(feature.geom).GetEnvelope()
+            min_x, max_x, min_y, max_y = extent
+            for area_id, (area_min_x, area_min_y, area_max_x, area_max_y) in areas:
+                if min_x <= area_max_x and max_x >= area_min_x and min_y <= area_max_y and max_y >= area_min_y:
+                    (imported_ids.setdefault(layer_id, {}).setdefault(area_id, GeomType.get_empty_dict())
+                     [feature.geom_type].add(feature.osmid))
+                    rows_dict[feature.geom_type][feature.osmid] = OsmLoader._to_row(feature)
+
+        if sum(len(rows) for rows in rows_dict.values()) >= UPSERT_BATCH_SIZE:
+            count += _upsert(rows_dict)
+
+    count += _upsert(rows_dict)
+    logger.debug(f"Upserted {count} features from {osm_layer} of {path}")
+    return imported_ids
+
+
+def _upsert(rows_dict: Dict[GeomType, dict]) -> int:
+    count = 0
+    for geom_type, rows in rows_dict.items():
+        upsert_features(geom_type, rows)
+        count += len(rows)
+        rows.clear()
+    return count
@@ -1,190 +1,522 @@
+import asyncio
+import datetime
+import itertools
 import json
 import logging
 import os
+import re
 import tempfile
-from typing import Tuple, Set
+import uuid
+from typing import Tuple, Set, Iterable, Iterator, Optional, List
 
-import requests
+import aiohttp
 from django.conf import settings
-from django.contrib.gis.geos import GEOSGeometry
-from osgeo import gdal
-
-from .exeptions import TooManyRequests
-from .models import OsmLayer, AreaOfInterest
-from .utils import GeomType, osm_tags_to_dict, model_tag_to_overpass_tag
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .bbox_planner import Bbox, split_bbox, split_bbox_to_depth, estimate_split_depth
+from .bulk import FeatureRows, upsert_features, add_layer_membership, remove_layer_membership, write_feature_rows
+from .exeptions import QueryTooLarge
+from .metrics import FEATURES_INGESTED
+from .models import OsmLayer, AreaOfInterest, OsmSyncState
+from .overpass_cache import OverpassCache
+from .overpass_endpoints import EndpointPool
+from .overpass_fetcher import OverpassFetcher
+from .osm_reader import read_osm_xml_features, read_osm_features
+from .overpass_json import read_overpass_json_features
+from .spans import span
+from .tag_matcher import compile_tags
+from .utils import GeomType, OsmFeatureRecord, OutputFormat, model_tag_to_overpass_tag
 
 logger = logging.getLogger(__name__)
 
 
 class OsmLoader:
-    URL = f"{settings.OVERPASS_API_URL}/interpreter"
-    KILL_EXISTING_QUERIES_URL = f"{settings.OVERPASS_API_URL}/kill_my_queries"
     QUERY_TEMPLATE = '''
 // gather results
-[out:xml][timeout:{timeout}];
+[out:{output_format}][timeout:{timeout}];
 (
     // query parts
     {query_parts}
 );
 // print results
-(._;>;);out body;
+{print_statement}
     '''
 
+    PRINT_STATEMENTS = {
+        # GDAL needs the referenced nodes and ways to build the geometries
+        OutputFormat.XML: '(._;>;);out body;',
+        # Geometries are inlined to the elements
+        OutputFormat.JSON: 'out geom;',
+    }
+
     QUERY_PART_TEMPLATE = '''
     // query part for: {tag}
-    node[{tag}]{bbox};
-    way[{tag}]{bbox};
-    relation[{tag}]{bbox};
+    node[{tag}]{newer}{bbox};
+    way[{tag}]{newer}{bbox};
+    relation[{tag}]{newer}{bbox};
     '''
 
-    def __init__(self, timeout: int = 900):
+    NEWER_FILTER_TEMPLATE = '(newer:"{timestamp}")'
+    OSM_BASE_PATTERN = re.compile(rb'osm_base"?\s*[:=]\s*"([^"]+)"')
+
+    COUNT_PRINT_STATEMENT = 'out count;'
+    # Overpass reports these as a remark at the end of otherwise successful response
+    RUNTIME_ERROR_PATTERN = re.compile(rb'runtime error:[^<"]*(timed out|out of memory)')
+
+    CHUNK_SIZE = 1024 * 1024
+    CONNECT_TIMEOUT = 30
+
+    def __init__(self, timeout: int = 900, gzip: bool = True, output_format: OutputFormat = OutputFormat.XML,
+                 max_split_depth: int = 3, max_elements_per_query: Optional[int] = None, use_cache: bool = True,
+                 bypass_cache: bool = False, max_concurrency: Optional[int] = None):
         """
 
         :param timeout: Timeout for the query execution
+        :param gzip: Whether to ask Overpass to compress the response
+        :param output_format: Overpass output format. With JSON the geometries are built without GDAL.
+        :param max_split_depth: How many times the bbox can be split to quadrants if the query is too large
+        :param max_elements_per_query: If given, the number of elements is estimated with out count before the
+        query and the bbox is split up front so that each query contains roughly at most this many elements
+        :param use_cache: Whether to use the response cache configured in settings
+        :param bypass_cache: Whether to skip reading from the cache. Responses are still written to the cache.
+        :param max_concurrency: Maximum number of simultaneous queries, defaults to
+        settings.OVERPASS_MAX_CONCURRENT_QUERIES. The slots available on the server limit it further.
         """
         self.timeout = timeout
+        self.gzip = gzip
+        self.output_format = output_format
+        self.max_split_depth = max_split_depth
+        self.max_elements_per_query = max_elements_per_query
+        self.cache = OverpassCache.from_settings() if use_cache else None
+        self.bypass_cache = bypass_cache
+        self.max_concurrency = max_concurrency or settings.OVERPASS_MAX_CONCURRENT_QUERIES
+        self._fetcher: Optional[OverpassFetcher] = None
+
+    def populate(self, layer: OsmLayer, area: AreaOfInterest, incremental: bool = False) -> bool:
+        """
+        Populate models with features found by layer tags. Runs fetch, parse and synchronize stages in a row.
+        :param layer: OsmLayer object
+        :param area: AreaOfInterest object from layer
+        :param incremental: Whether to fetch only the objects changed since the last synchronization. Deleted
+        objects are not in the changes, so they are removed only by the full synchronization that is done anyway
+        if the layer has not been synchronized in full in settings.OSM_FULL_SYNC_INTERVAL_HOURS.
+        :return: Whether any features were populated or not
+        """
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            fetched = self.fetch(layer, area, tmpdirname, incremental)
+            if fetched is None:
+                return False
+            with span('translate') as s:
+                rows_dict = self._collect_rows(self._read_features_from_files(fetched['files']))
+                s.set(rows=sum(len(rows) for rows in rows_dict.values()))
+
+        return self.synchronize(layer, area, rows_dict, fetched)
+
+    def fetch(self, layer: OsmLayer, area: AreaOfInterest, dir_path: str, incremental: bool = False) -> Optional[dict]:
+        """
+        Fetch stage of the population. Downloads the features of the layer to files without parsing them.
+        :param layer: OsmLayer object
+        :param area: AreaOfInterest object from layer
+        :param dir_path: directory to download the files to
+        :param incremental: Whether to fetch only the objects changed since the last synchronization
+        :return: json serializable fetch result or None if there is nothing to synchronize
+        """
+        if not layer.tags:
+            logger.debug("No tags available, skipping...")
+            return None
+
+        since = None
+        if incremental:
+            since = OsmSyncState.objects.get_or_create(layer=layer, area=area)[0].get_changes_since()
+
+        started = timezone.now()
+        with span('fetch', incremental=since is not None) as s:
+            file_paths = self._try_fetch(layer.tags, area, dir_path, since)
+            if file_paths is None:
+                return None
+            s.set(files=len(file_paths), bytes=sum(os.path.getsize(path) for path in file_paths))
+
+        osm_base = min(filter(None, map(self._read_osm_base, file_paths)), default=None)
+        return {
+            'files': file_paths,
+            'format': self.output_format.value,
+            'incremental': incremental,
+            'since': since.isoformat() if since is not None else None,
+            'timestamp': (osm_base or started).isoformat(),
+        }
+
+    def parse(self, file_paths: List[str], parsed_path: str) -> int:
+        """
+        Parse stage of the population. Reads the features of the fetched files and writes them as rows
+        that can be synchronized without GDAL.
+        :param file_paths: paths of the fetched files
+        :param parsed_path: path of the file to write the rows to
+        :return: number of rows
+        """
+        with span('translate') as s:
+            rows_dict = self._collect_rows(self._read_features_from_files(file_paths))
+            write_feature_rows(parsed_path, rows_dict)
+            count = sum(len(rows) for rows in rows_dict.values())
+            s.set(rows=count)
+        return count
 
-    def populate(self, layer: OsmLayer, area: AreaOfInterest) -> bool:
+    @staticmethod
+    def synchronize(layer: OsmLayer, area: AreaOfInterest, rows_dict: {GeomType: FeatureRows},
+                    fetched: dict) -> bool:
         """
-        Populate models with features found by layer tags
+        Synchronize stage of the population. Saves the rows and updates the synchronization state.
         :param layer: OsmLayer object
         :param area: AreaOfInterest object from layer
+        :param rows_dict: feature rows by geometry type
+        :param fetched: result of the fetch stage
         :return: Whether any features were populated or not
         """
+        since = parse_datetime(fetched['since']) if fetched['since'] else None
+        with span('sync', incremental=since is not None) as s:
+            # Changes are applied on top of the existing features, full synchronization removes the missing ones
+            ids, new_ids = OsmLoader._synchronize_rows(layer, area, rows_dict, remove_missing=since is None)
+
+            # Scheduler needs the state also when the changes are not fetched incrementally
+            state = OsmSyncState.objects.get_or_create(layer=layer, area=area)[0]
+            state.mark_synced(parse_datetime(fetched['timestamp']), full=since is None, changed=len(ids))
+            s.set(rows=len(ids), created=len(new_ids))
+
+        sync_type = "changed" if since is not None else "all"
+        logger.info(f"Processed layer '{layer}' ({sync_type}): {len(ids)} features. {len(new_ids)} new features.")
+        return len(ids) > 0
+
+    def populate_area(self, area: AreaOfInterest, layers: Iterable[OsmLayer]) -> {int: bool}:
+        """
+        Populate models for all layers of the area with a single query. Query contains the union of the
+        layer tags and features are assigned to layers locally by matching the layer tags.
+        :param area: AreaOfInterest object
+        :param layers: OsmLayer objects of the area
+        :return: Whether any features were populated or not for each layer pk
+        """
+        layers = [layer for layer in layers if layer.tags]
+        tags = sorted({tag for layer in layers for tag in layer.tags})
+        if not len(tags):
+            logger.debug("No tags available, skipping...")
+            return {}
+
+        matchers = [(layer, compile_tags(layer.tags)) for layer in layers]
+        layer_ids_dict = {layer.pk: GeomType.get_empty_dict() for layer in layers}
+        rows_dict = {geom_type: {} for geom_type in GeomType}
+
+        started = timezone.now()
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            with span('fetch', layers=len(layers)) as s:
+                file_paths = self._try_fetch(tags, area, tmpdirname)
+                if file_paths is None:
+                    return {layer.pk: False for layer in layers}
+                s.set(files=len(file_paths), bytes=sum(os.path.getsize(path) for path in file_paths))
+            timestamp = min(filter(None, map(self._read_osm_base, file_paths)), default=None) or started
+
+            with span('translate') as s:
+                for feature in self._read_features_from_files(file_paths):
+                    matching_layers = [layer for layer, matches in matchers if matches(feature.tags)]
+                    if not len(matching_layers):
+                        # Referenced nodes and ways that do not match any layer by themselves
+                        continue
+                    rows_dict[feature.geom_type][feature.osmid] = self._to_row(feature)
+                    for layer in matching_layers:
+                        layer_ids_dict[layer.pk][feature.geom_type].add(feature.osmid)
+                s.set(rows=sum(len(rows) for rows in rows_dict.values()))
+
+        # Upserts are shared by the layers, spans of each layer have the layer attribute
+        updated_dict = GeomType.get_empty_dict()
+        for geom_type, rows in rows_dict.items():
+            with span('upsert', geom_type=geom_type.name) as s:
+                created_ids, updated_dict[geom_type] = upsert_features(geom_type, rows)
+                s.set(rows=len(rows), created=len(created_ids), updated=len(updated_dict[geom_type]))
+
+        results = {}
+        for layer in layers:
+            with span('sync', layer=layer.pk) as s:
+                ids, new_ids = self._synchronize_layer(layer, area, layer_ids_dict[layer.pk])
+                OsmSyncState.objects.get_or_create(layer=layer, area=area)[0].mark_synced(timestamp, full=True)
+                s.set(rows=len(ids), created=len(new_ids))
+            logger.info(f"Processed layer '{layer}' in area '{area}': {len(ids)} features. "
+                        f"{len(new_ids)} new features.")
+            results[layer.pk] = len(ids) > 0
+        self._refresh_sharing_layers(updated_dict, [layer.pk for layer in layers])
+        return results
+
+    @staticmethod
+    def reclassify(layer: OsmLayer) -> Tuple[Set, Set]:
+        """
+        Evaluates layer tags against the features already stored in the areas of the layer and updates
+        the layer relations accordingly without querying Overpass
+        :param layer: OsmLayer object
+        :return: all ids and new ids as sets
+        """
+        matches = compile_tags(layer.tags)
+        all_ids = set()
+        new_ids = set()
+        for area in layer.areas.all():
+            bbox = area.bbox.envelope
+            id_dict = {
+                geom_type: {osmid for osmid, tags in (geom_type.osm_model.objects.filter(geom__intersects=bbox)
+                                                      .values_list('osmid', 'tags').iterator()) if matches(tags)}
+                for geom_type in GeomType
+            }
+            ids, area_new_ids = OsmLoader._synchronize_layer(layer, area, id_dict)
+            all_ids = all_ids.union(ids)
+            new_ids = new_ids.union(area_new_ids)
+
+        logger.info(f"Reclassified layer '{layer}': {len(all_ids)} features. {len(new_ids)} new features.")
+        return all_ids, new_ids
+
+    def _build_query(self, tags: [str], bbox: Bbox, since: Optional[datetime.datetime] = None,
+                     count_only: bool = False) -> Optional[str]:
+        with span('build_query', count_only=count_only) as s:
+            query = self._format_query(tags, bbox, since, count_only)
+            s.set(tags=len(tags or []), size=len(query or ''))
+        logger.debug(query)
+        return query
+
+    def _format_query(self, tags: [str], bbox: Bbox, since: Optional[datetime.datetime],
+                      count_only: bool) -> Optional[str]:
+        newer = ''
+        if since is not None:
+            newer = self.NEWER_FILTER_TEMPLATE.format(
+                timestamp=since.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
 
         query_parts = [self.QUERY_PART_TEMPLATE.format(
             tag=model_tag_to_overpass_tag(tag),
-            bbox=area.overpass_bbox
+            newer=newer,
+            bbox=tuple(bbox)
         )
-            for tag in layer.tags]
+            for tag in tags or []]
         if not len(query_parts):
-            logger.debug("No tags available, skipping...")
-            return False
+            return None
 
-        query = self.QUERY_TEMPLATE.format(
+        output_format = OutputFormat.JSON if count_only else self.output_format
+        return self.QUERY_TEMPLATE.format(
             query_parts='\n'.join(query_parts),
-            timeout=self.timeout
+            timeout=self.timeout,
+            output_format=output_format.value,
+            print_statement=self.COUNT_PRINT_STATEMENT if count_only else self.PRINT_STATEMENTS[output_format]
         )
-        logger.debug(query)
 
-        r = requests.get(self.URL, params={'data': query})
+    def _try_fetch(self, tags: [str], area: AreaOfInterest, dir_path: str,
+                   since: Optional[datetime.datetime] = None) -> Optional[List[str]]:
+        """
+        Fetches the features of the area to files. Area is split into smaller bounding boxes if the query is
+        too large for Overpass.
+        :return: paths of the fetched files or None if the query failed
+        """
+        pool = EndpointPool.from_settings()
         try:
-            if r.status_code == 429:
-                # Too many requests, killing existing with instructions
-                # from http://overpass-api.de/command_line.html and retrying using Celery
-                logger.warning(f"Too many requests foor {layer}:{area}, killing existing and retrying...")
-                requests.get(self.KILL_EXISTING_QUERIES_URL)
-                raise TooManyRequests()
-
-            r.raise_for_status()
-            features = self._overpass_xml_to_geojson_features(r.text)
-        except requests.HTTPError:
+            return asyncio.run(self._fetch_area(tags, area.overpass_bbox, dir_path, since, pool))
+        except aiohttp.ClientResponseError as e:
             logger.exception(
-                f"Query failed for following area: '{area}'. Query: {query} \n Headers: {r.headers} \n Skpping...")
-            return False
-
-        ids, new_ids = self._synchronize_features(layer, area, features)
-
-        logger.info(f"Processed layer '{layer}': {len(ids)} features. {len(new_ids)} new features.")
-        return len(ids) > 0
+                f"Query failed for following area: '{area}'. Tags: {tags} \n "
+                f"Headers: {e.headers} \n Skpping...")
+        except aiohttp.ClientError:
+            logger.exception(f"Could not connect to any Overpass endpoint. Skipping area '{area}'...")
+        except QueryTooLarge:
+            logger.exception(f"Query is too large even after splitting the area '{area}'. Skipping...")
+        finally:
+            pool.save()
+        return None
+
+    async def _fetch_area(self, tags: [str], bbox: Bbox, dir_path: str, since: Optional[datetime.datetime],
+                          pool: EndpointPool) -> List[str]:
+        async with OverpassFetcher(pool, self.timeout, self.CONNECT_TIMEOUT, self.gzip, self.CHUNK_SIZE,
+                                   self.max_concurrency) as fetcher:
+            self._fetcher = fetcher
+            try:
+                depth = await self._estimate_split_depth(tags, bbox, dir_path, since)
+                return await self._gather_paths(self._fetch_bbox(tags, tile, dir_path, since, depth)
+                                                for tile in split_bbox_to_depth(bbox, depth))
+            finally:
+                self._fetcher = None
+
+    async def _fetch_bbox(self, tags: [str], bbox: Bbox, dir_path: str, since: Optional[datetime.datetime],
+                          depth: int) -> List[str]:
+        file_path = os.path.join(dir_path, f"data_{uuid.uuid4().hex}.{self.output_format.value}")
+        try:
+            await self._download(self._build_query(tags, bbox, since), file_path)
+            return [file_path]
+        except QueryTooLarge:
+            if depth >= self.max_split_depth:
+                raise
+            logger.warning(f"Query for bbox {bbox} is too large, splitting it to quadrants...")
+            return await self._gather_paths(self._fetch_bbox(tags, quadrant, dir_path, since, depth + 1)
+                                            for quadrant in split_bbox(bbox))
 
     @staticmethod
-    def _overpass_xml_to_geojson_features(xml_data: str) -> []:
+    async def _gather_paths(coroutines: Iterable) -> List[str]:
+        # Tiles are fetched concurrently, the fetcher limits how many of them actually run at once
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return [path for paths in results for path in paths]
+
+    async def _estimate_split_depth(self, tags: [str], bbox: Bbox, dir_path: str,
+                                    since: Optional[datetime.datetime]) -> int:
+        if self.max_elements_per_query is None:
+            return 0
+        file_path = os.path.join(dir_path, "count.json")
+        await self._download(self._build_query(tags, bbox, since, count_only=True), file_path)
+        with open(file_path) as f:
+            counts = json.load(f)['elements'][0]['tags']
+        depth = estimate_split_depth(int(counts['total']), self.max_elements_per_query, self.max_split_depth)
+        logger.debug(f"Estimated {counts['total']} elements, splitting bbox {bbox} to depth {depth}")
+        return depth
+
+    async def _download(self, query: str, file_path: str) -> int:
         """
-        Converts Overpass xml to geojson features
-        :param xml_data: Overpass XML
-        :return: list of features
+        Streams the query response to a file in chunks so that the whole response is never held in memory
+        :param query: Overpass query
+        :param file_path: path of the file to write to
+        :return: number of bytes written
         """
+        key = self.cache.get_key(query) if self.cache is not None else None
+        if key is not None and not self.bypass_cache and self.cache.get(key, file_path):
+            size = os.path.getsize(file_path)
+            with span('cache_hit', trace_memory=False, bytes=size):
+                return size
 
-        ogr2ogr_params = [
-            "-a_srs", f"EPSG:4326",
-        ]
+        # Tiles are downloaded concurrently, so memory of a single download cannot be told apart
+        with span('http', trace_memory=False) as s:
+            size = await self._fetcher.download(query, file_path)
+            s.set(bytes=size)
 
-        ogr2ogr_multi_params = ogr2ogr_params + ["-nlt", "PROMOTE_TO_MULTI"]
+        with open(file_path, 'rb') as f:
+            f.seek(max(0, size - 4096))
+            if self.RUNTIME_ERROR_PATTERN.search(f.read()):
+                raise QueryTooLarge()
 
-        gdal.SetConfigOption('OSM_CONFIG_FILE', settings.OSM_CONFIG)
-        gdal.SetConfigOption('OSM_USE_CUSTOM_INDEXING', 'NO')
+        if key is not None:
+            self.cache.put(key, file_path)
 
-        features = []
+        logger.debug(f"Downloaded {size} bytes")
+        return size
 
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            xml_fil_path = os.path.join(tmpdirname, "data.osm")
-            with open(xml_fil_path, "w") as f:
-                f.write(xml_data)
-
-            for geom_type in list(GeomType):
-                layers = geom_type.value['osm_layers']
-                for layer in layers:
-                    params = ogr2ogr_params if geom_type == GeomType.POINT else ogr2ogr_multi_params
-
-                    layer_fil = os.path.join(tmpdirname, f"layer.json")
-                    try:
-                        gdal.VectorTranslate(
-                            layer_fil, xml_fil_path,
-                            options=f'{layer} -f GeoJSON ' + ' '.join(params)
-                        )
-                        with open(layer_fil) as f:
-                            geojson = json.load(f)
-                            features += geojson["features"]
-                    except RuntimeError:
-                        logger.exception("Could not translate OSM file to geojson. Skipping...")
-
-        return features
+    @staticmethod
+    def _read_osm_base(file_path: str) -> Optional[datetime.datetime]:
+        """
+        Reads the timestamp of the OSM data from the beginning of Overpass xml or json response
+        :param file_path: path of the response
+        :return: timestamp or None if not found
+        """
+        with open(file_path, 'rb') as f:
+            match = OsmLoader.OSM_BASE_PATTERN.search(f.read(4096))
+        return parse_datetime(match.group(1).decode()) if match else None
+
+    def _read_features_from_files(self, file_paths: List[str]) -> Iterator[OsmFeatureRecord]:
+        # Features crossing bbox borders are in multiple files. They are deduplicated by id when synchronizing.
+        return itertools.chain.from_iterable(self._read_features_from_file(path) for path in file_paths)
+
+    def _read_features_from_file(self, file_path: str) -> Iterator[OsmFeatureRecord]:
+        if self.output_format == OutputFormat.JSON:
+            return read_overpass_json_features(file_path)
+        return read_osm_features(file_path)
 
     @staticmethod
-    def _synchronize_features(layer: OsmLayer, area: AreaOfInterest, features: list) -> Tuple[Set, Set]:
+    def _read_features(xml_data: str) -> Iterator[OsmFeatureRecord]:
+        """
+        Reads features from Overpass xml
+        :param xml_data: Overpass XML
+        :return: generator of features
         """
-        Save Geojson features as model objects and removes layer from features that do not belong to it anymore
+        return read_osm_xml_features(xml_data)
+
+    @staticmethod
+    def _synchronize_features(layer: OsmLayer, area: AreaOfInterest, features: Iterable[OsmFeatureRecord],
+                              remove_missing: bool = True) -> Tuple[Set, Set]:
+        """
+        Save features as model objects and removes layer from features that do not belong to it anymore.
+        Features are upserted in batches per geometry type instead of one object at a time.
         :param layer: OsmLayer object
         :params area: AreaOfInterest object
-        :param features: in Geojson format
+        :param features: OsmFeatureRecords, for example from a generator
+        :param remove_missing: Whether to remove layer from existing features that are not in features
         :return: all ids and new ids as sets
         """
-        existing_ids_dict = layer.get_related(area)
+        return OsmLoader._synchronize_rows(layer, area, OsmLoader._collect_rows(features), remove_missing)
 
-        id_dict = GeomType.get_empty_dict()
+    @staticmethod
+    def _collect_rows(features: Iterable[OsmFeatureRecord]) -> {GeomType: FeatureRows}:
+        rows_dict = {geom_type: {} for geom_type in GeomType}
         for feature in features:
-            props = feature['properties']
-            # if osm_way_id is present, it represents that the geometry is closed way instead of relation
-            osmid = int(props.get('osm_id', props.get('osm_way_id')))
-            geom = GEOSGeometry(str(feature['geometry']), srid=settings.SRID)
-            tags = osm_tags_to_dict(props["all_tags"])
-            geom_type = GeomType.from_feature(feature)
+            # Later duplicates win as they did with update_or_create
+            rows_dict[feature.geom_type][feature.osmid] = OsmLoader._to_row(feature)
+        return rows_dict
 
-            values = {'tags': tags, 'geom': geom}
-            if geom_type == GeomType.LINE:
-                values["z_order"] = props.get("z_order", 0)
-
-            obj, created = geom_type.osm_model.objects.update_or_create(pk=osmid, defaults=values)
-            id_dict[geom_type].add(osmid)
+    @staticmethod
+    def _synchronize_rows(layer: OsmLayer, area: AreaOfInterest, rows_dict: {GeomType: FeatureRows},
+                          remove_missing: bool = True) -> Tuple[Set, Set]:
+        updated_dict = GeomType.get_empty_dict()
+        for geom_type, rows in rows_dict.items():
+            with span('upsert', geom_type=geom_type.name) as s:
+                created_ids, updated_dict[geom_type] = upsert_features(geom_type, rows)
+                s.set(rows=len(rows), created=len(created_ids), updated=len(updated_dict[geom_type]))
+            if len(created_ids):
+                logger.debug(f"{len(created_ids)} new {geom_type.name} features created")
+
+        result = OsmLoader._synchronize_layer(
+            layer, area, {geom_type: set(rows.keys()) for geom_type, rows in rows_dict.items()}, remove_missing)
+        OsmLoader._refresh_sharing_layers(updated_dict, [layer.pk])
+        return result
 
-            if created:
-                logger.debug(f"New {geom_type.name} created: {osmid}")
+    @staticmethod
+    def _refresh_sharing_layers(updated_dict: {GeomType: set}, synchronized_layer_ids: List[int]) -> None:
+        # Views of the synchronized layers were refreshed already, new features are not in the other layers yet
+        with span('view_refresh'):
+            OsmLayer.refresh_views_of_features(updated_dict, exclude=synchronized_layer_ids)
 
-            if layer not in obj.layers.all():
-                obj.layers.add(layer)
-                obj.save()
+    @staticmethod
+    def _synchronize_layer(layer: OsmLayer, area: AreaOfInterest, id_dict: {GeomType: set},
+                           remove_missing: bool = True) -> Tuple[Set, Set]:
+        """
+        Synchronizes layer relations of already saved features and removes layer from features of the area that
+        do not belong to it anymore
+        :param layer: OsmLayer object
+        :params area: AreaOfInterest object
+        :param id_dict: ids of the features that belong to the layer by geometry type
+        :param remove_missing: Whether to remove layer from existing features that are not in id_dict
+        :return: all ids and new ids as sets
+        """
+        existing_ids_dict = layer.get_related(area)
 
         all_ids = set()
-        new_ids = set
+        new_ids = set()
 
         for geom_type, ids in id_dict.items():
             existing_ids = existing_ids_dict[geom_type]
-            old_ids = existing_ids.difference(ids)
+            old_ids = existing_ids.difference(ids) if remove_missing else set()
             all_ids = all_ids.union(ids)
             new_ids = new_ids.union(ids.difference(existing_ids))
 
-            if len(old_ids):
-                # Remove layer from features that do not belong to it anymore
-                # There might have been tag changes that cause otherwise existing feature
-                # to not appear in the query
-                for feat in geom_type.osm_model.objects.filter(pk__in=old_ids):
-                    feat.remove_from_layer(layer)
-
-            if len(ids):
-                # Create views
-                layer.add_support_for_type(geom_type)
-            else:
-                layer.remove_support_from_type(geom_type)
-
+            with span('membership', geom_type=geom_type.name, rows=len(ids), removed=len(old_ids)):
+                # Layer relations are kept in sync with a constant number of queries
+                add_layer_membership(geom_type, layer.pk, ids)
+                if len(old_ids):
+                    # Remove layer from features that do not belong to it anymore
+                    # There might have been tag changes that cause otherwise existing feature
+                    # to not appear in the query
+                    remove_layer_membership(geom_type, layer.pk, old_ids)
+            FEATURES_INGESTED.labels(layer=layer.name, geom_type=geom_type.name).inc(len(ids))
+
+            with span('view_ddl', geom_type=geom_type.name):
+                if len(ids):
+                    # Create views
+                    layer.add_support_for_type(geom_type)
+                elif remove_missing:
+                    layer.remove_support_from_type(geom_type)
+
+        with span('statistics'):
+            layer.update_statistics()
         return all_ids, new_ids
+
+    @staticmethod
+    def _to_row(feature: OsmFeatureRecord) -> Tuple[dict, str, Optional[int]]:
+        return feature.tags, feature.geom.hex(), feature.z_order
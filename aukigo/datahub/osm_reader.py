@@ -0,0 +1,89 @@
+import logging
+import uuid
+from typing import Iterable, Iterator, Optional
+
+from django.conf import settings
+from osgeo import gdal, ogr
+
+from .utils import GeomType, OsmFeatureRecord, osm_tags_to_dict
+
+logger = logging.getLogger(__name__)
+
+
+def read_osm_xml_features(xml_data: str) -> Iterator[OsmFeatureRecord]:
+    """
+    Reads features from Overpass xml without writing it to disk
+    :param xml_data: Overpass XML
+    :return: generator of features
+    """
+    path = f"/vsimem/{uuid.uuid4().hex}.osm"
+    gdal.FileFromMemBuffer(path, xml_data.encode())
+    try:
+        yield from read_osm_features(path)
+    finally:
+        gdal.Unlink(path)
+
+
+def read_osm_features(path: str, osm_layers: Optional[Iterable[str]] = None,
+                      custom_indexing: bool = False) -> Iterator[OsmFeatureRecord]:
+    """
+    Reads features from OSM file (xml or pbf) with GDAL OSM driver in a single pass
+    :param path: Path to the file, can also be a GDAL virtual file system path
+    :param osm_layers: Names of the GDAL OSM layers to build, defaults to all of them
+    :param custom_indexing: Whether to use the custom node index of GDAL, which is faster for large extracts
+    :return: generator of features
+    """
+    gdal.SetConfigOption('OSM_CONFIG_FILE', settings.OSM_CONFIG)
+    gdal.SetConfigOption('OSM_USE_CUSTOM_INDEXING', 'YES' if custom_indexing else 'NO')
+
+    ds = gdal.OpenEx(path, gdal.OF_VECTOR, allowed_drivers=['OSM'])
+    if ds is None:
+        logger.error(f"Could not open OSM file {path}. Skipping...")
+        return
+    if osm_layers is not None:
+        # Geometries of the other layers are not assembled at all
+        ds.ExecuteSQL(f"SET interest_layers = {','.join(osm_layers)}")
+
+    geom_types = {osm_layer: geom_type for geom_type in GeomType for osm_layer in geom_type.value['osm_layers']}
+    while True:
+        # Dataset level iteration reads interleaved layers without parsing the file again for each layer
+        feature, layer = ds.GetNextFeature()
+        if feature is None:
+            break
+        geom_type = geom_types.get(layer.GetName())
+        if geom_type is None:
+            continue
+
+        record = _to_record(feature, geom_type)
+        if record is not None:
+            yield record
+
+
+def _to_record(feature: ogr.Feature, geom_type: GeomType) -> Optional[OsmFeatureRecord]:
+    geom: ogr.Geometry = feature.GetGeometryRef()
+    if geom is None:
+        return None
+    if geom_type == GeomType.LINE:
+        geom = ogr.ForceToMultiLineString(geom)
+    elif geom_type == GeomType.POLYGON:
+        geom = ogr.ForceToMultiPolygon(geom)
+
+    # if osm_way_id is present, it represents that the geometry is closed way instead of relation
+    osmid = feature.GetField('osm_id')
+    if osmid is None:
+        osmid = feature.GetField('osm_way_id')
+
+    all_tags = feature.GetField('all_tags')
+    z_order = None
+    if geom_type == GeomType.LINE:
+        # Only the lines layer has computed z_order, multilinestrings default to zero
+        has_z_order = feature.GetFieldIndex('z_order') >= 0
+        z_order = (feature.GetField('z_order') if has_z_order else None) or 0
+
+    return OsmFeatureRecord(
+        osmid=int(osmid),
+        geom_type=geom_type,
+        geom=bytes(geom.ExportToWkb()),
+        tags=osm_tags_to_dict(all_tags) if all_tags else {},
+        z_order=z_order
+    )
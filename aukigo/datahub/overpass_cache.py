@@ -0,0 +1,130 @@
+import gzip
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from typing import Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Only whole line comments, // can also appear inside quoted values such as urls
+COMMENT_PATTERN = re.compile(r'^\s*//.*$', re.MULTILINE)
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+class OverpassCache:
+    """
+    Content addressed on-disk cache for Overpass responses. Responses are stored gzip compressed and keyed by
+    the hash of the normalized query, which contains the bounding box. Entries expire after ttl seconds and
+    the least recently used entries are evicted when the cache grows over max_bytes.
+    """
+
+    SUFFIX = '.gz'
+
+    def __init__(self, directory: str, ttl: int, max_bytes: int):
+        """
+
+        :param directory: Cache directory, created if it does not exist
+        :param ttl: Time to live of the entries in seconds
+        :param max_bytes: Maximum size of the compressed entries in bytes
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def from_settings() -> Optional['OverpassCache']:
+        if not settings.OVERPASS_CACHE_ENABLED:
+            return None
+        return OverpassCache(settings.OVERPASS_CACHE_DIR, settings.OVERPASS_CACHE_TTL_SECONDS,
+                             settings.OVERPASS_CACHE_MAX_BYTES)
+
+    @staticmethod
+    def get_key(query: str) -> str:
+        """
+        :param query: Overpass query
+        :return: hash of the query without comments and extra whitespace
+        """
+        normalized = WHITESPACE_PATTERN.sub(' ', COMMENT_PATTERN.sub('', query)).strip()
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    def get(self, key: str, file_path: str) -> bool:
+        """
+        Decompresses cached response to the file
+        :param key: cache key
+        :param file_path: path of the file to write to
+        :return: whether the response was found in the cache
+        """
+        entry_path = self._get_entry_path(key)
+        try:
+            created = os.path.getmtime(entry_path)
+            if time.time() - created > self.ttl:
+                logger.debug(f"Cache entry {key} has expired")
+                os.remove(entry_path)
+                return False
+            with gzip.open(entry_path, 'rb') as src, open(file_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            # Access time is used for LRU eviction, modification time for expiration
+            os.utime(entry_path, (time.time(), created))
+        except FileNotFoundError:
+            return False
+
+        logger.debug(f"Cache hit for {key}")
+        return True
+
+    def put(self, key: str, file_path: str) -> None:
+        """
+        Compresses the response file to the cache
+        :param key: cache key
+        :param file_path: path of the response
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with open(file_path, 'rb') as src, os.fdopen(fd, 'wb') as raw, \
+                    gzip.GzipFile(fileobj=raw, mode='wb') as dst:
+                shutil.copyfileobj(src, dst)
+            # Atomic so that concurrent workers never see a partial entry
+            os.replace(tmp_path, self._get_entry_path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes expired entries and the least recently used entries that do not fit into max_bytes
+        """
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(self.SUFFIX):
+                continue
+            stat = entry.stat()
+            if now - stat.st_mtime > self.ttl:
+                self._remove(entry.path)
+            else:
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _get_entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+            logger.debug(f"Evicted {path} from the cache")
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,134 @@
+import datetime
+import logging
+import random
+from typing import Iterable, List, Optional
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OverpassEndpoint
+
+logger = logging.getLogger(__name__)
+
+LATENCY_SMOOTHING = 0.3
+MIN_LATENCY = 0.1
+
+
+class Endpoint:
+    """
+    Health of an Overpass endpoint during a loader run. Changes are kept in memory, so that they can be
+    recorded from the event loop, and saved to the OverpassEndpoint afterwards.
+    """
+
+    def __init__(self, model: OverpassEndpoint):
+        self.model = model
+        self.url = model.url.rstrip('/')
+        self.interpreter_url = f"{self.url}/interpreter"
+        self.status_url = f"{self.url}/status"
+        self.latency = model.latency
+        self.consecutive_failures = model.consecutive_failures
+        self.circuit_open_until = model.circuit_open_until
+        self.last_error = model.last_error
+        self.last_success = model.last_success
+        self.requests = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.rate_limited = 0
+
+    def is_available(self, now: datetime.datetime) -> bool:
+        # Circuit is half open after the time has passed, a single success closes it
+        return self.circuit_open_until is None or self.circuit_open_until <= now
+
+    def record_success(self, latency: float) -> None:
+        self.requests += 1
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * self.latency
+        self.consecutive_failures = 0
+        self.circuit_open_until = None
+        self.last_success = timezone.now()
+
+    def record_failure(self, error: str, timeout: bool = False) -> None:
+        self.requests += 1
+        self.failures += 1
+        self.timeouts += int(timeout)
+        self.consecutive_failures += 1
+        self.last_error = error[:500]
+        if self.consecutive_failures >= settings.OVERPASS_CIRCUIT_BREAKER_THRESHOLD:
+            self.circuit_open_until = timezone.now() + datetime.timedelta(
+                seconds=settings.OVERPASS_CIRCUIT_BREAKER_SECONDS)
+            logger.warning(f"Overpass endpoint {self.url} failed {self.consecutive_failures} times in a row, "
+                           f"not using it until {self.circuit_open_until}")
+
+    def record_query_too_large(self) -> None:
+        # Query ran out of time or memory on the server, which says nothing about the health of the endpoint
+        self.requests += 1
+        self.timeouts += 1
+
+    def record_rate_limited(self) -> None:
+        self.requests += 1
+        self.rate_limited += 1
+
+    def save(self) -> None:
+        OverpassEndpoint.objects.filter(pk=self.model.pk).update(
+            # Counters are incremented in the database as several workers may use the same endpoint
+            request_count=F('request_count') + self.requests,
+            failure_count=F('failure_count') + self.failures,
+            timeout_count=F('timeout_count') + self.timeouts,
+            rate_limited_count=F('rate_limited_count') + self.rate_limited,
+            latency=self.latency,
+            consecutive_failures=self.consecutive_failures,
+            circuit_open_until=self.circuit_open_until,
+            last_error=self.last_error,
+            last_success=self.last_success
+        )
+        self.requests = self.failures = self.timeouts = self.rate_limited = 0
+
+    def __str__(self):
+        return self.url
+
+
+class EndpointPool:
+    """
+    Pool of Overpass endpoints. Queries are distributed with weights inversely proportional to the latency
+    of the endpoints and endpoints that fail repeatedly are left out for a while.
+    """
+
+    def __init__(self, endpoints: List[Endpoint]):
+        self.endpoints = endpoints
+
+    @staticmethod
+    def from_settings() -> 'EndpointPool':
+        """
+        :return: pool of the enabled OverpassEndpoints. If there are none, endpoints are created from
+        settings.OVERPASS_API_URLS.
+        """
+        if not OverpassEndpoint.objects.exists():
+            for url in settings.OVERPASS_API_URLS:
+                OverpassEndpoint.objects.get_or_create(url=url)
+        models = OverpassEndpoint.objects.filter(enabled=True).order_by('pk')
+        return EndpointPool([Endpoint(model) for model in models])
+
+    def choose(self, exclude: Iterable[str] = ()) -> Optional[Endpoint]:
+        """
+        :param exclude: urls of the endpoints that should not be chosen
+        :return: available endpoint or None if all of them are excluded or failing
+        """
+        now = timezone.now()
+        candidates = [endpoint for endpoint in self.endpoints
+                      if endpoint.url not in exclude and endpoint.is_available(now)]
+        if not len(candidates):
+            return None
+
+        # Endpoints without measurements are weighted with the average latency so that they get tried too
+        latencies = [endpoint.latency for endpoint in candidates if endpoint.latency is not None]
+        default_latency = sum(latencies) / len(latencies) if len(latencies) else 1.0
+        weights = [1 / max(endpoint.latency if endpoint.latency is not None else default_latency, MIN_LATENCY)
+                   for endpoint in candidates]
+        return random.choices(candidates, weights)[0]
+
+    def save(self) -> None:
+        for endpoint in self.endpoints:
+            endpoint.save()
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import re
+import time
+from typing import Dict, NamedTuple, Optional
+
+import aiohttp
+
+from .exeptions import TooManyRequests, QueryTooLarge
+from .metrics import OVERPASS_BYTES, OVERPASS_LATENCY, OVERPASS_RESPONSE_SIZE
+from .overpass_endpoints import Endpoint, EndpointPool
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_PATTERN = re.compile(r'Rate limit: (\d+)')
+AVAILABLE_SLOTS_PATTERN = re.compile(r'(\d+) slots? available now')
+SLOT_AVAILABLE_AFTER_PATTERN = re.compile(r'Slot available after: \S+, in (-?\d+) seconds?')
+
+
+class OverpassStatus(NamedTuple):
+    rate_limit: int  # 0 means that the server does not limit the number of queries
+    available_slots: int
+    next_slot_in: Optional[int]  # seconds until the next slot is freed if none are available
+
+
+def parse_status(text: str) -> OverpassStatus:
+    """
+    Parses the plain text response of Overpass /api/status
+    :param text: status response
+    :return: OverpassStatus
+    """
+    rate_limit = RATE_LIMIT_PATTERN.search(text)
+    available_slots = AVAILABLE_SLOTS_PATTERN.search(text)
+    next_slots = [int(seconds) for seconds in SLOT_AVAILABLE_AFTER_PATTERN.findall(text)]
+    return OverpassStatus(
+        rate_limit=int(rate_limit.group(1)) if rate_limit else 0,
+        available_slots=int(available_slots.group(1)) if available_slots else 0,
+        next_slot_in=min(next_slots) if len(next_slots) else None
+    )
+
+
+class OverpassFetcher:
+    """
+    Runs Overpass queries concurrently over a single keep-alive session. Each query goes to an endpoint chosen
+    from the pool. Before each query the status endpoint of the server is polled, so that only as many queries
+    are run at once as the server has slots available for us and the queries are never rejected with 429 on
+    a happy path. Queries that are rejected or fail because of the server are failed over to other endpoints.
+
+    Use as an async context manager.
+    """
+
+    STATUS_POLL_INTERVAL = 1
+    MAX_SLOT_WAIT = 60
+    MAX_ATTEMPTS = 4
+
+    def __init__(self, pool: EndpointPool, timeout: int, connect_timeout: int, gzip: bool = True,
+                 chunk_size: int = 1024 * 1024, max_concurrency: int = 2):
+        """
+
+        :param pool: Overpass endpoints to use
+        :param timeout: Timeout for the query execution
+        :param connect_timeout: Timeout for connecting to the server
+        :param gzip: Whether to ask Overpass to compress the response
+        :param chunk_size: Size of the chunks written to the file
+        :param max_concurrency: Maximum number of simultaneous queries per endpoint even if the server would
+        allow more
+        """
+        self.pool = pool
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.gzip = gzip
+        self.chunk_size = chunk_size
+        self.max_concurrency = max_concurrency
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._slot_locks: Dict[str, asyncio.Lock] = {}
+
+    async def __aenter__(self) -> 'OverpassFetcher':
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=self.max_concurrency + 1),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout,
+                                          sock_read=self.timeout + self.connect_timeout)
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.session.close()
+        self.session = None
+
+    async def get_status(self, endpoint: Endpoint) -> Optional[OverpassStatus]:
+        """
+        :return: status of the server or None if the server does not report it
+        """
+        try:
+            async with self.session.get(endpoint.status_url) as r:
+                if r.status != 200:
+                    return None
+                return parse_status(await r.text())
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logger.debug(f"Could not get status from {endpoint.status_url}")
+            return None
+
+    async def download(self, query: str, file_path: str) -> int:
+        """
+        Waits for a free slot and streams the query response to a file
+        :param query: Overpass query
+        :param file_path: path of the file to write to
+        :return: number of bytes written
+        """
+        tried = set()
+        for _ in range(self.MAX_ATTEMPTS):
+            endpoint = self.pool.choose(exclude=tried) or self.pool.choose()
+            if endpoint is None:
+                logger.warning("All Overpass endpoints are failing")
+                break
+            tried.add(endpoint.url)
+
+            try:
+                async with await self._get_semaphore(endpoint):
+                    await self._wait_for_slot(endpoint)
+                    # Time spent waiting for a slot is not part of the latency of the endpoint
+                    started = time.monotonic()
+                    size = await self._download(endpoint, query, file_path)
+            except QueryTooLarge:
+                # Other endpoints would run out of time as well, so the bbox is split instead of failing over.
+                # The endpoint is healthy, so its circuit is not opened because of large areas.
+                self._observe(endpoint, 'timeout', started)
+                endpoint.record_query_too_large()
+                raise
+            except aiohttp.ClientResponseError as e:
+                if e.status < 500:
+                    # The query itself is invalid, other endpoints would not do any better
+                    raise
+                self._observe(endpoint, 'error', started)
+                endpoint.record_failure(f"{e.status} {e.message}")
+                if self.pool.choose(exclude=tried) is None:
+                    raise
+                logger.warning(f"Query failed on {endpoint} with {e.status}, trying another endpoint...")
+                continue
+            except aiohttp.ClientError as e:
+                self._observe(endpoint, 'error', started)
+                endpoint.record_failure(repr(e), timeout=isinstance(e, asyncio.TimeoutError))
+                if self.pool.choose(exclude=tried) is None:
+                    raise
+                logger.warning(f"Could not query {endpoint}, trying another endpoint...")
+                continue
+            except TooManyRequests:
+                endpoint.record_rate_limited()
+                continue
+
+            if size is None:
+                # Slot was taken in between, for example by another client from the same address
+                self._observe(endpoint, 'rate_limited', started)
+                endpoint.record_rate_limited()
+                logger.debug(f"{endpoint} rejected the query, waiting for a slot...")
+                await asyncio.sleep(self.STATUS_POLL_INTERVAL)
+                continue
+
+            endpoint.record_success(time.monotonic() - started)
+            self._observe(endpoint, 'success', started)
+            OVERPASS_BYTES.labels(endpoint=endpoint.url).inc(size)
+            OVERPASS_RESPONSE_SIZE.labels(endpoint=endpoint.url).observe(size)
+            return size
+        raise TooManyRequests()
+
+    @staticmethod
+    def _observe(endpoint: Endpoint, outcome: str, started: float) -> None:
+        OVERPASS_LATENCY.labels(endpoint=endpoint.url, outcome=outcome).observe(time.monotonic() - started)
+
+    async def _get_semaphore(self, endpoint: Endpoint) -> asyncio.Semaphore:
+        # Created on the first query, so that the status is not polled if nothing is downloaded
+        async with self._get_slot_lock(endpoint):
+            if endpoint.url not in self._semaphores:
+                status = await self.get_status(endpoint)
+                concurrency = self.max_concurrency
+                if status is not None and status.rate_limit > 0:
+                    concurrency = min(concurrency, status.rate_limit)
+                logger.debug(f"Running at most {concurrency} queries at once on {endpoint}")
+                self._semaphores[endpoint.url] = asyncio.Semaphore(concurrency)
+        return self._semaphores[endpoint.url]
+
+    def _get_slot_lock(self, endpoint: Endpoint) -> asyncio.Lock:
+        return self._slot_locks.setdefault(endpoint.url, asyncio.Lock())
+
+    async def _wait_for_slot(self, endpoint: Endpoint) -> None:
+        # Queries are started one at a time so that each one sees the slots taken by the previous ones
+        async with self._get_slot_lock(endpoint):
+            waited = 0
+            while True:
+                status = await self.get_status(endpoint)
+                if status is None or status.rate_limit == 0 or status.available_slots > 0:
+                    return
+                if waited >= self.MAX_SLOT_WAIT:
+                    raise TooManyRequests()
+                delay = min(max(status.next_slot_in or 0, self.STATUS_POLL_INTERVAL), self.MAX_SLOT_WAIT)
+                logger.debug(f"No free slots on {endpoint}, waiting {delay} seconds...")
+                await asyncio.sleep(delay)
+                waited += delay
+
+    async def _download(self, endpoint: Endpoint, query: str, file_path: str) -> Optional[int]:
+        headers = {'Accept-Encoding': 'gzip' if self.gzip else 'identity'}
+        try:
+            async with self.session.get(endpoint.interpreter_url, params={'data': query}, headers=headers) as r:
+                if r.status == 504:
+                    raise QueryTooLarge()
+                if r.status == 429:
+                    return None
+
+                r.raise_for_status()
+                size = 0
+                with open(file_path, 'wb') as f:
+                    # Transfer encoding is decompressed on the fly
+                    async for chunk in r.content.iter_chunked(self.chunk_size):
+                        f.write(chunk)
+                        size += len(chunk)
+        except asyncio.TimeoutError as e:
+            if isinstance(e, aiohttp.ClientError):
+                raise
+            # Overpass reports the timeouts of the query itself with 504 or in the response, so timeouts of
+            # the connection are problems of the endpoint and failed over like the other connection errors
+            raise aiohttp.ServerTimeoutError(f"Timeout on {endpoint}") from e
+        return size
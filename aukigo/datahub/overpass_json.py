@@ -0,0 +1,228 @@
+import functools
+import json
+import logging
+import struct
+import sys
+from array import array
+from itertools import chain
+from typing import Iterator, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.contrib.gis.geos import LinearRing, Polygon
+
+from .utils import GeomType, OsmFeatureRecord
+
+logger = logging.getLogger(__name__)
+
+Coordinates = List[Tuple[float, float]]
+
+Z_ORDER_HIGHWAYS = {
+    'minor': 3, 'road': 3, 'unclassified': 3, 'residential': 3, 'tertiary_link': 4, 'tertiary': 4,
+    'secondary_link': 6, 'secondary': 6, 'primary_link': 7, 'primary': 7, 'trunk_link': 8, 'trunk': 8,
+    'motorway_link': 9, 'motorway': 9
+}
+TRUTHY_VALUES = ('yes', 'true', '1')
+MULTIPOLYGON_RELATIONS = ('multipolygon', 'boundary')
+MULTILINESTRING_RELATIONS = ('multilinestring', 'route')
+
+# WKB is written in the byte order of the machine so that coordinate arrays can be dumped as they are
+WKB_BYTE_ORDER = 1 if sys.byteorder == 'little' else 0
+WKB_POINT, WKB_LINESTRING, WKB_POLYGON, WKB_MULTILINESTRING, WKB_MULTIPOLYGON = 1, 2, 3, 5, 6
+
+
+def read_overpass_json_features(path: str) -> Iterator[OsmFeatureRecord]:
+    """
+    Reads features from Overpass json that is queried with out geom
+    :param path: Path to the json file
+    :return: generator of features
+    """
+    with open(path) as f:
+        elements = json.load(f).get('elements', [])
+    return elements_to_features(elements)
+
+
+def elements_to_features(elements: Iterable[dict]) -> Iterator[OsmFeatureRecord]:
+    """
+    Builds features from Overpass json elements following the same rules as GDAL OSM driver with
+    the settings.OSM_CONFIG configuration. Geometries are written directly as WKB from the coordinate
+    arrays of the elements, GEOS is only used to place the holes of multipolygons.
+    :param elements: Overpass elements with geometries
+    :return: generator of features
+    """
+    builders = {'node': _node_to_feature, 'way': _way_to_feature, 'relation': _relation_to_feature}
+    for element in elements:
+        if not element.get('tags'):
+            continue
+        builder = builders.get(element['type'])
+        feature = builder(element) if builder is not None else None
+        if feature is not None:
+            yield feature
+
+
+def compute_z_order(tags: {str: str}) -> int:
+    """
+    Python version of the z_order_sql in settings.OSM_CONFIG
+    :param tags: tag dictionary of the line
+    :return: z_order
+    """
+    z_order = Z_ORDER_HIGHWAYS.get(tags.get('highway'), 0)
+    if tags.get('bridge') in TRUTHY_VALUES:
+        z_order += 10
+    if tags.get('tunnel') in TRUTHY_VALUES:
+        z_order -= 10
+    if 'railway' in tags:
+        z_order += 5
+    if 'layer' in tags:
+        try:
+            z_order += 10 * int(tags['layer'])
+        except ValueError:
+            pass
+    return z_order
+
+
+def assemble_rings(lines: List[Coordinates]) -> List[Coordinates]:
+    """
+    Joins line segments into closed rings by matching their end points
+    :param lines: coordinate lists of the member ways
+    :return: closed rings, segments that cannot be closed are dropped
+    """
+    rings = []
+    open_lines = [list(line) for line in lines if len(line) >= 2]
+    while open_lines:
+        current = open_lines.pop()
+        while current[0] != current[-1]:
+            for i, other in enumerate(open_lines):
+                if other[0] == current[-1]:
+                    current = current + other[1:]
+                elif other[-1] == current[-1]:
+                    current = current + other[-2::-1]
+                elif other[-1] == current[0]:
+                    current = other[:-1] + current
+                elif other[0] == current[0]:
+                    current = other[:0:-1] + current
+                else:
+                    continue
+                open_lines.pop(i)
+                break
+            else:
+                break
+        if current[0] == current[-1] and len(current) >= 4:
+            rings.append(current)
+        else:
+            logger.debug("Dropped an unclosed ring")
+    return rings
+
+
+@functools.lru_cache()
+def _get_closed_ways_are_polygons() -> Tuple[set, set]:
+    keys, key_values = set(), set()
+    with open(settings.OSM_CONFIG) as f:
+        for line in f:
+            if line.startswith('closed_ways_are_polygons='):
+                for value in line.strip().split('=', 1)[1].split(','):
+                    (key_values if '=' in value else keys).add(value)
+    return keys, key_values
+
+
+def _is_area(tags: {str: str}) -> bool:
+    area = tags.get('area')
+    if area is not None:
+        return area != 'no'
+    keys, key_values = _get_closed_ways_are_polygons()
+    return any(key in keys or f'{key}={value}' in key_values for key, value in tags.items())
+
+
+def _coordinates(geometry: List[Optional[dict]]) -> Coordinates:
+    # Nodes that are outside of the queried bbox may be null
+    return [(node['lon'], node['lat']) for node in geometry if node is not None]
+
+
+def _wkb_header(wkb_type: int, count: int) -> bytes:
+    return struct.pack('=BII', WKB_BYTE_ORDER, wkb_type, count)
+
+
+def _wkb_coordinates(coords: Coordinates) -> bytes:
+    # The whole coordinate sequence is packed at once instead of point by point
+    return struct.pack('=I', len(coords)) + array('d', chain.from_iterable(coords)).tobytes()
+
+
+def _wkb_point(lon: float, lat: float) -> bytes:
+    return struct.pack('=BIdd', WKB_BYTE_ORDER, WKB_POINT, lon, lat)
+
+
+def _wkb_linestring(coords: Coordinates) -> bytes:
+    return struct.pack('=BI', WKB_BYTE_ORDER, WKB_LINESTRING) + _wkb_coordinates(coords)
+
+
+def _wkb_polygon(rings: List[Coordinates]) -> bytes:
+    return _wkb_header(WKB_POLYGON, len(rings)) + b''.join(_wkb_coordinates(ring) for ring in rings)
+
+
+def _wkb_multi(wkb_type: int, parts: List[bytes]) -> bytes:
+    return _wkb_header(wkb_type, len(parts)) + b''.join(parts)
+
+
+def _record(element: dict, geom_type: GeomType, wkb: bytes, z_order: Optional[int] = None) -> OsmFeatureRecord:
+    return OsmFeatureRecord(osmid=element['id'], geom_type=geom_type, geom=wkb, tags=element['tags'],
+                            z_order=z_order)
+
+
+def _node_to_feature(element: dict) -> OsmFeatureRecord:
+    return _record(element, GeomType.POINT, _wkb_point(element['lon'], element['lat']))
+
+
+def _way_to_feature(element: dict) -> Optional[OsmFeatureRecord]:
+    coords = _coordinates(element.get('geometry', []))
+    if len(coords) < 2:
+        return None
+    tags = element['tags']
+    if len(coords) >= 4 and coords[0] == coords[-1] and _is_area(tags):
+        return _record(element, GeomType.POLYGON, _wkb_multi(WKB_MULTIPOLYGON, [_wkb_polygon([coords])]))
+    return _record(element, GeomType.LINE, _wkb_multi(WKB_MULTILINESTRING, [_wkb_linestring(coords)]),
+                   compute_z_order(tags))
+
+
+def _relation_to_feature(element: dict) -> Optional[OsmFeatureRecord]:
+    relation_type = element['tags'].get('type')
+    members = [member for member in element.get('members', []) if member['type'] == 'way']
+    if relation_type in MULTIPOLYGON_RELATIONS:
+        wkb = _build_multipolygon(members)
+        geom_type = GeomType.POLYGON
+    elif relation_type in MULTILINESTRING_RELATIONS:
+        lines = [_coordinates(member.get('geometry', [])) for member in members]
+        lines = [_wkb_linestring(coords) for coords in lines if len(coords) >= 2]
+        wkb = _wkb_multi(WKB_MULTILINESTRING, lines) if len(lines) else None
+        geom_type = GeomType.LINE
+    else:
+        return None
+
+    if wkb is None:
+        logger.debug(f"Could not build geometry for relation {element['id']}")
+        return None
+    # Relations are in multilinestrings layer that does not have z_order
+    return _record(element, geom_type, wkb, 0 if geom_type == GeomType.LINE else None)
+
+
+def _build_multipolygon(members: List[dict]) -> Optional[bytes]:
+    outer_lines, inner_lines = [], []
+    for member in members:
+        coords = _coordinates(member.get('geometry', []))
+        (inner_lines if member.get('role') == 'inner' else outer_lines).append(coords)
+
+    outers = assemble_rings(outer_lines)
+    if not len(outers):
+        return None
+
+    polygons = [[outer] for outer in outers]
+    inners = assemble_rings(inner_lines)
+    if len(inners):
+        # GEOS is only needed to find the outer ring that contains each hole
+        outer_polygons = [Polygon(outer) for outer in outers]
+        for ring in inners:
+            inner = LinearRing(ring)
+            for i, outer in enumerate(outer_polygons):
+                if outer.contains(inner):
+                    polygons[i].append(ring)
+                    break
+
+    return _wkb_multi(WKB_MULTIPOLYGON, [_wkb_polygon(rings) for rings in polygons])
@@ -0,0 +1,286 @@
+import contextlib
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, NamedTuple, Optional, Union
+from urllib.parse import parse_qs, urlparse
+from xml.etree import ElementTree
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Ids of the scaled copies are offset by multiples of this so that they never collide with real OSM ids
+SCALED_ID_OFFSET = 10 ** 11
+SCALED_COORDINATE_OFFSET = 1e-5
+DRIP_CHUNK_SIZE = 1024
+
+Response = Union[str, int]  # fixture name or path, or HTTP status code
+
+
+class Faults(NamedTuple):
+    rate_limit_probability: float = 0.0  # respond with 429
+    timeout_probability: float = 0.0  # respond with 504 after the latency
+    latency: float = 0.0  # seconds before the response starts
+    drip_bytes_per_second: Optional[int] = None  # throttle the response body
+    seed: Optional[int] = None
+
+
+def overpass_status(rate_limit: int, available_slots: int, next_slot_in: Optional[int] = None) -> str:
+    """
+    Builds Overpass /api/status response
+    :param rate_limit: number of slots, 0 for unlimited
+    :param available_slots: number of free slots
+    :param next_slot_in: seconds until the next slot is freed
+    :return: plain text status
+    """
+    lines = ["Connected as: 1234567", "Current time: 2020-06-22T07:43:03Z", f"Rate limit: {rate_limit}"]
+    if rate_limit > 0:
+        lines.append(f"{available_slots} slots available now.")
+    if next_slot_in is not None:
+        lines.append(f"Slot available after: 2020-06-22T07:43:15Z, in {next_slot_in} seconds.")
+    lines.append("Currently running queries (pid, space limit, time limit, start time):")
+    return '\n'.join(lines) + '\n'
+
+
+class OverpassStandIn:
+    """
+    Local HTTP server that stands in for Overpass API. Responds to the queries with recorded OSM xml files
+    in order, the last response is repeated. Responses are converted to json or counts if the query asks
+    for them. Faults can be injected to test the error handling and the pacing of the loader.
+
+    Use as a context manager or with start and stop.
+    """
+
+    def __init__(self, responses: List[Response], statuses: Optional[List[str]] = None, faults: Faults = Faults(),
+                 scale: int = 1, host: str = 'localhost', port: int = 0):
+        """
+
+        :param responses: OSM xml files or HTTP status codes. Relative paths are read from settings.TEST_DATA_DIR.
+        :param statuses: /api/status responses that are consumed in order, the last one is repeated
+        :param faults: Faults to inject to the interpreter responses
+        :param scale: Number of copies of the features in each response
+        :param host: Host to bind to
+        :param port: Port to bind to, 0 picks a free port
+        """
+        self.responses = responses
+        self.statuses = statuses if statuses is not None else [overpass_status(0, 0)]
+        self.faults = faults
+        self.scale = scale
+        self.queries: List[str] = []
+        self._random = random.Random(faults.seed)
+        self._lock = threading.Lock()
+        self._tmp_dir: Optional[str] = None
+        self._paths: List[Response] = []
+        self._server = ThreadingHTTPServer((host, port), self._create_handler())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api"
+
+    def start(self) -> 'OverpassStandIn':
+        self._prepare_responses()
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        self._prepare_responses()
+        try:
+            self._server.serve_forever()
+        finally:
+            self.stop()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread = None
+        self._server.server_close()
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+    def __enter__(self) -> 'OverpassStandIn':
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+    def _prepare_responses(self) -> None:
+        self._paths = []
+        for response in self.responses:
+            if isinstance(response, int):
+                self._paths.append(response)
+                continue
+            path = response if os.path.isabs(response) else os.path.join(settings.TEST_DATA_DIR, response)
+            if self.scale > 1:
+                if self._tmp_dir is None:
+                    self._tmp_dir = tempfile.mkdtemp()
+                scaled_path = os.path.join(self._tmp_dir, f"{len(self._paths)}_{os.path.basename(path)}")
+                scale_osm_file(path, scaled_path, self.scale)
+                path = scaled_path
+            self._paths.append(path)
+
+    def _next_status(self) -> str:
+        with self._lock:
+            return self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+
+    def _next_response(self, query: str) -> Response:
+        with self._lock:
+            self.queries.append(query)
+            return self._paths[min(len(self.queries), len(self._paths)) - 1]
+
+    def _create_handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path.endswith('/status'):
+                    self._respond(200, standin._next_status().encode())
+                    return
+                query = parse_qs(url.query)['data'][0]
+                response = standin._next_response(query)
+
+                faults = standin.faults
+                if faults.latency:
+                    time.sleep(faults.latency)
+                if standin._random.random() < faults.rate_limit_probability:
+                    response = 429
+                elif standin._random.random() < faults.timeout_probability:
+                    response = 504
+
+                if isinstance(response, int):
+                    self._respond(response, b'')
+                else:
+                    self._respond(200, render_response(response, query), faults.drip_bytes_per_second)
+
+            def _respond(self, status_code: int, body: bytes, drip_bytes_per_second: Optional[int] = None):
+                self.send_response(status_code)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if drip_bytes_per_second is None:
+                    self.wfile.write(body)
+                    return
+                for i in range(0, len(body), DRIP_CHUNK_SIZE):
+                    self.wfile.write(body[i:i + DRIP_CHUNK_SIZE])
+                    self.wfile.flush()
+                    time.sleep(DRIP_CHUNK_SIZE / drip_bytes_per_second)
+
+            def log_message(self, *args):
+                logger.debug(args[0] % args[1:])
+
+        return Handler
+
+
+@contextlib.contextmanager
+def recorded_overpass(responses: List[Response], statuses: Optional[List[str]] = None,
+                      faults: Faults = Faults(), scale: int = 1):
+    """
+    Serves the responses from OverpassStandIn for the duration of the context
+    :return: API url of the server and list of received queries
+    """
+    with OverpassStandIn(responses, statuses, faults, scale) as standin:
+        yield standin.url, standin.queries
+
+
+def render_response(path: str, query: str) -> bytes:
+    """
+    Renders the recorded OSM xml in the output format that the query asks for
+    :param path: path of the OSM xml file
+    :param query: Overpass query
+    :return: response body
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if '[out:json]' not in query:
+        return data
+
+    elements = osm_xml_to_overpass_elements(data.decode())
+    if 'out count;' in query:
+        counts = {f'{element_type}s': str(sum(1 for element in elements if element['type'] == element_type))
+                  for element_type in ('node', 'way', 'relation')}
+        elements = [{'type': 'count', 'id': 0, 'tags': {**counts, 'total': str(len(elements))}}]
+    osm_base = ElementTree.fromstring(data).find('meta')
+    return json.dumps({
+        'version': 0.6,
+        'osm3s': {'timestamp_osm_base': osm_base.get('osm_base') if osm_base is not None else None},
+        'elements': elements
+    }).encode()
+
+
+def scale_osm_file(src_path: str, dst_path: str, factor: int) -> None:
+    """
+    Writes a synthetic OSM xml that contains factor copies of the elements of the source file. Copies have
+    offset ids and slightly shifted coordinates.
+    :param src_path: OSM xml file
+    :param dst_path: path of the file to write
+    :param factor: number of copies
+    """
+    root = ElementTree.parse(src_path).getroot()
+    elements = list(root)
+    id_attributes = [(element, attr, int(element.get(attr)))
+                     for parent in elements for element in parent.iter()
+                     for attr in ('id', 'ref') if element.get(attr) is not None]
+    coordinates = [(element, float(element.get('lat')), float(element.get('lon')))
+                   for element in root.iter('node') if element.get('lat') is not None]
+
+    with open(dst_path, 'wb') as f:
+        f.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+        f.write(f'<osm version="{root.get("version", "0.6")}" generator="aukigo stand-in">\n'.encode())
+        for element in elements:
+            if element.tag in ('note', 'meta', 'bounds'):
+                f.write(ElementTree.tostring(element))
+        for copy in range(factor):
+            for element, attr, value in id_attributes:
+                element.set(attr, str(value + copy * SCALED_ID_OFFSET))
+            for element, lat, lon in coordinates:
+                element.set('lat', f"{lat + copy * SCALED_COORDINATE_OFFSET:.7f}")
+                element.set('lon', f"{lon + copy * SCALED_COORDINATE_OFFSET:.7f}")
+            for element in elements:
+                if element.tag in ('node', 'way', 'relation'):
+                    f.write(ElementTree.tostring(element))
+        f.write(b'</osm>\n')
+
+
+def osm_xml_to_overpass_elements(xml_data: str) -> [dict]:
+    """
+    Converts OSM xml to elements that Overpass would return with out geom
+    :param xml_data: OSM xml
+    :return: Overpass json elements
+    """
+    root = ElementTree.fromstring(xml_data)
+    nodes = {node.get('id'): {'lat': float(node.get('lat')), 'lon': float(node.get('lon'))}
+             for node in root.iter('node')}
+    ways = {way.get('id'): [nodes.get(nd.get('ref')) for nd in way.iter('nd')] for way in root.iter('way')}
+
+    def get_tags(element):
+        return {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+
+    elements = [{'type': 'node', 'id': int(node.get('id')), 'tags': get_tags(node), **nodes[node.get('id')]}
+                for node in root.iter('node')]
+    elements += [{'type': 'way', 'id': int(way.get('id')), 'tags': get_tags(way), 'geometry': ways[way.get('id')]}
+                 for way in root.iter('way')]
+    for relation in root.iter('relation'):
+        members = []
+        for member in relation.iter('member'):
+            ref = member.get('ref')
+            values = {'type': member.get('type'), 'ref': int(ref), 'role': member.get('role')}
+            if values['type'] == 'way':
+                values['geometry'] = ways.get(ref, [])
+            elif values['type'] == 'node' and ref in nodes:
+                values.update(nodes[ref])
+            members.append(values)
+        elements.append({'type': 'relation', 'id': int(relation.get('id')), 'tags': get_tags(relation),
+                         'members': members})
+    return elements
@@ -0,0 +1,197 @@
+import logging
+from contextlib import contextmanager
+from typing import List
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from .bulk import get_through_table
+from .utils import GeomType
+
+logger = logging.getLogger(__name__)
+
+
+# noinspection SqlNoDataSourceInspection
+def is_partitioned(geom_type: GeomType, using=DEFAULT_DB_ALIAS) -> bool:
+    """
+    :param geom_type: geometry type of the features
+    :param using: Database key
+    :return: Whether the layer memberships of the geometry type are partitioned by layer
+    """
+    table, _, _ = get_through_table(geom_type)
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)', [table])
+        return cursor.fetchone() is not None
+
+
+# noinspection SqlNoDataSourceInspection
+def get_partitioned_types(using=DEFAULT_DB_ALIAS) -> List[GeomType]:
+    """
+    :param using: Database key
+    :return: Geometry types whose layer memberships are partitioned by layer, checked with a single query
+    """
+    tables = {get_through_table(geom_type)[0]: geom_type for geom_type in GeomType}
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT name FROM unnest(%s::text[]) AS name '
+                       'WHERE to_regclass(name) IN (SELECT partrelid FROM pg_partitioned_table)', [list(tables)])
+        partitioned = {row[0] for row in cursor.fetchall()}
+    return [geom_type for table, geom_type in tables.items() if table in partitioned]
+
+
+def get_partition_name(geom_type: GeomType, layer_id: int) -> str:
+    table, _, _ = get_through_table(geom_type)
+    return f"{table}_{layer_id}"
+
+
+# noinspection SqlNoDataSourceInspection
+def create_layer_partitions(layer_id: int, using=DEFAULT_DB_ALIAS) -> None:
+    """
+    Creates partitions of the layer for the partitioned geometry types. Memberships of the layer that are already
+    in the default partition are moved to the new partition, since the partition cannot be created otherwise.
+    :param layer_id: OsmLayer pk
+    :param using: Database key
+    """
+    partitioned_types = get_partitioned_types(using)
+    if not len(partitioned_types):
+        return
+    with transaction.atomic(using=using), connections[using].cursor() as cursor, _immediate_constraints(cursor):
+        for geom_type in partitioned_types:
+            table, _, layer_column = get_through_table(geom_type)
+            partition = get_partition_name(geom_type, layer_id)
+            cursor.execute('SELECT to_regclass(%s)', [partition])
+            if cursor.fetchone()[0] is not None:
+                continue
+            moved_table = f"{partition}_moved"
+            cursor.execute(f'CREATE TEMPORARY TABLE {moved_table} (LIKE {table})')
+            cursor.execute(f'WITH moved AS (DELETE FROM {table}_default WHERE {layer_column} = %s RETURNING *) '
+                           f'INSERT INTO {moved_table} SELECT * FROM moved', [layer_id])
+            moved = cursor.rowcount
+            cursor.execute(f'CREATE TABLE {partition} PARTITION OF {table} FOR VALUES IN ({int(layer_id)})')
+            if moved:
+                cursor.execute(f'INSERT INTO {table} SELECT * FROM {moved_table}')
+                logger.info(f"Moved {moved} memberships of layer {layer_id} from the default partition to {partition}")
+            cursor.execute(f'DROP TABLE {moved_table}')
+
+
+# noinspection SqlNoDataSourceInspection
+def drop_layer_partitions(layer_id: int, using=DEFAULT_DB_ALIAS) -> None:
+    """
+    Drops the layer memberships of the layer at once instead of deleting them row by row. Features that are not
+    in any other layer are left as they are, like when the memberships are deleted.
+    :param layer_id: OsmLayer pk
+    :param using: Database key
+    """
+    partitioned_types = get_partitioned_types(using)
+    if not len(partitioned_types):
+        return
+    with connections[using].cursor() as cursor, _immediate_constraints(cursor):
+        for geom_type in partitioned_types:
+            cursor.execute(f'DROP TABLE IF EXISTS {get_partition_name(geom_type, layer_id)}')
+
+
+# noinspection SqlNoDataSourceInspection
+def partition_membership(using=DEFAULT_DB_ALIAS) -> List[GeomType]:
+    """
+    Converts the layer membership tables to tables list-partitioned by layer. Each layer gets its own partition,
+    so the queries of a single layer only read its own memberships and a layer can be removed by dropping
+    its partitions. Memberships of layers without a partition go to the default partition.
+    :param using: Database key
+    :return: converted geometry types
+    """
+    from .models import OsmLayer
+
+    layers = list(OsmLayer.objects.using(using))
+    converted = []
+    with transaction.atomic(using=using), _without_views(layers), connections[using].cursor() as cursor, \
+            _immediate_constraints(cursor):
+        for geom_type in GeomType:
+            if is_partitioned(geom_type, using):
+                continue
+            table, feature_column, layer_column = get_through_table(geom_type)
+            old_table = f"{table}_unpartitioned"
+            cursor.execute(f'ALTER TABLE {table} RENAME TO {old_table}')
+            cursor.execute(f'CREATE TABLE {table} (LIKE {old_table} INCLUDING DEFAULTS) '
+                           f'PARTITION BY LIST ({layer_column})')
+            # Sequence of the id column would be dropped with the old table
+            cursor.execute(f"SELECT pg_get_serial_sequence('{old_table}', 'id')")
+            cursor.execute(f'ALTER SEQUENCE {cursor.fetchone()[0]} OWNED BY {table}.id')
+            cursor.execute(f'CREATE TABLE {table}_default PARTITION OF {table} DEFAULT')
+            for layer in layers:
+                cursor.execute(f'CREATE TABLE {get_partition_name(geom_type, layer.pk)} '
+                               f'PARTITION OF {table} FOR VALUES IN ({int(layer.pk)})')
+            cursor.execute(f'INSERT INTO {table} SELECT * FROM {old_table}')
+            cursor.execute(f'DROP TABLE {old_table}')
+            _add_constraints(cursor, geom_type, primary_key=f'id, {layer_column}')
+            cursor.execute(f'ANALYZE {table}')
+            converted.append(geom_type)
+            logger.info(f"Partitioned {table} by layer")
+    return converted
+
+
+# noinspection SqlNoDataSourceInspection
+def unpartition_membership(using=DEFAULT_DB_ALIAS) -> List[GeomType]:
+    """
+    Converts the layer membership tables back to plain tables
+    :param using: Database key
+    :return: converted geometry types
+    """
+    from .models import OsmLayer
+
+    layers = list(OsmLayer.objects.using(using))
+    converted = []
+    with transaction.atomic(using=using), _without_views(layers), connections[using].cursor() as cursor, \
+            _immediate_constraints(cursor):
+        for geom_type in GeomType:
+            if not is_partitioned(geom_type, using):
+                continue
+            table, _, _ = get_through_table(geom_type)
+            new_table = f"{table}_unpartitioned"
+            cursor.execute(f'CREATE TABLE {new_table} (LIKE {table} INCLUDING DEFAULTS)')
+            cursor.execute(f"SELECT pg_get_serial_sequence('{table}', 'id')")
+            cursor.execute(f'ALTER SEQUENCE {cursor.fetchone()[0]} OWNED BY {new_table}.id')
+            cursor.execute(f'INSERT INTO {new_table} SELECT * FROM {table}')
+            cursor.execute(f'DROP TABLE {table}')
+            cursor.execute(f'ALTER TABLE {new_table} RENAME TO {table}')
+            _add_constraints(cursor, geom_type, primary_key='id')
+            cursor.execute(f'ANALYZE {table}')
+            converted.append(geom_type)
+            logger.info(f"Removed partitioning of {table}")
+    return converted
+
+
+@contextmanager
+def _immediate_constraints(cursor):
+    # Table cannot be dropped while it has pending foreign key checks in the transaction
+    cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+    yield
+    cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+
+
+@contextmanager
+def _without_views(layers):
+    # Views of the layers depend on the membership tables, so they are created again after the conversion
+    for layer in layers:
+        layer._drop_views()
+    yield
+    for layer in layers:
+        for geom_type in layer.geom_types:
+            layer.add_support_for_type(geom_type)
+
+
+def _add_constraints(cursor, geom_type: GeomType, primary_key: str) -> None:
+    from .models import OsmLayer
+
+    table, feature_column, layer_column = get_through_table(geom_type)
+    feature_table = geom_type.osm_model._meta.db_table
+    # Constraints of partitioned table are created on its partitions as well
+    for sql in (
+            f'ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY ({primary_key})',
+            f'ALTER TABLE {table} ADD CONSTRAINT {table}_uniq UNIQUE ({feature_column}, {layer_column})',
+            f'ALTER TABLE {table} ADD CONSTRAINT {table}_{feature_column}_fk FOREIGN KEY ({feature_column}) '
+            f'REFERENCES {feature_table} (osmid) DEFERRABLE INITIALLY DEFERRED',
+            f'ALTER TABLE {table} ADD CONSTRAINT {table}_{layer_column}_fk FOREIGN KEY ({layer_column}) '
+            f'REFERENCES {OsmLayer._meta.db_table} ({OsmLayer._meta.pk.column}) DEFERRABLE INITIALLY DEFERRED',
+            f'CREATE INDEX {table}_{feature_column}_idx ON {table} ({feature_column})',
+            f'CREATE INDEX {table}_{layer_column}_idx ON {table} ({layer_column})',
+    ):
+        logger.debug(sql)
+        cursor.execute(sql)
@@ -0,0 +1,56 @@
+import datetime
+import logging
+from typing import List, Tuple
+
+from django.db.models import Exists, OuterRef
+
+from .models import OsmLayer, OsmSyncState
+
+logger = logging.getLogger(__name__)
+
+
+def get_due_states(now: datetime.datetime) -> List[OsmSyncState]:
+    """
+    Finds the layer and area pairs that should be refreshed. States are created for new pairs.
+    :param now: current time
+    :return: states of the due pairs, the most stale first. Ties are broken by the change rate and the cost.
+    """
+    links = OsmLayer.areas.through.objects
+    existing = set(OsmSyncState.objects.values_list('layer_id', 'area_id'))
+    OsmSyncState.objects.bulk_create([
+        OsmSyncState(layer_id=layer_id, area_id=area_id)
+        for layer_id, area_id in links.values_list('osmlayer_id', 'areaofinterest_id')
+        if (layer_id, area_id) not in existing
+    ], ignore_conflicts=True)  # Scheduler of another worker may create the same states at the same time
+
+    # States of areas that were removed from the layer are left alone
+    states = (OsmSyncState.objects
+              .filter(Exists(links.filter(osmlayer_id=OuterRef('layer_id'), areaofinterest_id=OuterRef('area_id'))))
+              .select_related('layer', 'area'))
+    due = [state for state in states if state.layer.tags and state.is_due(now)]
+    return sorted(due, key=lambda state: (-state.get_staleness(now), -(state.change_rate or 0),
+                                          state.last_duration or 0))
+
+
+def plan_refreshes(states: List[OsmSyncState], window: datetime.timedelta) -> List[Tuple[OsmSyncState, float]]:
+    """
+    Spreads the refreshes across the window so that the pairs do not all start at once. Each pair is given
+    a share of the window in proportion to its historical duration.
+    :param states: due states in the order they should be started
+    :param window: time until the next scheduling round
+    :return: states with the delay in seconds to start them after
+    """
+    durations = [state.last_duration for state in states if state.last_duration is not None]
+    default_duration = sum(durations) / len(durations) if len(durations) else 1.0
+    costs = [state.last_duration if state.last_duration is not None else default_duration for state in states]
+    total_cost = sum(costs)
+    if total_cost <= 0:
+        # Durations of zero give no proportions, so the refreshes are spread evenly
+        costs, total_cost = [1.0] * len(states), float(len(states))
+
+    plan = []
+    elapsed = 0.0
+    for state, cost in zip(states, costs):
+        plan.append((state, window.total_seconds() * elapsed / total_cost))
+        elapsed += cost
+    return plan
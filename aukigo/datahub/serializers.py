@@ -5,7 +5,7 @@ from rest_framework.request import Request
 from rest_framework_gis.serializers import GeoFeatureModelSerializer
 
 from .models import (Tileset, AreaOfInterest, OsmLayer, WMTSBasemap, VectorTileBasemap,
-                     Layer, OsmPoint, OsmPolygon, OsmLine)
+                     Layer, OsmPoint, OsmPolygon, OsmLine, OverpassEndpoint)
 
 
 class OsmLayerSerializer(serializers.HyperlinkedModelSerializer):
@@ -126,6 +126,16 @@ class VectorTileBasemapSerializer(BasemapSerializer):
         model = VectorTileBasemap
 
 
+class OverpassEndpointSerializer(serializers.ModelSerializer):
+    is_available = serializers.ReadOnlyField()
+
+    class Meta:
+        model = OverpassEndpoint
+        # last_error is left out, since the error messages may reveal details of the endpoints and the network
+        fields = ('url', 'enabled', 'is_available', 'request_count', 'failure_count', 'timeout_count',
+                  'rate_limited_count', 'latency', 'consecutive_failures', 'circuit_open_until', 'last_success')
+
+
 class OsmPointSerializer(GeoFeatureModelSerializer):
     class Meta:
         model = OsmPoint
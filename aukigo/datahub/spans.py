@@ -0,0 +1,162 @@
+import contextlib
+import contextvars
+import json
+import logging
+import time
+import tracemalloc
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+_current_recorder: contextvars.ContextVar[Optional['SpanRecorder']] = contextvars.ContextVar('span_recorder',
+                                                                                            default=None)
+_current_span: contextvars.ContextVar[Optional['Span']] = contextvars.ContextVar('span', default=None)
+
+
+class Span:
+    """
+    Timed phase of a unit of work, for example Overpass request or upsert of one geometry type
+    """
+
+    def __init__(self, name: str, attributes: dict, parent: Optional['Span'] = None):
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.duration: Optional[float] = None
+        self.queries = 0
+        self.peak_memory: Optional[int] = None
+        self._peak = 0
+
+    @property
+    def path(self) -> str:
+        return f"{self.parent.path}.{self.name}" if self.parent is not None else self.name
+
+    def set(self, **attributes) -> None:
+        """
+        Adds attributes such as row counts to the span
+        """
+        self.attributes.update(attributes)
+
+    def as_dict(self) -> dict:
+        return {'span': self.path, 'duration': self.duration, 'queries': self.queries,
+                'peak_memory': self.peak_memory, **self.attributes}
+
+
+class SpanRecorder:
+    """
+    Collects the spans of a unit of work, for example loading of one layer and area. Attributes of the recorder
+    are added to all the span records. Use as a context manager around the work.
+    """
+
+    def __init__(self, **attributes):
+        self.attributes = attributes
+        self.spans: List[Span] = []
+        self.started: Optional[float] = None
+        self.duration: Optional[float] = None
+        self._query_count = 0
+        self._stack = contextlib.ExitStack()
+        self._started_tracemalloc = False
+        self._token = None
+
+    def __enter__(self) -> 'SpanRecorder':
+        self.started = time.perf_counter()
+        self._token = _current_recorder.set(self)
+        # Counts queries without the overhead of recording them like CaptureQueriesContext does
+        self._stack.enter_context(connection.execute_wrapper(self._count_query))
+        if settings.SPAN_TRACE_MEMORY and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.duration = time.perf_counter() - self.started
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        self._stack.close()
+        _current_recorder.reset(self._token)
+
+    def as_list(self) -> List[dict]:
+        return [{**self.attributes, **span.as_dict()} for span in self.spans]
+
+    def _count_query(self, execute, sql, params, many, context):
+        self._query_count += 1
+        return execute(sql, params, many, context)
+
+
+@contextlib.contextmanager
+def span(name: str, trace_memory: bool = True, **attributes):
+    """
+    Measures duration, database query count and peak Python memory of the block and records it to the current
+    SpanRecorder. Does nothing but yield a span if there is no recorder.
+
+    Memory is measured with tracemalloc and includes only Python allocations. Peaks of nested spans are
+    separated only in Python 3.9 and newer, older versions report the peak since the recorder was entered.
+    :param name: name of the phase
+    :param trace_memory: whether to measure memory, disable for spans that run concurrently
+    :param attributes: attributes of the span
+    :return: Span
+    """
+    recorder = _current_recorder.get()
+    parent = _current_span.get()
+    current = Span(name, attributes, parent)
+    if recorder is None:
+        yield current
+        return
+
+    trace_memory = trace_memory and tracemalloc.is_tracing()
+    start_memory = 0
+    if trace_memory:
+        start_memory, peak = tracemalloc.get_traced_memory()
+        if parent is not None:
+            parent._peak = max(parent._peak, peak)
+        _reset_peak()
+
+    token = _current_span.set(current)
+    start_queries = recorder._query_count
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - start
+        current.queries = recorder._query_count - start_queries
+        _current_span.reset(token)
+
+        if trace_memory:
+            peak = max(tracemalloc.get_traced_memory()[1], current._peak)
+            current.peak_memory = peak - start_memory
+            if parent is not None:
+                parent._peak = max(parent._peak, peak)
+            _reset_peak()
+
+        recorder.spans.append(current)
+        record = {**recorder.attributes, **current.as_dict()}
+        logger.info(f"{current.path} took {current.duration:.3f} s", extra={'span': record})
+
+
+def total_duration(spans: List[dict]) -> float:
+    """
+    :param spans: span records, for example from SpanRecorder.as_list
+    :return: sum of the durations of the top level spans
+    """
+    return sum(record['duration'] for record in spans if '.' not in record['span'])
+
+
+def _reset_peak() -> None:
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+
+class SpanFormatter(logging.Formatter):
+    """
+    Formats span log records as json lines
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = getattr(record, 'span', None)
+        if data is None:
+            return super().format(record)
+        return json.dumps({'time': self.formatTime(record), **data}, default=str)
@@ -0,0 +1,103 @@
+import functools
+import logging
+import re
+from typing import Callable, Iterable, Pattern, Tuple
+
+logger = logging.getLogger(__name__)
+
+TagPredicate = Callable[[dict], bool]
+
+
+class TagMatcher:
+    """
+    OsmLayer tags compiled to a predicate over a tag dictionary. Overpass returns the union of the tag queries,
+    so a feature matches if any of the tags match.
+
+    Tags are indexed by key, so matching costs a dictionary lookup per tag key instead of evaluating every
+    tag expression one by one.
+    """
+
+    def __init__(self, tags: Iterable[str]):
+        self.keys = set()  # key, key=*
+        self.values = {}  # key=val
+        self.patterns = {}  # key~regex
+        self.key_patterns = []  # ~keyregex~regex
+
+        for tag in tags or []:
+            try:
+                self._add(tag)
+            except re.error:
+                logger.warning(f"Possibly invalid tag: '{tag}'")
+
+        self._indexed_keys = self.keys.union(self.values.keys(), self.patterns.keys())
+
+    def __call__(self, tags: {str: str}) -> bool:
+        if len(tags) <= len(self._indexed_keys):
+            candidate_keys = [key for key in tags if key in self._indexed_keys]
+        else:
+            candidate_keys = [key for key in self._indexed_keys if key in tags]
+
+        for key in candidate_keys:
+            value = tags[key]
+            if key in self.keys or value in self.values.get(key, ()):
+                return True
+            if any(pattern.search(value) for pattern in self.patterns.get(key, ())):
+                return True
+
+        return any(key_pattern.search(k) and value_pattern.search(v)
+                   for key_pattern, value_pattern in self.key_patterns for k, v in tags.items())
+
+    def _add(self, tag: str) -> None:
+        if tag.startswith('~') and '~' in tag[1:]:
+            key_regex, value_regex = tag[1:].split('~', 1)
+            self.key_patterns.append((_compile_regex(key_regex), _compile_regex(value_regex)))
+            return
+
+        key, sep, value = split_tag(tag)
+        if sep is None or (sep == '=' and value == '*'):
+            self.keys.add(key)
+        elif sep == '=':
+            self.values.setdefault(key, set()).add(value)
+        else:
+            self.patterns.setdefault(key, []).append(_compile_regex(value))
+
+
+def split_tag(tag: str) -> Tuple[str, str, str]:
+    """
+    Splits tag from the first = or ~. Keys may contain other special characters such as :
+    :param tag: Tag in format key=val, key~regex, key=*, key
+    :return: key, separator and value. Separator and value are None if tag is only a key.
+    """
+    separators = [i for i in (tag.find('='), tag.find('~')) if i > 0]
+    if not len(separators):
+        return tag, None, None
+    i = min(separators)
+    return tag[:i], tag[i], tag[i + 1:]
+
+
+def compile_tag(tag: str) -> TagPredicate:
+    """
+    Compiles OsmLayer tag to a predicate that evaluates the tag like Overpass API would
+    :param tag: Tag in format key=val, key~regex, ~keyregex~regex, key=*, key
+    :return: predicate over a tag dictionary
+    """
+    return compile_tags((tag,))
+
+
+def compile_tags(tags: Iterable[str]) -> TagPredicate:
+    """
+    Compiles all tags of OsmLayer to a single predicate. Compiled matchers are cached by the tags.
+    :param tags: OsmLayer tags
+    :return: predicate over a tag dictionary
+    """
+    return _get_matcher(tuple(tags or ()))
+
+
+@functools.lru_cache(maxsize=256)
+def _get_matcher(tags: Tuple[str]) -> TagMatcher:
+    return TagMatcher(tags)
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_regex(pattern: str) -> Pattern:
+    return re.compile(pattern)
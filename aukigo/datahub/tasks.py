@@ -1,11 +1,23 @@
+import datetime
 import logging
+import os
+import shutil
+import uuid
 
-from celery import shared_task, group
+from celery import shared_task, group, chain, Task
 from django.conf import settings
+from django.db import OperationalError
+from django.utils import timezone
 
-from .exeptions import TooManyRequests
-from .models import OsmLayer, AreaOfInterest
+from .bulk import read_feature_rows
+from .exeptions import TooManyRequests, LockNotAcquired
+from .locks import LeasedLock, claim, release_claim, lock_pairs, pair_key, area_key
+from .models import OsmLayer, AreaOfInterest, OsmSyncState
+from .osm_extract import import_osm_extract
 from .osm_loader import OsmLoader
+from .scheduler import get_due_states, plan_refreshes
+from .spans import SpanRecorder, total_duration
+from .utils import OutputFormat
 
 logger = logging.getLogger(__name__)
 
@@ -17,33 +29,288 @@ def load_osm_data():
     Spawns number of retryable child tasks
     :return:
     """
-    g = group(load_osm_data_for_area.s(layer.pk, area.pk)
-              for layer in OsmLayer.objects.all()
-              for area in layer.areas.all())
+    if settings.OSM_COMBINED_AREA_QUERIES:
+        # One query per area shared by all the layers of the area
+        signatures = {area_key(area.pk): _load_area_signature(area.pk)
+                      for area in AreaOfInterest.objects.filter(osmlayer__isnull=False).distinct()}
+    else:
+        signatures = {pair_key(layer.pk, area.pk): _load_signature(layer.pk, area.pk)
+                      for layer in OsmLayer.objects.all()
+                      for area in layer.areas.all()}
+
+    # Loads that are already queued or running are skipped
+    claimed = [signature for key, signature in signatures.items() if claim(key)]
+    if len(claimed) < len(signatures):
+        logger.info(f"Skipped {len(signatures) - len(claimed)} loads that are already in flight")
+    g = group(claimed)
 
     if not settings.IN_INTEGRATION_TEST:
-        # Using queue with concurrency of 1 to avoid problems with the Overpass API
-        g.apply_async(queue='network')
+        # Using queue with concurrency of 1 for Overpass queries to avoid problems with the Overpass API
+        g.apply_async()
     else:
         g.apply()
 
 
-@shared_task(rate_limit='10/s', autoretry_for=(TooManyRequests,), retry_backoff=2, retry_backoff_max=60,
-             max_retries=4)
+@shared_task
+def schedule_osm_data():
+    """
+    Task to load OSM data only for the layers and areas that are due for a refresh. Runs periodically and
+    spreads the loading over the time until the next run.
+    :return: number of refreshed layer and area pairs
+    """
+    now = timezone.now()
+    states = get_due_states(now)
+    window = datetime.timedelta(minutes=settings.OSM_SCHEDULER_INTERVAL_MINUTES)
+
+    scheduled = []
+    for state, countdown in plan_refreshes(states, window):
+        if settings.OSM_COMBINED_AREA_QUERIES:
+            # All the layers of the area are refreshed with the first due one, the others are already claimed
+            key, signature = area_key(state.area_id), _load_area_signature(state.area_id)
+        else:
+            key, signature = pair_key(state.layer_id, state.area_id), _load_signature(state.layer_id, state.area_id)
+        if not claim(key):
+            logger.debug(f"Load of {key} is already in flight")
+            continue
+
+        scheduled.append(state.pk)
+        if not settings.IN_INTEGRATION_TEST:
+            signature.apply_async(countdown=countdown)
+        else:
+            signature.apply()
+
+    OsmSyncState.objects.filter(pk__in=scheduled).update(last_scheduled=now)
+    logger.info(f"Scheduled {len(scheduled)} layer and area pairs to be refreshed")
+    return len(scheduled)
+
+
+def _pair_load_key(layer_id, area_id):
+    return pair_key(layer_id, area_id)
+
+
+def _area_load_key(area_id):
+    return area_key(area_id)
+
+
+def _stage_load_key(result):
+    # Stages after the fetch get the result of the previous stage
+    return pair_key(result['layer_id'], result['area_id']) if result is not None else None
+
+
+class LoadTask(Task):
+    """
+    Task that loads a layer and area, or its stage. Releases the claim of the load if the task fails for good,
+    so that the load can be enqueued again right away. Tasks give the key of the claim with load_key option.
+    """
+    load_key = None
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        key = self.load_key(*args, **kwargs) if self.load_key is not None else None
+        if key is not None:
+            release_claim(key)
+
+
+@shared_task(base=LoadTask, load_key=staticmethod(_pair_load_key), autoretry_for=(TooManyRequests, LockNotAcquired),
+             retry_backoff=2, retry_backoff_max=60, max_retries=4)
 def load_osm_data_for_area(layer_id, area_id):
     """
     Load OSM data for given layer and area
     :param layer_id: OsmLayer pk
     :param area_id: AreaOfInterest pk
-    :return: completion status
+    :return: completion status and timings of the phases
     """
     loader = OsmLoader()
     layer = OsmLayer.objects.get(pk=layer_id)
     area = AreaOfInterest.objects.get(pk=area_id)
 
     try:
-        succeeded = loader.populate(layer, area)
-        return succeeded
+        with LeasedLock(pair_key(layer_id, area_id)), SpanRecorder(layer=layer_id, area=area_id) as recorder:
+            succeeded = loader.populate(layer, area, incremental=settings.OSM_INCREMENTAL_SYNC)
+    except LockNotAcquired:
+        logger.info("Layer and area are being loaded by another worker, retrying later...")
+        raise
     except Exception:
         logger.exception("Uncaught error occurred while loading osm data")
         raise
+
+    release_claim(pair_key(layer_id, area_id))
+    return _finish_load(succeeded, layer_id, area_id, recorder.as_list())
+
+
+@shared_task(base=LoadTask, load_key=staticmethod(_area_load_key), autoretry_for=(TooManyRequests, LockNotAcquired),
+             retry_backoff=2, retry_backoff_max=60, max_retries=4)
+def load_osm_data_for_area_layers(area_id):
+    """
+    Load OSM data for all layers of the given area with a single Overpass query
+    :param area_id: AreaOfInterest pk
+    :return: completion status and timings of the phases for each layer pk
+    """
+    loader = OsmLoader()
+    area = AreaOfInterest.objects.get(pk=area_id)
+
+    layers = list(OsmLayer.objects.filter(areas=area))
+
+    try:
+        with lock_pairs((layer.pk, area_id) for layer in layers), SpanRecorder(area=area_id) as recorder:
+            results = loader.populate_area(area, layers)
+    except LockNotAcquired:
+        logger.info("Layer and area are being loaded by another worker, retrying later...")
+        raise
+    except Exception:
+        logger.exception("Uncaught error occurred while loading osm data")
+        raise
+
+    release_claim(area_key(area_id))
+    spans = _group_spans_by_layer(recorder.as_list())
+    # Fetch, translate and upsert are shared by the layers, so each layer is charged its share of them
+    return {layer.pk: _finish_load(results.get(layer.pk, False), layer.pk, area_id, spans.get(layer.pk, []),
+                                   spans.get(None, []), len(layers))
+            for layer in layers}
+
+
+@shared_task(base=LoadTask, load_key=staticmethod(_pair_load_key), autoretry_for=(TooManyRequests,), retry_backoff=2,
+             retry_backoff_max=60, max_retries=4)
+def fetch_osm_data(layer_id, area_id):
+    """
+    Fetch stage of loading OSM data for given layer and area. Downloads the data to the staging directory.
+    :param layer_id: OsmLayer pk
+    :param area_id: AreaOfInterest pk
+    :return: fetch result for parse_osm_data or None if there is nothing to load
+    """
+    layer = OsmLayer.objects.get(pk=layer_id)
+    area = AreaOfInterest.objects.get(pk=area_id)
+
+    # Each attempt gets its own directory so that retries never see files of a failed attempt
+    dir_path = os.path.join(settings.OSM_STAGING_DIR, f"{layer_id}_{area_id}_{uuid.uuid4().hex}")
+    os.makedirs(dir_path)
+    try:
+        with SpanRecorder(layer=layer_id, area=area_id) as recorder:
+            fetched = OsmLoader().fetch(layer, area, dir_path, incremental=settings.OSM_INCREMENTAL_SYNC)
+    except Exception:
+        shutil.rmtree(dir_path, ignore_errors=True)
+        logger.exception("Uncaught error occurred while fetching osm data")
+        raise
+
+    if fetched is None:
+        shutil.rmtree(dir_path, ignore_errors=True)
+        release_claim(pair_key(layer_id, area_id))
+        return None
+    return {**fetched, 'layer_id': layer_id, 'area_id': area_id, 'dir': dir_path, 'spans': recorder.as_list()}
+
+
+@shared_task(base=LoadTask, load_key=staticmethod(_stage_load_key), autoretry_for=(OSError,), retry_backoff=2,
+             max_retries=2)
+def parse_osm_data(fetched):
+    """
+    Parse stage of loading OSM data. Reads the features of the fetched files to feature rows.
+    :param fetched: result of fetch_osm_data
+    :return: parse result for sync_osm_data or None if there is nothing to load
+    """
+    if fetched is None:
+        return None
+
+    parsed_path = os.path.join(fetched['dir'], 'features.jsonl.gz')
+    with SpanRecorder(layer=fetched['layer_id'], area=fetched['area_id']) as recorder:
+        if not os.path.exists(parsed_path):
+            # Written under temporary name so that a retried task never reads partial rows
+            tmp_path = f"{parsed_path}.tmp"
+            count = OsmLoader(output_format=OutputFormat(fetched['format'])).parse(fetched['files'], tmp_path)
+            os.replace(tmp_path, parsed_path)
+            logger.debug(f"Parsed {count} features to {parsed_path}")
+    return {**fetched, 'parsed': parsed_path, 'spans': fetched['spans'] + recorder.as_list()}
+
+
+@shared_task(base=LoadTask, load_key=staticmethod(_stage_load_key), autoretry_for=(OperationalError, LockNotAcquired),
+             retry_backoff=2, retry_backoff_max=60, max_retries=4)
+def sync_osm_data(parsed):
+    """
+    Sync stage of loading OSM data. Saves the parsed feature rows and removes the staged files.
+    :param parsed: result of parse_osm_data
+    :return: completion status and timings of the phases of all the stages, or None if there was nothing to load
+    """
+    if parsed is None:
+        return None
+    key = pair_key(parsed['layer_id'], parsed['area_id'])
+    if not os.path.exists(parsed['parsed']):
+        logger.warning(f"Staged files in {parsed['dir']} are already synchronized or removed")
+        release_claim(key)
+        return _finish_load(False, parsed['layer_id'], parsed['area_id'], parsed['spans'])
+
+    layer = OsmLayer.objects.get(pk=parsed['layer_id'])
+    area = AreaOfInterest.objects.get(pk=parsed['area_id'])
+
+    try:
+        with LeasedLock(key), SpanRecorder(layer=layer.pk, area=area.pk) as recorder:
+            succeeded = OsmLoader.synchronize(layer, area, read_feature_rows(parsed['parsed']), parsed)
+    except LockNotAcquired:
+        logger.info("Layer and area are being loaded by another worker, retrying later...")
+        raise
+    except Exception:
+        logger.exception("Uncaught error occurred while synchronizing osm data")
+        raise
+
+    shutil.rmtree(parsed['dir'], ignore_errors=True)
+    release_claim(key)
+    return _finish_load(succeeded, layer.pk, area.pk, parsed['spans'] + recorder.as_list())
+
+
+@shared_task(autoretry_for=(LockNotAcquired,), retry_backoff=2, retry_backoff_max=60, max_retries=10)
+def reclassify_osm_layer(layer_id):
+    """
+    Update layer relations of already stored features after the tags of the layer have changed
+    :param layer_id: OsmLayer pk
+    :return: number of features in the layer
+    """
+    layer = OsmLayer.objects.get(pk=layer_id)
+    with lock_pairs((layer_id, area.pk) for area in layer.areas.all()):
+        ids, new_ids = OsmLoader.reclassify(layer)
+    return len(ids)
+
+
+@shared_task
+def import_osm_extract_file(path, processes=None):
+    """
+    Import features of all layers from OSM extract
+    :param path: Path to the extract
+    :param processes: Number of worker processes
+    :return: number of features in each layer pk
+    """
+    try:
+        return import_osm_extract(path, processes)
+    except Exception:
+        logger.exception(f"Uncaught error occurred while importing {path}")
+        raise
+
+
+def _load_signature(layer_id, area_id):
+    if settings.OSM_STAGED_LOADING:
+        # Network queue only downloads, so the next area is fetched while the previous one is parsed and saved
+        return chain(fetch_osm_data.s(layer_id, area_id).set(queue='network'),
+                     parse_osm_data.s().set(queue='cpu'),
+                     sync_osm_data.s().set(queue='db'))
+    return load_osm_data_for_area.s(layer_id, area_id).set(queue='network')
+
+
+def _load_area_signature(area_id):
+    return load_osm_data_for_area_layers.s(area_id).set(queue='network')
+
+
+def _group_spans_by_layer(spans):
+    # Nested spans are recorded before the top level span that contains them
+    grouped, nested = {}, []
+    for record in spans:
+        nested.append(record)
+        if '.' not in record['span']:
+            grouped.setdefault(record.get('layer'), []).extend(nested)
+            nested = []
+    return grouped
+
+
+def _finish_load(succeeded, layer_id, area_id, spans, shared_spans=(), shared_by=1):
+    duration = total_duration(spans) + total_duration(shared_spans) / shared_by
+    spans = list(shared_spans) + spans
+    if succeeded:
+        # Scheduler spreads the refreshes by their cost
+        OsmSyncState.objects.filter(layer_id=layer_id, area_id=area_id).update(last_duration=duration)
+    # Durations are in the task result so that the slowest layers and areas can be ranked from the result backend
+    return {'succeeded': succeeded, 'layer_id': layer_id, 'area_id': area_id, 'duration': duration, 'spans': spans}
@@ -0,0 +1,402 @@
+import datetime
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import tempfile
+import time
+import tracemalloc
+from typing import Iterable, Set, Tuple
+
+from django.conf import settings
+from django.contrib.gis.geos import GEOSGeometry, Point, Polygon
+from django.db import connection
+from django.test import TestCase, SimpleTestCase, tag
+from django.test.utils import CaptureQueriesContext
+
+from .bulk import upsert_features
+from .models import OsmLayer, AreaOfInterest
+from .opening_hours import parse_opening_hours
+from .osm_loader import OsmLoader
+from .overpass_standin import scale_osm_file
+from .tag_matcher import compile_tags, split_tag
+from .tests import read_test_data, TEST_POLYGON
+from .utils import GeomType, OsmFeatureRecord, IS_CURRENTLY_OPEN_FUNCTION, OPENING_HOURS_FUNCTIONS
+
+logger = logging.getLogger(__name__)
+
+# Sizes of the synthetic datasets, for example BENCHMARK_SIZES=10000,100000,1000000
+BENCHMARK_SIZES = [int(size) for size in os.environ.get("BENCHMARK_SIZES", "10000").split(",") if size]
+BENCHMARK_RESULTS = os.environ.get("BENCHMARK_RESULTS",
+                                   os.path.join(settings.BASE_DIR, "logs", "benchmark_results.json"))
+BENCHMARK_BASELINE = os.environ.get("BENCHMARK_BASELINE",
+                                    os.path.join(settings.DATA_DIR, "benchmarks", "baseline.json"))
+# Relative drop of the normalized throughput compared to the baseline that fails the benchmark. Throughputs are
+# divided by the rate of a reference workload measured in the same run, so that a slower or busier runner does not
+# show up as a regression.
+BENCHMARK_TOLERANCE = float(os.environ.get("BENCHMARK_TOLERANCE", 0.25))
+# Throughput of smaller datasets is dominated by fixed costs and is only reported
+BENCHMARK_MIN_FEATURES = int(os.environ.get("BENCHMARK_MIN_FEATURES", 1000))
+REFERENCE_ROWS = 20000
+# BENCHMARK_UPDATE_BASELINE=1 stores the results as the new baseline instead of comparing against it
+BENCHMARK_UPDATE_BASELINE = bool(int(os.environ.get("BENCHMARK_UPDATE_BASELINE", 0)))
+
+
+def _synchronize_features_per_object(layer: OsmLayer, area: AreaOfInterest,
+                                     features: Iterable[OsmFeatureRecord]) -> Tuple[Set, Set]:
+    """
+    Original synchronization that saves the features one by one with the ORM, used as the reference
+    of the batched synchronization
+    :param layer: OsmLayer object
+    :params area: AreaOfInterest object
+    :param features: OsmFeatureRecords
+    :return: all ids and new ids as sets
+    """
+    existing_ids_dict = layer.get_related(area)
+
+    id_dict = GeomType.get_empty_dict()
+    for feature in features:
+        osmid = feature.osmid
+        geom_type = feature.geom_type
+        values = {'tags': feature.tags, 'geom': GEOSGeometry(memoryview(feature.geom), srid=settings.SRID)}
+        if geom_type == GeomType.LINE:
+            values["z_order"] = feature.z_order
+
+        obj, created = geom_type.osm_model.objects.update_or_create(pk=osmid, defaults=values)
+        id_dict[geom_type].add(osmid)
+
+        if created:
+            logger.debug(f"New {geom_type.name} created: {osmid}")
+
+        if layer not in obj.layers.all():
+            obj.layers.add(layer)
+            obj.save()
+
+    all_ids = set()
+    new_ids = set()
+
+    for geom_type, ids in id_dict.items():
+        existing_ids = existing_ids_dict[geom_type]
+        old_ids = existing_ids.difference(ids)
+        all_ids = all_ids.union(ids)
+        new_ids = new_ids.union(ids.difference(existing_ids))
+
+        if len(old_ids):
+            # Remove layer from features that do not belong to it anymore
+            # There might have been tag changes that cause otherwise existing feature
+            # to not appear in the query
+            for feat in geom_type.osm_model.objects.filter(pk__in=old_ids):
+                feat.remove_from_layer(layer)
+
+        if len(ids):
+            # Create views
+            layer.add_support_for_type(geom_type)
+        else:
+            layer.remove_support_from_type(geom_type)
+
+    return all_ids, new_ids
+
+
+def _write_results(path: str, section: str, results: dict) -> None:
+    """
+    Replaces a section of the results file, so that the results of the other benchmark classes are kept
+    :param path: results file
+    :param section: name of the section, for example the name of the benchmark class
+    :param results: results of the section
+    """
+    output = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            output = json.load(f)
+    output[section] = {'created': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'results': results}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(output, f, indent=2)
+
+
+def _measure_reference_rate(rounds: int = 3) -> float:
+    """
+    Measures a fixed workload that does not use the loader code: building rows with GEOS and json in Python and
+    inserting them to a temporary table in one statement
+    :param rounds: number of measurements, the fastest one is used
+    :return: rows per second
+    """
+    point = Point(24.5, 60.3, srid=settings.SRID)
+    best = 0.0
+    with connection.cursor() as cursor:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            ids = list(range(REFERENCE_ROWS))
+            tags = [json.dumps({'name': str(i)}) for i in ids]
+            geoms = [GEOSGeometry(memoryview(point.wkb), srid=settings.SRID).hex for _ in ids]
+            cursor.execute("CREATE TEMPORARY TABLE benchmark_reference (id integer, tags jsonb, geom geometry)")
+            cursor.execute("INSERT INTO benchmark_reference SELECT * FROM unnest(%s::integer[], %s::jsonb[], "
+                           "%s::geometry[])", [ids, tags, geoms])
+            cursor.execute("DROP TABLE benchmark_reference")
+            best = max(best, REFERENCE_ROWS / (time.perf_counter() - start))
+    return best
+
+
+class BenchmarkResultsMixin:
+    """
+    Collects the results of the benchmark class to its own section of BENCHMARK_RESULTS
+    """
+    results: dict
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.results = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        _write_results(BENCHMARK_RESULTS, cls.__name__, cls.results)
+        super().tearDownClass()
+
+
+@tag("benchmark")  # ./manage.py test --tag=benchmark
+class SynchronizationBenchmarks(BenchmarkResultsMixin, TestCase):
+    def setUp(self) -> None:
+        self.area = AreaOfInterest.objects.create(name="Test", bbox=TEST_POLYGON)
+        self.layer = OsmLayer.objects.create(name="Hiking", tags=["route=hiking"])
+        self.layer.areas.add(self.area)
+        self.loader = OsmLoader()
+        self.features = list(self.loader._read_features(read_test_data("hiking_routes.osm")))
+
+    def test_batched_synchronization_against_per_object(self):
+        per_object = self._measure(_synchronize_features_per_object)
+        for geom_type in GeomType:
+            geom_type.osm_model.objects.all().delete()
+        batched = self._measure(self.loader._synchronize_features)
+
+        self.results["hiking_routes.osm"] = {'features': len(self.features), 'per_object': per_object,
+                                             'batched': batched}
+        logger.info(f"hiking_routes.osm ({len(self.features)} features): "
+                    f"per object {per_object['features_per_second']:.0f} features/s {per_object['queries']} queries, "
+                    f"batched {batched['features_per_second']:.0f} features/s {batched['queries']} queries")
+        self.assertLess(batched['queries'], per_object['queries'])
+        # Both are measured in the same run, so the comparison does not depend on the speed of the runner
+        self.assertGreater(batched['features_per_second'], per_object['features_per_second'])
+
+    def _measure(self, synchronize) -> dict:
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            ids, new_ids = synchronize(self.layer, self.area, self.features)
+            elapsed = time.perf_counter() - start
+        self.assertEqual(len(ids), len(self.features))
+        return {'features_per_second': len(self.features) / elapsed, 'queries': len(context.captured_queries)}
+
+
+@tag("benchmark")
+class IngestionBenchmarks(BenchmarkResultsMixin, TestCase):
+    """
+    Measures wall time, peak Python memory, throughput and SQL query count of each ingestion phase. Results are
+    written to BENCHMARK_RESULTS and compared against BENCHMARK_BASELINE. More queries or a lower normalized
+    throughput than in the baseline fail the tests.
+    """
+    baseline = {}
+    reference_rate: float
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp_dir = tempfile.mkdtemp()
+        if os.path.exists(BENCHMARK_BASELINE):
+            with open(BENCHMARK_BASELINE) as f:
+                cls.baseline = json.load(f).get(cls.__name__, {}).get('results', {})
+        cls.reference_rate = _measure_reference_rate()
+        cls.results['reference'] = {'rows': REFERENCE_ROWS, 'rows_per_second': cls.reference_rate}
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+        if BENCHMARK_UPDATE_BASELINE:
+            _write_results(BENCHMARK_BASELINE, cls.__name__, cls.results)
+        super().tearDownClass()
+
+    def setUp(self) -> None:
+        # Covers the synthetic copies that are shifted from the original coordinates
+        self.area = AreaOfInterest.objects.create(name="Finland", bbox=Polygon.from_bbox((19, 59, 32, 71)))
+        self.loader = OsmLoader()
+
+    def test_fixtures(self):
+        for fixture in ("firepit.osm", "hiking_routes.osm", "administrative_boundary.osm"):
+            with self.subTest(dataset=fixture):
+                self._benchmark(fixture, os.path.join(settings.TEST_DATA_DIR, fixture))
+
+    def test_synthetic_datasets(self):
+        source = os.path.join(settings.TEST_DATA_DIR, "hiking_routes.osm")
+        source_size = len(list(self.loader._read_features_from_file(source)))
+        queries = {}
+        for size in BENCHMARK_SIZES:
+            name = f"synthetic_{size}"
+            with self.subTest(dataset=name):
+                path = os.path.join(self.tmp_dir, f"{name}.osm")
+                scale_osm_file(source, path, math.ceil(size / source_size))
+                self._benchmark(name, path)
+                queries[name] = {phase: result['queries'] for phase, result in self.results[name]['phases'].items()}
+
+        # Copies of the same data are loaded with the same queries regardless of their number
+        self.assertEqual(len(set(map(json.dumps, queries.values()))), 1, f"Query counts depend on the size: {queries}")
+
+    def _benchmark(self, name: str, path: str) -> None:
+        for geom_type in GeomType:
+            geom_type.osm_model.objects.all().delete()
+        # Each dataset gets a new layer, so that the views and statistics of the previous one are not reused
+        layer = OsmLayer.objects.create(name=re.sub(r'\W', '_', name), tags=["route=hiking"])
+        layer.areas.add(self.area)
+
+        phases = {}
+        features, phases['parse'] = self._measure(lambda: list(self.loader._read_features_from_file(path)))
+        count = len(features)
+        (ids, new_ids), phases['first_load'] = self._measure(
+            lambda: self.loader._synchronize_features(layer, self.area, features))
+        self.assertEqual(len(new_ids), len(ids))
+        (ids, new_ids), phases['noop_resync'] = self._measure(
+            lambda: self.loader._synchronize_features(layer, self.area, features))
+        self.assertEqual(len(new_ids), 0)
+        kept = features[:int(count * 0.9)]
+        _, phases['partial_delete_resync'] = self._measure(
+            lambda: self.loader._synchronize_features(layer, self.area, kept))
+
+        for phase in phases.values():
+            phase['features_per_second'] = count / phase['wall_time'] if phase['wall_time'] else None
+            phase['normalized_throughput'] = (phase['features_per_second'] / self.reference_rate
+                                              if phase['features_per_second'] else None)
+        self.results[name] = {'features': count, 'phases': phases}
+
+        logger.info(f"{name} ({count} features): " + ", ".join(
+            f"{phase} {result['features_per_second']:.0f} features/s {result['queries']} queries "
+            f"{result['peak_memory'] / 2 ** 20:.1f} MiB" for phase, result in phases.items()))
+        self._compare_to_baseline(name)
+
+    @staticmethod
+    def _measure(function):
+        # tracemalloc only sees the Python allocations, GDAL and the database are not included
+        tracemalloc.start()
+        try:
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                result = function()
+                wall_time = time.perf_counter() - start
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return result, {'wall_time': wall_time, 'peak_memory': peak_memory, 'queries': len(context.captured_queries)}
+
+    def _compare_to_baseline(self, name: str) -> None:
+        if BENCHMARK_UPDATE_BASELINE:
+            return
+        if name not in self.baseline:
+            logger.warning(f"{name} is not in the baseline {BENCHMARK_BASELINE}")
+            return
+        for phase, result in self.results[name]['phases'].items():
+            expected = self.baseline[name]['phases'].get(phase)
+            if expected is None:
+                continue
+            self.assertLessEqual(result['queries'], expected['queries'],
+                                 f"{name} {phase}: more SQL queries than in the baseline")
+            if self.results[name]['features'] < BENCHMARK_MIN_FEATURES or not (
+                    expected.get('normalized_throughput') and result['normalized_throughput']):
+                continue
+            self.assertGreaterEqual(
+                result['normalized_throughput'], expected['normalized_throughput'] * (1 - BENCHMARK_TOLERANCE),
+                f"{name} {phase}: {result['features_per_second']:.0f} features/s is slower than the baseline "
+                f"relative to the reference workload ({result['normalized_throughput']:.3f} < "
+                f"{expected['normalized_throughput']:.3f})")
+
+
+@tag("benchmark")
+class TagMatcherBenchmarks(BenchmarkResultsMixin, SimpleTestCase):
+    def test_compiled_matcher_against_per_tag_predicates(self):
+        with open(os.path.join(settings.DATA_DIR, "fixtures", "TBR_tags.json")) as f:
+            layer_tags = [json.loads(obj['fields']['tags']) for obj in json.load(f) if obj['model'] == 'datahub.osmlayer']
+        feature_tags = [feature.tags for fixture in ("firepit.osm", "hiking_routes.osm", "administrative_boundary.osm")
+                        for feature in OsmLoader._read_features(read_test_data(fixture))]
+        feature_tags += [{tag.split('=')[0].strip('~'): tag.split('=')[-1], 'name': 'Synthetic'}
+                         for tags in layer_tags for tag in tags]
+
+        naive = [[self._compile_naive(tag) for tag in tags] for tags in layer_tags]
+        compiled = [compile_tags(tags) for tags in layer_tags]
+
+        naive_rate, naive_matches = self._matches_per_second(
+            lambda tags: [any(predicate(tags) for predicate in predicates) for predicates in naive], feature_tags)
+        compiled_rate, compiled_matches = self._matches_per_second(
+            lambda tags: [matcher(tags) for matcher in compiled], feature_tags)
+
+        self.results["TBR_tags.json"] = {'layers': len(layer_tags), 'features': len(feature_tags),
+                                         'per_tag_features_per_second': naive_rate,
+                                         'compiled_features_per_second': compiled_rate}
+        logger.info(f"TBR_tags.json ({len(layer_tags)} layers, {len(feature_tags)} features): "
+                    f"per tag {naive_rate:.0f} features/s, compiled {compiled_rate:.0f} features/s")
+        self.assertEqual(naive_matches, compiled_matches)
+
+    @staticmethod
+    def _compile_naive(tag: str):
+        # Straightforward evaluation that compiles regexes on every call
+        key, sep, value = split_tag(tag)
+        if sep is None or value == '*':
+            return lambda tags: key in tags
+        elif sep == '=':
+            return lambda tags: tags.get(key) == value
+        return lambda tags: key in tags and re.search(value, tags[key]) is not None
+
+    @staticmethod
+    def _matches_per_second(match, feature_tags, rounds=20):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            matches = [match(tags) for tags in feature_tags]
+        elapsed = time.perf_counter() - start
+        return rounds * len(feature_tags) / elapsed, matches
+
+
+@tag("benchmark")
+class OpeningHoursBenchmarks(BenchmarkResultsMixin, TestCase):
+    def setUp(self) -> None:
+        with open(os.path.join(settings.TEST_DATA_DIR, "opening_hours.txt")) as f:
+            self.samples = [line.strip() for line in f if line.strip()]
+        geom = Point(24.5, 60.3).hex
+        rows = {osmid: ({'opening_hours': self.samples[osmid % len(self.samples)]}, geom, 0)
+                for osmid in range(1, BENCHMARK_SIZES[0] + 1)}
+
+        start = time.perf_counter()
+        upsert_features(GeomType.POINT, rows)
+        self.ingest_rate = len(rows) / (time.perf_counter() - start)
+        with connection.cursor() as cursor:
+            cursor.execute(IS_CURRENTLY_OPEN_FUNCTION + OPENING_HOURS_FUNCTIONS)
+            cursor.execute("ANALYZE datahub_osmpoint, datahub_openinghoursinterval")
+
+    def test_parser(self):
+        start = time.perf_counter()
+        for _ in range(100):
+            for value in self.samples:
+                parse_opening_hours(value)
+        rate = 100 * len(self.samples) / (time.perf_counter() - start)
+        self.results["opening_hours.txt"] = {'values': len(self.samples), 'values_per_second': rate,
+                                             'ingested_features_per_second': self.ingest_rate}
+        logger.info(f"opening_hours.txt ({len(self.samples)} values): parsed {rate:.0f} values/s, "
+                    f"ingested {self.ingest_rate:.0f} features/s")
+
+    def test_precomputed_intervals_against_plpgsql_function(self):
+        plpgsql_rate, plpgsql_open = self._rows_per_second(
+            "is_currently_open(tags->>'opening_hours')")
+        intervals_rate, intervals_open = self._rows_per_second(
+            "CASE WHEN tags->>'opening_hours' IS NOT NULL THEN is_open('POINT', osmid) END")
+
+        self.results["currently_open"] = {'features': BENCHMARK_SIZES[0],
+                                          'plpgsql_rows_per_second': plpgsql_rate, 'plpgsql_open': plpgsql_open,
+                                          'intervals_rows_per_second': intervals_rate, 'intervals_open': intervals_open}
+        logger.info(f"currently_open of {BENCHMARK_SIZES[0]} features: plpgsql {plpgsql_rate:.0f} rows/s "
+                    f"({plpgsql_open} open), intervals {intervals_rate:.0f} rows/s ({intervals_open} open)")
+
+    @staticmethod
+    def _rows_per_second(currently_open: str, rounds=5):
+        with connection.cursor() as cursor:
+            start = time.perf_counter()
+            for _ in range(rounds):
+                cursor.execute(f"SELECT count(*), count(*) FILTER (WHERE {currently_open}) FROM datahub_osmpoint")
+                count, open_count = cursor.fetchone()
+            elapsed = time.perf_counter() - start
+        return rounds * count / elapsed, open_count
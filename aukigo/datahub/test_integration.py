@@ -1,4 +1,5 @@
 import logging
+import uuid
 from unittest.mock import patch
 
 from django.test import TestCase, tag, override_settings
@@ -15,7 +16,7 @@ def mocked_exception(*args, **kwargs):
 
 
 @tag("integration")  # ./manage.py test --exclude-tag=integration & ./manage.py test --tag=integration
-@override_settings(IN_INTEGRATION_TEST=True)
+@override_settings(IN_INTEGRATION_TEST=True, LOCK_KEY_PREFIX=f"aukigo-test-{uuid.uuid4().hex}")
 class DatahubIntegrationTests(TestCase):
     # names: camping, tourism, tourism2
     fixtures = ['camping.json']
@@ -29,7 +30,7 @@ class DatahubIntegrationTests(TestCase):
 
         self.assertGreater(Tileset.objects.count(), 3)  # At least one geom type for each
 
-    @patch("datahub.osm_loader.OsmLoader.populate", side_effect=mocked_exception)
+    @patch("datahub.osm_loader.OsmLoader.fetch", side_effect=mocked_exception)
     def test_load_osm_retries_when_error_occurs(self, mocked_loader):
         # This test probably expects that Celery is running
         load_osm_data()
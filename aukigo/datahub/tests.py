@@ -1,19 +1,55 @@
+import datetime
+import io
 import json
 import os
+import shutil
+import tempfile
+import time
+import types
+import uuid
+from unittest.mock import patch
 
 from django.conf import settings
-from django.contrib.gis.geos import Polygon
-from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Polygon, GEOSGeometry
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
-from .models import OsmLayer, AreaOfInterest, OsmPoint, OsmLine, OsmPolygon
+from .bbox_planner import split_bbox, split_bbox_to_depth, estimate_split_depth
+from .exeptions import LockNotAcquired
+from .locks import LeasedLock, claim, release_claim, pair_key, area_key
+from .bulk import (add_layer_membership, remove_layer_membership, write_feature_rows, read_feature_rows,
+                   upsert_features)
+from .metrics import get_registry
+from .models import (OsmLayer, AreaOfInterest, OsmPoint, OsmLine, OsmPolygon, OsmSyncState, OverpassEndpoint,
+                     OpeningHoursInterval)
+from .opening_hours import parse_opening_hours, MINUTES_IN_WEEK
+from .osm_extract import import_osm_extract
 from .osm_loader import OsmLoader
+from .overpass_cache import OverpassCache
+from .overpass_endpoints import EndpointPool
+from .overpass_fetcher import parse_status, OverpassStatus
+from .partitions import is_partitioned, get_partition_name, create_layer_partitions
+from .scheduler import get_due_states, plan_refreshes
+from .overpass_standin import (recorded_overpass, overpass_status, osm_xml_to_overpass_elements, scale_osm_file,
+                               Faults)
+from .overpass_json import elements_to_features, assemble_rings, compute_z_order
+from .spans import SpanRecorder, span, total_duration
+from .tag_matcher import compile_tag, compile_tags
+from .tasks import (fetch_osm_data, parse_osm_data, sync_osm_data, load_osm_data, reclassify_osm_layer,
+                    schedule_osm_data, load_osm_data_for_area, load_osm_data_for_area_layers)
 from .utils import (overpass_bbox_to_polygon, polygon_to_overpass_bbox, osm_tags_to_dict, GeomType,
-                    model_tag_to_overpass_tag)
+                    model_tag_to_overpass_tag, OutputFormat)
 
 TEST_POLYGON = Polygon(((24.499, 60.260), (24.499, 60.352), (24.668, 60.352), (24.668, 60.260), (24.499, 60.260)),
                        srid=settings.SRID)
 TEST_BBOX = (60.260, 24.499, 60.352, 24.668)
+# Locks and claims of the previous runs do not affect the tests
+TEST_LOCK_KEY_PREFIX = f"aukigo-test-{uuid.uuid4().hex}"
 
 
 class UtilsTests(TestCase):
@@ -34,6 +70,39 @@ class UtilsTests(TestCase):
         tags = osm_tags_to_dict(tag_string)
         self.assertEqual(tags, {"1": "1", "2": "long line with, commas"})
 
+    def test_tag_matcher(self):
+        tags = {'tourism': 'hotel', 'addr:city': 'Turku'}
+        matching = ["tourism=hotel", "tourism~[hm]o.?tel", "~addr:.*~Tur", "tourism=*", "tourism", "addr:city=Turku"]
+        not_matching = ["tourism=motel", "tourism~^tel", "~name~.*", "amenity=*", "amenity"]
+        for tag in matching:
+            self.assertTrue(compile_tag(tag)(tags), tag)
+        for tag in not_matching:
+            self.assertFalse(compile_tag(tag)(tags), tag)
+        self.assertTrue(compile_tags(["amenity", "tourism=hotel"])(tags))
+        self.assertFalse(compile_tags([])(tags))
+
+    def test_split_bbox(self):
+        quadrants = split_bbox(self.bbox)
+        self.assertEqual(len(quadrants), 4)
+        self.assertAlmostEqual(sum(overpass_bbox_to_polygon(q).area for q in quadrants), self.polygon.area)
+        self.assertEqual(len(split_bbox_to_depth(self.bbox, 2)), 16)
+
+    def test_estimate_split_depth(self):
+        self.assertEqual(estimate_split_depth(100, 1000, 3), 0)
+        self.assertEqual(estimate_split_depth(3000, 1000, 3), 1)
+        self.assertEqual(estimate_split_depth(5000, 1000, 3), 2)
+        self.assertEqual(estimate_split_depth(10 ** 9, 1000, 3), 3)
+
+    def test_assemble_rings(self):
+        segments = [[(0, 0), (1, 0)], [(1, 1), (1, 0)], [(1, 1), (0, 1), (0, 0)], [(5, 5), (6, 6)]]
+        rings = assemble_rings(segments)
+        self.assertEqual(len(rings), 1)
+        self.assertEqual(Polygon(rings[0]).area, 1)
+
+    def test_compute_z_order(self):
+        self.assertEqual(compute_z_order({'highway': 'primary', 'bridge': 'yes', 'layer': '1'}), 27)
+        self.assertEqual(compute_z_order({'highway': 'path', 'layer': 'invalid'}), 0)
+
     def test_model_tags_to_overpass_tags(self):
         tags = {"key=value", "key:value", "key~val.*", "~key~val", "key=*", "key"}
         expected = {'"key"="value"', '"key":"value"', '"key"~"val.*"', '"~key"~"val"', '"key"'}
@@ -41,6 +110,66 @@ class UtilsTests(TestCase):
         self.assertEqual(overpass_tags, expected)
 
 
+class OpeningHoursTests(TestCase):
+    def test_parse_opening_hours(self):
+        self.assertEqual(parse_opening_hours("24/7"), [(0, MINUTES_IN_WEEK)])
+        self.assertEqual(parse_opening_hours("Mo-We 08:00-16:00"), [(480, 960), (1920, 2400), (3360, 3840)])
+        self.assertEqual(parse_opening_hours("Mo,We 10:00-12:00,13:00-14:00"),
+                         [(600, 720), (780, 840), (3480, 3600), (3660, 3720)])
+        self.assertEqual(parse_opening_hours("Mo-Fr 08:00-16:00, Sa 10:00-12:00; Tu-Fr off; PH off"),
+                         [(480, 960), (7800, 7920)])
+        self.assertEqual(parse_opening_hours("Su 22:00-02:00"), [(0, 120), (9960, MINUTES_IN_WEEK)])
+        self.assertEqual(parse_opening_hours("24/7; Su off"), [(0, 6 * 1440)])
+        self.assertEqual(parse_opening_hours("sunrise-sunset"), [])
+        self.assertEqual(parse_opening_hours("Jan-Mar Mo 08:00-16:00; Tu 08:00-16:00"), [(1920, 2400)])
+
+    def test_intervals_are_stored_and_removed_with_features(self):
+        layer = OsmLayer.objects.create(name="test")
+        geom = GEOSGeometry('POINT(24.5 60.3)').hex
+        upsert_features(GeomType.POINT, {1: ({'opening_hours': '24/7'}, geom, 0), 2: ({}, geom, 0),
+                                         3: ({'opening_hours': 'Mo-Fr 08:00-16:00'}, geom, 0)})
+        add_layer_membership(GeomType.POINT, layer.pk, {1, 2, 3})
+        layer.add_support_for_type(GeomType.POINT)
+        self.assertEqual(OpeningHoursInterval.objects.filter(osmid=3).count(), 5)
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT osmid, currently_open FROM osm_test_p WHERE osmid < 3 ORDER BY osmid")
+            self.assertEqual(cursor.fetchall(), [(1, True), (2, None)])
+
+        upsert_features(GeomType.POINT, {3: ({'opening_hours': 'Sa 10:00-12:00'}, geom, 0)})
+        self.assertEqual(list(OpeningHoursInterval.objects.filter(osmid=3).values_list('start_minute', 'end_minute')),
+                         [(7800, 7920)])
+        remove_layer_membership(GeomType.POINT, layer.pk, {1, 2, 3})
+        self.assertFalse(OpeningHoursInterval.objects.exists())
+        layer.delete()
+
+    def test_intervals_are_removed_with_bulk_deleted_features(self):
+        geom = GEOSGeometry('POINT(24.5 60.3)').hex
+        upsert_features(GeomType.POINT, {1: ({'opening_hours': '24/7'}, geom, 0),
+                                         2: ({'opening_hours': 'Mo-Fr 08:00-16:00'}, geom, 0)})
+        upsert_features(GeomType.LINE, {1: ({'opening_hours': '24/7'},
+                                            GEOSGeometry('MULTILINESTRING((24.5 60.3, 24.6 60.4))').hex, 0)})
+        OsmPoint.objects.filter(pk=1).delete()
+        self.assertEqual(set(OpeningHoursInterval.objects.values_list('geom_type', 'osmid')),
+                         {('POINT', 2), ('LINE', 1)})
+        OsmPoint.objects.all().delete()
+        self.assertEqual(list(OpeningHoursInterval.objects.values_list('geom_type', 'osmid')), [('LINE', 1)])
+
+    def test_intervals_are_stored_on_save_only_if_opening_hours_change(self):
+        OsmPoint.objects.create(osmid=1, tags={'opening_hours': '24/7'}, geom='POINT(24.5 60.3)')
+        self.assertEqual(OpeningHoursInterval.objects.filter(osmid=1).count(), 1)
+        point = OsmPoint.objects.get(pk=1)
+        with patch("datahub.models.store_opening_hours") as mocked_store:
+            point.tags['name'] = "Kiosk"
+            point.save()
+            self.assertEqual(mocked_store.call_count, 0)
+            point.tags['opening_hours'] = "Mo-Fr 08:00-16:00"
+            point.save()
+            self.assertEqual(mocked_store.call_count, 1)
+            point.save()
+            self.assertEqual(mocked_store.call_count, 1)
+
+
 @override_settings(VIEW_PREFIX='osm', PG_TILESERV_POSTFIX='/tiles')
 class ModelsTest(TestCase):
 
@@ -61,6 +190,101 @@ class ModelsTest(TestCase):
         self.assertEqual(layer.tilesets.count(), 3)
         layer.delete()
 
+    def test_tileset_is_materialized_and_refreshed(self):
+        layer = OsmLayer.objects.create(name="test")
+        point = OsmPoint.objects.create(osmid=1, tags={'opening_hours': '24/7'}, geom='POINT(24.5 60.3)')
+        point.layers.add(layer)
+        layer.add_support_for_type(GeomType.POINT)
+        OsmPoint.objects.create(osmid=2, tags={}, geom='POINT(24.6 60.3)').layers.add(layer)
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT osmid, currently_open FROM osm_test_p ORDER BY osmid")
+            self.assertEqual(cursor.fetchall(), [(1, True)])
+            layer.add_support_for_type(GeomType.POINT)
+            cursor.execute("SELECT osmid, currently_open FROM osm_test_p ORDER BY osmid")
+            self.assertEqual(cursor.fetchall(), [(1, True), (2, None)])
+            cursor.execute("SELECT indexdef FROM pg_indexes WHERE tablename = 'osm_mv_test_p'")
+            self.assertTrue(any('USING gist (geom)' in row[0] for row in cursor.fetchall()))
+
+            with self.settings(OSM_MATERIALIZED_TILESETS=False):
+                layer.add_support_for_type(GeomType.POINT)
+            cursor.execute("SELECT to_regclass('osm_mv_test_p')")
+            self.assertIsNone(cursor.fetchone()[0])
+            cursor.execute("SELECT count(*) FROM osm_test_p")
+            self.assertEqual(cursor.fetchone()[0], 2)
+        layer.delete()
+
+    def test_views_of_layers_sharing_changed_features_are_refreshed(self):
+        area = AreaOfInterest.objects.create(name="Test", bbox=TEST_POLYGON)
+        layer, other = OsmLayer.objects.create(name="test"), OsmLayer.objects.create(name="other")
+        point = OsmPoint.objects.create(osmid=1, tags={'amenity': 'cafe'}, geom='POINT(24.5 60.3)')
+        point.layers.add(layer, other)
+        layer.add_support_for_type(GeomType.POINT)
+        other.add_support_for_type(GeomType.POINT)
+
+        rows_dict = {GeomType.POINT: {1: ({'amenity': 'restaurant'}, point.geom.hex, 0)},
+                     GeomType.LINE: {}, GeomType.POLYGON: {}}
+        OsmLoader._synchronize_rows(layer, area, rows_dict)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT tags->>'amenity' FROM osm_other_p")
+            self.assertEqual(cursor.fetchall(), [('restaurant',)])
+        other.delete()
+        layer.delete()
+
+    def test_layer_membership_partitioned_by_layer(self):
+        layer = OsmLayer.objects.create(name="test")
+        OsmPoint.objects.create(osmid=1, tags={}, geom='POINT(24.5 60.3)').layers.add(layer)
+        layer.add_support_for_type(GeomType.POINT)
+
+        call_command('partition_layer_membership', stdout=io.StringIO())
+        self.assertTrue(is_partitioned(GeomType.POINT))
+        other = OsmLayer.objects.create(name="other")
+        add_layer_membership(GeomType.POINT, other.pk, {1})
+        add_layer_membership(GeomType.POINT, other.pk, {1})
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT osmpoint_id FROM {get_partition_name(GeomType.POINT, other.pk)}")
+            self.assertEqual(cursor.fetchall(), [(1,)])
+            cursor.execute("SELECT osmid FROM osm_test_p")
+            self.assertEqual(cursor.fetchall(), [(1,)])
+        self.assertEqual(list(layer.get_objects_for_type(GeomType.POINT).values_list('pk', flat=True)), [1])
+
+        other.delete()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)", [get_partition_name(GeomType.POINT, other.pk)])
+            self.assertIsNone(cursor.fetchone()[0])
+        self.assertEqual(list(OsmPoint.objects.get(pk=1).layers.all()), [layer])
+
+        call_command('partition_layer_membership', '--undo', stdout=io.StringIO())
+        self.assertFalse(is_partitioned(GeomType.POINT))
+        self.assertEqual(list(OsmPoint.objects.get(pk=1).layers.all()), [layer])
+        layer.delete()
+
+    def test_memberships_in_default_partition_are_moved_to_layer_partition(self):
+        layer = OsmLayer.objects.create(name="test")
+        OsmPoint.objects.create(osmid=1, tags={}, geom='POINT(24.5 60.3)').layers.add(layer)
+        call_command('partition_layer_membership', stdout=io.StringIO())
+        partition = get_partition_name(GeomType.POINT, layer.pk)
+        with connection.cursor() as cursor:
+            # Memberships of a layer without a partition end up in the default partition
+            cursor.execute(f"ALTER TABLE datahub_osmpoint_layers DETACH PARTITION {partition}")
+            cursor.execute(f"INSERT INTO datahub_osmpoint_layers_default SELECT * FROM {partition}")
+            cursor.execute(f"DROP TABLE {partition}")
+
+        create_layer_partitions(layer.pk)
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT osmpoint_id FROM {partition}")
+            self.assertEqual(cursor.fetchall(), [(1,)])
+            cursor.execute("SELECT count(*) FROM datahub_osmpoint_layers_default")
+            self.assertEqual(cursor.fetchone()[0], 0)
+        self.assertEqual(list(OsmPoint.objects.get(pk=1).layers.all()), [layer])
+
+        # Partitions are only checked when a layer is created
+        with CaptureQueriesContext(connection) as context:
+            layer.save()
+        self.assertFalse(any('pg_partitioned_table' in query['sql'] for query in context.captured_queries))
+        call_command('partition_layer_membership', '--undo', stdout=io.StringIO())
+        layer.delete()
+
     def test_api_serialization(self):
         self.maxDiff = None
         layer = OsmLayer.objects.create(name="test")
@@ -81,19 +305,149 @@ class ModelsTest(TestCase):
                           'style': None}
                          )
 
-class OsmLoadingTests(TestCase):
+    def test_layer_statistics_are_updated_and_prefetched(self):
+        area = AreaOfInterest.objects.create(name="Test", bbox=TEST_POLYGON)
+        geom = GEOSGeometry('POINT(24.5 60.3)').hex
+        upsert_features(GeomType.POINT, {1: ({}, geom, 0), 2: ({}, GEOSGeometry('POINT(24.6 60.34)').hex, 0)})
+        layer = OsmLayer.objects.create(name="test")
+        OsmLoader._synchronize_layer(layer, area, {GeomType.POINT: {1, 2}, GeomType.LINE: set(),
+                                                   GeomType.POLYGON: set()})
+
+        statistics = layer.get_statistics(GeomType.POINT)
+        self.assertEqual(statistics.feature_count, 2)
+        self.assertEqual(statistics.bounds, [24.5, 60.3, 24.6, 60.34])
+        self.assertGreater(statistics.total_bytes, 0)
+        last_modified = statistics.last_modified
+        layer.update_statistics()
+        self.assertEqual(layer.get_statistics(GeomType.POINT).last_modified, last_modified)
+
+        with CaptureQueriesContext(connection) as one_layer:
+            response = self.client.get(reverse("api-root") + "layers/").json()
+        self.assertEqual(response[0]['bounds'], [24.5, 60.3, 24.6, 60.34])
+        other = OsmLayer.objects.create(name="other")
+        OsmLoader._synchronize_layer(other, area, {GeomType.POINT: {2}, GeomType.LINE: set(),
+                                                   GeomType.POLYGON: set()})
+        with CaptureQueriesContext(connection) as two_layers:
+            self.client.get(reverse("api-root") + "layers/")
+        self.assertEqual(len(one_layer), len(two_layers))
+        other.delete()
+        layer.delete()
+
+
+class CampingLayerMixin:
+    """
+    Test area and a firepit layer that covers it, shared by the loading tests
+    """
+    area: AreaOfInterest
+    layer: OsmLayer
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.area = AreaOfInterest.objects.create(name="Test", bbox=TEST_POLYGON)
+        self.layer = OsmLayer.objects.create(name="Camping", tags=["leisure=firepit"])
+        self.layer.areas.add(self.area)
+
+
+@override_settings(OVERPASS_CACHE_ENABLED=False)
+class OsmLoadingTests(CampingLayerMixin, TestCase):
     def setUp(self) -> None:
+        super().setUp()
         self.maxDiff = None
         self.polygon = TEST_POLYGON
         self.bbox = TEST_BBOX
-        self.area = AreaOfInterest.objects.create(name="Test", bbox=self.polygon)
-        self.layer = OsmLayer.objects.create(name="Camping", tags=["leisure=firepit"])
-        self.layer.areas.add(self.area)
-        self.layer.save()
         self.loader = OsmLoader()
 
+    def test_read_features_without_geojson(self):
+        features = self.loader._read_features(read_test_data("administrative_boundary.osm"))
+        self.assertIsInstance(features, types.GeneratorType)
+        geom_types = {GEOSGeometry(memoryview(feature.geom)).geom_type: feature.geom_type for feature in features}
+        self.assertEqual(geom_types, {'Point': GeomType.POINT, 'MultiLineString': GeomType.LINE,
+                                      'MultiPolygon': GeomType.POLYGON})
+
+    def test_populate_waits_for_free_slot(self):
+        statuses = [overpass_status(2, 2), overpass_status(2, 0, next_slot_in=1), overpass_status(2, 1)]
+        with recorded_overpass(["firepit.osm"], statuses) as (url, queries):
+            with self.settings(OVERPASS_API_URLS=[url]):
+                self.assertTrue(self.loader.populate(self.layer, self.area))
+
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(len(statuses), 1)
+        self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 7)
+
+    def test_rejected_query_is_retried(self):
+        with recorded_overpass([429, "firepit.osm"]) as (url, queries):
+            with self.settings(OVERPASS_API_URLS=[url]):
+                self.assertTrue(self.loader.populate(self.layer, self.area))
+
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 7)
+
+    def test_parse_overpass_status(self):
+        self.assertEqual(parse_status(overpass_status(2, 0, next_slot_in=12)), OverpassStatus(2, 0, 12))
+        self.assertEqual(parse_status(overpass_status(2, 2)), OverpassStatus(2, 2, None))
+        self.assertEqual(parse_status(overpass_status(0, 0)).rate_limit, 0)
+
+    def test_json_output_has_feature_parity_with_gdal(self):
+        for fixture in ("firepit.osm", "hiking_routes.osm", "administrative_boundary.osm"):
+            xml_data = read_test_data(fixture)
+            gdal_features = {(f.geom_type, f.osmid): f.z_order for f in self.loader._read_features(xml_data)}
+            json_features = {(f.geom_type, f.osmid): f.z_order for f in
+                             elements_to_features(osm_xml_to_overpass_elements(xml_data))}
+            with self.subTest(fixture=fixture):
+                self.assertEqual(json_features, gdal_features)
+
+    def test_json_wkb_matches_gdal_geometries(self):
+        for fixture in ("firepit.osm", "hiking_routes.osm", "administrative_boundary.osm"):
+            xml_data = read_test_data(fixture)
+            gdal_geoms = {(f.geom_type, f.osmid): GEOSGeometry(memoryview(f.geom))
+                          for f in self.loader._read_features(xml_data)}
+            json_geoms = {(f.geom_type, f.osmid): GEOSGeometry(memoryview(f.geom))
+                          for f in elements_to_features(osm_xml_to_overpass_elements(xml_data))}
+            with self.subTest(fixture=fixture):
+                self.assertEqual(json_geoms.keys(), gdal_geoms.keys())
+                for key, geom in json_geoms.items():
+                    self.assertEqual(geom.geom_type, gdal_geoms[key].geom_type)
+                    self.assertTrue(geom.valid, key)
+                    self.assertTrue(geom.equals(gdal_geoms[key]), key)
+
+    def test_with_hiking_routes_from_json(self):
+        features = elements_to_features(osm_xml_to_overpass_elements(read_test_data("hiking_routes.osm")))
+        ids, new_ids = self.loader._synchronize_features(self.layer, self.area, features)
+        self.assertEqual(len(ids), 462)
+        lines_qs = OsmLine.objects.filter(layers=self.layer)
+        self.assertEqual(lines_qs.count(), 395)
+        self.assertEqual(lines_qs.filter(z_order__gt=1).count(), 69)
+
+    @patch("datahub.osm_loader.OsmLoader._download")
+    def test_populate_area_queries_once_for_all_layers(self, mocked_download):
+        mocked_download.side_effect = lambda query, file_path: shutil.copy(
+            os.path.join(settings.TEST_DATA_DIR, "firepit.osm"), file_path)
+        leisure_layer = OsmLayer.objects.create(name="Leisure", tags=["leisure=*"])
+        empty_layer = OsmLayer.objects.create(name="Shops", tags=["shop"])
+
+        results = self.loader.populate_area(self.area, [self.layer, leisure_layer, empty_layer])
+        self.assertEqual(mocked_download.call_count, 1)
+        self.assertEqual(results, {self.layer.pk: True, leisure_layer.pk: True, empty_layer.pk: False})
+        self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 7)
+        self.assertEqual(OsmPoint.objects.filter(layers=leisure_layer).count(), 7)
+        self.assertEqual(empty_layer.tilesets.count(), 0)
+
+    def test_reclassify_stored_features_after_tag_change(self):
+        features = list(self.loader._read_features(read_test_data("administrative_boundary.osm")))
+        self.loader._synchronize_features(self.layer, self.area, features)
+
+        self.layer.tags = ["boundary=administrative"]
+        self.layer.save()
+        ids, new_ids = self.loader.reclassify(self.layer)
+        self.assertGreater(len(ids), 0)
+        self.assertEqual(len(new_ids), 0)
+        self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 0)
+        for geom_type in GeomType:
+            for feature in self.layer.get_objects_for_type(geom_type):
+                self.assertEqual(feature.tags.get('boundary'), 'administrative')
+
     def test_with_firepit_points_multiple_times(self):
-        features = self.loader._overpass_xml_to_geojson_features(read_test_data("firepit.osm"))
+        features = list(self.loader._read_features(read_test_data("firepit.osm")))
         self.assertEqual(len(features), 7)
         self.loader._synchronize_features(self.layer, self.area, features)
         ids, new_ids = self.loader._synchronize_features(self.layer, self.area, features)
@@ -103,7 +457,7 @@ class OsmLoadingTests(TestCase):
         self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 7)
 
     def test_with_hiking_routes(self):
-        features = self.loader._overpass_xml_to_geojson_features(read_test_data("hiking_routes.osm"))
+        features = list(self.loader._read_features(read_test_data("hiking_routes.osm")))
         self.assertEqual(len(features), 462)
         ids, new_ids = self.loader._synchronize_features(self.layer, self.area, features)
         self.assertEqual(len(ids), 462)
@@ -116,7 +470,7 @@ class OsmLoadingTests(TestCase):
         self.maxDiff = None
         data = read_test_data("firepit.osm")
 
-        features = self.loader._overpass_xml_to_geojson_features(data)
+        features = list(self.loader._read_features(data))
         self.assertEqual(len(features), 7)
         ids, new_ids = self.loader._synchronize_features(self.layer, self.area, features)
         self.assertEqual(len(ids), 7)
@@ -150,15 +504,25 @@ class OsmLoadingTests(TestCase):
         self.assertEqual(geojson_response, expected)
 
     def test_with_administrative_boundary(self):
-        features = self.loader._overpass_xml_to_geojson_features(read_test_data("administrative_boundary.osm"))
+        features = list(self.loader._read_features(read_test_data("administrative_boundary.osm")))
         ids, new_ids = self.loader._synchronize_features(self.layer, self.area, features)
         self.assertEqual(len(ids), 85)
         self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 11)
         self.assertEqual(OsmLine.objects.filter(layers=self.layer).count(), 66)
         self.assertEqual(OsmPolygon.objects.filter(layers=self.layer).count(), 8)
 
+    def test_with_changed_tags_updates_existing(self):
+        features = list(self.loader._read_features(read_test_data("firepit.osm")))
+        self.loader._synchronize_features(self.layer, self.area, features)
+        osmid = features[0].osmid
+        features[0] = features[0]._replace(tags={"leisure": "firepit", "name": "Changed"})
+        ids, new_ids = self.loader._synchronize_features(self.layer, self.area, features)
+        self.assertEqual(len(ids), 7)
+        self.assertEqual(len(new_ids), 0)
+        self.assertEqual(OsmPoint.objects.get(pk=osmid).tags, {"leisure": "firepit", "name": "Changed"})
+
     def test_with_deleted_features_removes_existing(self):
-        features = self.loader._overpass_xml_to_geojson_features(read_test_data("firepit.osm"))
+        features = list(self.loader._read_features(read_test_data("firepit.osm")))
         self.loader._synchronize_features(self.layer, self.area, features)
         ids, new_ids = self.loader._synchronize_features(self.layer, self.area, features[:-2])
         self.assertEqual(len(ids), 5)
@@ -166,7 +530,7 @@ class OsmLoadingTests(TestCase):
         self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 5)
 
     def test_with_deleted_features_removes_existing2(self):
-        features = self.loader._overpass_xml_to_geojson_features(read_test_data("firepit.osm"))
+        features = list(self.loader._read_features(read_test_data("firepit.osm")))
         self.loader._synchronize_features(self.layer, self.area, features)
         ids, new_ids = self.loader._synchronize_features(self.layer, self.area, [])
         self.assertEqual(ids, set())
@@ -174,10 +538,23 @@ class OsmLoadingTests(TestCase):
         self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 0)
         self.assertEqual(self.layer.tilesets.count(), 0)
 
+    def test_removing_features_from_layer_costs_constant_queries(self):
+        features = list(self.loader._read_features(read_test_data("hiking_routes.osm")))
+        self.loader._synchronize_features(self.layer, self.area, features)
+        line_ids = list(OsmLine.objects.filter(layers=self.layer).values_list('pk', flat=True))
+
+        with CaptureQueriesContext(connection) as single:
+            remove_layer_membership(GeomType.LINE, self.layer.pk, set(line_ids[:1]))
+        with CaptureQueriesContext(connection) as many:
+            deleted = remove_layer_membership(GeomType.LINE, self.layer.pk, set(line_ids[1:]))
+        self.assertEqual(len(single), len(many))
+        self.assertEqual(deleted, len(line_ids) - 1)
+        self.assertEqual(OsmLine.objects.count(), 0)
+
     def test_with_deleted_features_removes_existing3(self):
         layer2 = OsmLayer.objects.create(name="test2")
         layer2.areas.add(self.area)
-        features = self.loader._overpass_xml_to_geojson_features(read_test_data("firepit.osm"))
+        features = list(self.loader._read_features(read_test_data("firepit.osm")))
         self.loader._synchronize_features(self.layer, self.area, features)
         self.loader._synchronize_features(layer2, self.area, features)
         ids, new_ids = self.loader._synchronize_features(self.layer, self.area, [])
@@ -188,7 +565,584 @@ class OsmLoadingTests(TestCase):
         self.assertEqual(OsmPoint.objects.filter(layers=layer2).count(), 7)
 
 
+@override_settings(OVERPASS_CACHE_ENABLED=False)
+class IncrementalSyncTests(CampingLayerMixin, TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.loader = OsmLoader()
+
+    def test_second_sync_fetches_only_changes(self):
+        with recorded_overpass(["firepit.osm", "firepit_diff.osm"]) as (url, queries):
+            with self.settings(OVERPASS_API_URLS=[url]):
+                self.assertTrue(self.loader.populate(self.layer, self.area, incremental=True))
+                self.assertTrue(self.loader.populate(self.layer, self.area, incremental=True))
+
+        self.assertNotIn('newer:', queries[0])
+        self.assertIn('(newer:"2020-06-22T07:43:03Z")', queries[1])
+        self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 8)
+        self.assertEqual(OsmPoint.objects.get(pk=2919437626).tags['name'], 'Nuotiopaikka')
+        state = OsmSyncState.objects.get(layer=self.layer, area=self.area)
+        self.assertEqual(state.last_sync.isoformat(), '2020-06-29T09:12:41+00:00')
+
+    def test_full_sync_after_tag_change(self):
+        with recorded_overpass(["firepit.osm", "firepit.osm"]) as (url, queries):
+            with self.settings(OVERPASS_API_URLS=[url]):
+                self.loader.populate(self.layer, self.area, incremental=True)
+                self.layer.tags = ["leisure=firepit", "amenity=shelter"]
+                self.layer.save()
+                self.loader.populate(self.layer, self.area, incremental=True)
+
+        self.assertNotIn('newer:', queries[1])
+
+    @override_settings(OSM_FULL_SYNC_INTERVAL_HOURS=24)
+    def test_full_sync_removes_deleted_features_after_interval(self):
+        with recorded_overpass(["firepit.osm", "firepit_diff.osm"]) as (url, queries):
+            with self.settings(OVERPASS_API_URLS=[url]):
+                self.loader.populate(self.layer, self.area, incremental=True)
+                self.loader.populate(self.layer, self.area, incremental=True)
+                # Objects missing from the changes are kept until the next full synchronization
+                self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 8)
+
+                OsmSyncState.objects.filter(layer=self.layer, area=self.area).update(
+                    last_full_sync=timezone.now() - datetime.timedelta(hours=24))
+                self.loader.populate(self.layer, self.area, incremental=True)
+
+        self.assertNotIn('newer:', queries[2])
+        self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 2)
+
+
+@override_settings(OSM_REFRESH_INTERVAL_MINUTES=60, OSM_SCHEDULER_INTERVAL_MINUTES=10,
+                   LOCK_KEY_PREFIX=TEST_LOCK_KEY_PREFIX)
+class SchedulerTests(TestCase):
+    def setUp(self) -> None:
+        self.now = timezone.now()
+        self.areas = [AreaOfInterest.objects.create(name=f"Test {i}", bbox=TEST_POLYGON) for i in range(2)]
+        self.layer = OsmLayer.objects.create(name="Camping", tags=["leisure=firepit"])
+        self.layer.areas.add(*self.areas)
+
+    def test_only_due_pairs_are_returned_in_order_of_staleness(self):
+        other_layer = OsmLayer.objects.create(name="Shelters", tags=["amenity=shelter"])
+        other_layer.areas.add(self.areas[0])
+        OsmSyncState.objects.create(layer=self.layer, area=self.areas[0],
+                                    last_success=self.now - datetime.timedelta(minutes=30))
+        OsmSyncState.objects.create(layer=self.layer, area=self.areas[1],
+                                    last_success=self.now - datetime.timedelta(minutes=90))
+        OsmSyncState.objects.create(layer=other_layer, area=self.areas[1], last_success=None)
+
+        due = [(state.layer, state.area) for state in get_due_states(self.now)]
+
+        # State of the new pair is created and the pair that is not linked anymore is left out
+        self.assertEqual(due, [(other_layer, self.areas[0]), (self.layer, self.areas[1])])
+        self.assertEqual(OsmSyncState.objects.count(), 4)
+
+    def test_refresh_interval_can_be_set_per_pair(self):
+        state = OsmSyncState.objects.create(layer=self.layer, area=self.areas[0], refresh_interval=20,
+                                            last_success=self.now - datetime.timedelta(minutes=30))
+        self.assertTrue(state.is_due(self.now))
+        self.assertEqual(state.get_staleness(self.now), 1.5)
+
+    def test_refreshes_are_spread_by_cost(self):
+        states = [OsmSyncState(layer=self.layer, area=area, last_duration=duration)
+                  for area, duration in zip(self.areas, (30, 10))]
+        states.append(OsmSyncState(layer=self.layer, area=self.areas[0]))
+        plan = plan_refreshes(states, datetime.timedelta(minutes=10))
+        self.assertEqual([countdown for state, countdown in plan], [0, 300, 400])
+
+    def test_refreshes_without_cost_are_spread_evenly(self):
+        states = [OsmSyncState(layer=self.layer, area=area, last_duration=0) for area in self.areas]
+        states.append(OsmSyncState(layer=self.layer, area=self.areas[0]))
+        plan = plan_refreshes(states, datetime.timedelta(minutes=10))
+        self.assertEqual([countdown for state, countdown in plan], [0, 200, 400])
+
+    @patch("datahub.tasks._load_signature")
+    def test_scheduled_pairs_are_not_enqueued_again_while_pending(self, load_signature):
+        self.assertEqual(schedule_osm_data(), 2)
+        self.assertEqual(schedule_osm_data(), 0)
+
+        load_signature.assert_any_call(self.layer.pk, self.areas[1].pk)
+        countdowns = [call.kwargs['countdown'] for call in load_signature.return_value.apply_async.call_args_list]
+        self.assertEqual(countdowns, [0, 300])
+        self.assertEqual(OsmSyncState.objects.filter(last_scheduled__isnull=False).count(), 2)
+
+    def test_change_rate_is_measured_from_incremental_syncs(self):
+        state = OsmSyncState.objects.create(layer=self.layer, area=self.areas[0])
+        state.mark_synced(self.now - datetime.timedelta(hours=2), full=True)
+        state.mark_synced(self.now, full=False, changed=10)
+        self.assertEqual(state.change_rate, 5)
+        self.assertFalse(state.is_due(timezone.now()))
+
+
+@override_settings(OVERPASS_CACHE_ENABLED=False)
+class AdaptiveSplittingTests(CampingLayerMixin, TestCase):
+    def test_timed_out_query_is_split_without_duplicates(self):
+        fixtures = ["overpass_timeout.osm"] + ["firepit.osm"] * 4
+        with recorded_overpass(fixtures) as (url, queries):
+            with self.settings(OVERPASS_API_URLS=[url]):
+                self.assertTrue(OsmLoader().populate(self.layer, self.area))
+
+        self.assertEqual(len(queries), 5)
+        self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 7)
+
+    def test_query_fails_when_split_depth_is_reached(self):
+        with recorded_overpass(["overpass_timeout.osm"]) as (url, queries):
+            with self.settings(OVERPASS_API_URLS=[url]):
+                self.assertFalse(OsmLoader(max_split_depth=1).populate(self.layer, self.area))
+
+        # The whole area and the first quadrant
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(OsmPoint.objects.count(), 0)
+
+
+@override_settings(OVERPASS_CACHE_ENABLED=False, OSM_INCREMENTAL_SYNC=True, LOCK_KEY_PREFIX=TEST_LOCK_KEY_PREFIX)
+class StagedLoadingTests(CampingLayerMixin, TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.staging_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.staging_dir)
+
+    def test_stages_load_features_and_remove_staged_files(self):
+        with self.settings(OSM_STAGING_DIR=self.staging_dir):
+            with recorded_overpass(["firepit.osm"]) as (url, queries):
+                with self.settings(OVERPASS_API_URLS=[url]):
+                    fetched = fetch_osm_data(self.layer.pk, self.area.pk)
+            parsed = parse_osm_data(fetched)
+            # Retried stages reuse the results of the previous attempt
+            self.assertEqual(parse_osm_data(fetched)['parsed'], parsed['parsed'])
+            self.assertEqual(OsmPoint.objects.count(), 0)
+            result = sync_osm_data(parsed)
+            self.assertTrue(result['succeeded'])
+            self.assertFalse(sync_osm_data(parsed)['succeeded'])
+
+        # Phases of all the stages are in the result of the last stage
+        spans = {record['span']: record for record in result['spans']}
+        self.assertEqual(spans['fetch.http']['bytes'], spans['fetch']['bytes'])
+        self.assertEqual(spans['translate']['rows'], 7)
+        self.assertIn('sync.upsert', spans)
+        self.assertIn('sync.membership', spans)
+        self.assertIn('sync.view_ddl', spans)
+        self.assertGreater(spans['sync']['queries'], 0)
+        self.assertEqual({record['layer'] for record in result['spans']}, {self.layer.pk})
+        self.assertGreater(result['duration'], 0)
+
+        self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 7)
+        self.assertEqual(os.listdir(self.staging_dir), [])
+        state = OsmSyncState.objects.get(layer=self.layer, area=self.area)
+        self.assertEqual(state.last_sync.isoformat(), '2020-06-22T07:43:03+00:00')
+
+    def test_feature_rows_round_trip(self):
+        loader = OsmLoader()
+        rows_dict = loader._collect_rows(loader._read_features(read_test_data("hiking_routes.osm")))
+        file_path = os.path.join(self.staging_dir, "rows.jsonl.gz")
+        write_feature_rows(file_path, rows_dict)
+        self.assertEqual(read_feature_rows(file_path), rows_dict)
+
+
+@override_settings(OVERPASS_CACHE_ENABLED=False, LOCK_KEY_PREFIX=TEST_LOCK_KEY_PREFIX)
+class MetricsTests(CampingLayerMixin, TestCase):
+    def test_request_latency_and_queries_are_recorded_per_view(self):
+        labels = {'view': 'Capabilities', 'method': 'GET'}
+        before = get_sample_value('aukigo_http_request_db_queries_count', labels)
+        before_latency = get_sample_value('aukigo_http_request_duration_seconds_count', {**labels, 'status': '200'})
+
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(reverse('capabilities'))
+
+        self.assertEqual(get_sample_value('aukigo_http_request_db_queries_count', labels), before + 1)
+        self.assertGreaterEqual(get_sample_value('aukigo_http_request_db_queries_sum', labels),
+                                len(context.captured_queries))
+        self.assertEqual(get_sample_value('aukigo_http_request_duration_seconds_count', {**labels, 'status': '200'}),
+                         before_latency + 1)
+
+    def test_ingestion_and_overpass_metrics_are_recorded(self):
+        features_labels = {'layer': self.layer.name, 'geom_type': 'POINT'}
+        before = get_sample_value('aukigo_features_ingested_total', features_labels)
+        with recorded_overpass(["firepit.osm"]) as (url, queries):
+            endpoint_labels = {'endpoint': url}
+            before_bytes = get_sample_value('aukigo_overpass_received_bytes_total', endpoint_labels)
+            before_queries = get_sample_value('aukigo_overpass_request_duration_seconds_count',
+                                              {**endpoint_labels, 'outcome': 'success'})
+            with self.settings(OVERPASS_API_URLS=[url]):
+                self.assertTrue(OsmLoader().populate(self.layer, self.area))
+
+        self.assertEqual(get_sample_value('aukigo_features_ingested_total', features_labels), before + 7)
+        self.assertEqual(get_sample_value('aukigo_overpass_received_bytes_total', endpoint_labels),
+                         before_bytes + os.path.getsize(os.path.join(settings.TEST_DATA_DIR, "firepit.osm")))
+        self.assertEqual(get_sample_value('aukigo_overpass_request_duration_seconds_count',
+                                          {**endpoint_labels, 'outcome': 'success'}), before_queries + 1)
+
+    def test_task_outcomes_are_recorded(self):
+        labels = {'task': 'datahub.tasks.reclassify_osm_layer', 'state': 'SUCCESS'}
+        before = get_sample_value('aukigo_celery_tasks_total', labels)
+        reclassify_osm_layer.apply(args=(self.layer.pk,))
+        self.assertEqual(get_sample_value('aukigo_celery_tasks_total', labels), before + 1)
+
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('capabilities'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'aukigo_http_request_duration_seconds_bucket{', response.content)
+
+    @override_settings(METRICS_ALLOWED_IPS=['10.0.0.0/8'])
+    def test_metrics_endpoint_is_restricted(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.1.2.3').status_code, 200)
+        # Proxy is allowed but the client behind it is not
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.1.2.3',
+                                         HTTP_X_FORWARDED_FOR='203.0.113.1').status_code, 403)
+        with self.settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(reverse('metrics'), HTTP_X_FORWARDED_FOR='203.0.113.1',
+                                             HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+            self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.client.force_login(User.objects.create(username="staff", is_staff=True))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+
+# Cache is invalidated when the transaction is committed
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CapabilitiesCacheTests(TransactionTestCase):
+    def setUp(self) -> None:
+        self.layer = OsmLayer.objects.create(name="test")
+        self.layer.add_support_for_type(GeomType.POINT)
+
+    def test_capabilities_are_cached_until_layers_change(self):
+        response = self.client.get(reverse('capabilities'))
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        with CaptureQueriesContext(connection) as context:
+            cached = self.client.get(reverse('capabilities'))
+        self.assertEqual(len(context), 0)
+        self.assertEqual(cached.json(), response.json())
+        self.assertEqual(self.client.get(reverse('capabilities'), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        other_host = self.client.get(reverse('capabilities'), HTTP_HOST='example.com')
+        self.assertNotEqual(other_host['ETag'], etag)
+
+        self.layer.description = "Changed"
+        self.layer.save()
+        response = self.client.get(reverse('capabilities'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['tilesets'][0]['description'], "Changed")
+        self.layer.delete()
+
+
+@override_settings(LOCK_KEY_PREFIX=TEST_LOCK_KEY_PREFIX, OSM_COMBINED_AREA_QUERIES=False, OSM_STAGED_LOADING=False)
+class LockTests(CampingLayerMixin, TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.key = pair_key(self.layer.pk, self.area.pk)
+        self.addCleanup(release_claim, self.key)
+
+    def test_lock_is_exclusive_until_released(self):
+        with LeasedLock(self.key):
+            self.assertFalse(LeasedLock(self.key).acquire())
+            with self.assertRaises(LockNotAcquired):
+                with LeasedLock(self.key):
+                    pass
+        lock = LeasedLock(self.key)
+        self.assertTrue(lock.acquire())
+        lock.release()
+
+    def test_lease_is_renewed_while_held(self):
+        with LeasedLock(self.key, lease=1):
+            time.sleep(1.5)
+            self.assertFalse(LeasedLock(self.key).acquire())
+
+    def test_claim_can_be_made_once(self):
+        self.assertTrue(claim(self.key))
+        self.assertFalse(claim(self.key))
+        release_claim(self.key)
+        self.assertTrue(claim(self.key))
+
+    @patch("datahub.tasks.group")
+    @patch("datahub.tasks._load_signature")
+    def test_loads_in_flight_are_not_enqueued_again(self, load_signature, group):
+        other_area = AreaOfInterest.objects.create(name="Other", bbox=TEST_POLYGON)
+        self.layer.areas.add(other_area)
+        self.addCleanup(release_claim, pair_key(self.layer.pk, other_area.pk))
+        claim(self.key)
+
+        load_osm_data()
+        self.assertEqual(group.call_args.args[0], [load_signature.return_value])
+        load_osm_data()
+        self.assertEqual(group.call_args.args[0], [])
+
+    @patch("datahub.osm_loader.OsmLoader.populate", side_effect=ValueError)
+    def test_failed_load_releases_claim(self, populate):
+        claim(self.key)
+        load_osm_data_for_area.apply(args=(self.layer.pk, self.area.pk))
+        self.assertEqual(populate.call_count, 1)
+        self.assertTrue(claim(self.key))
+
+    @patch("datahub.osm_loader.OsmLoader.populate_area", side_effect=ValueError)
+    def test_failed_area_load_releases_claim(self, populate_area):
+        key = area_key(self.area.pk)
+        self.addCleanup(release_claim, key)
+        claim(key)
+        load_osm_data_for_area_layers.apply(args=(self.area.pk,))
+        self.assertEqual(populate_area.call_count, 1)
+        self.assertTrue(claim(key))
+
+    @override_settings(OVERPASS_CACHE_ENABLED=False)
+    def test_area_load_records_phases_of_each_pair(self):
+        self.addCleanup(release_claim, area_key(self.area.pk))
+        other = OsmLayer.objects.create(name="Leisure", tags=["leisure=*"])
+        other.areas.add(self.area)
+        with recorded_overpass(["firepit.osm"]) as (url, queries):
+            with self.settings(OVERPASS_API_URLS=[url]):
+                results = load_osm_data_for_area_layers.apply(args=(self.area.pk,)).get()
+
+        self.assertEqual(len(queries), 1)
+        for layer in (self.layer, other):
+            result = results[layer.pk]
+            self.assertTrue(result['succeeded'])
+            spans = [record['span'] for record in result['spans']]
+            self.assertEqual([span_name for span_name in spans if '.' not in span_name],
+                             ['fetch', 'translate', 'upsert', 'upsert', 'upsert', 'view_refresh', 'sync'])
+            self.assertIn('sync.membership', spans)
+            self.assertEqual({record['layer'] for record in result['spans'] if record['span'] == 'sync'}, {layer.pk})
+            state = OsmSyncState.objects.get(layer=layer, area=self.area)
+            self.assertEqual(state.last_duration, result['duration'])
+            self.assertIsNotNone(state.last_full_sync)
+
+    @patch("datahub.osm_loader.OsmLoader.populate", return_value=True)
+    def test_pair_is_not_loaded_while_locked(self, populate):
+        with LeasedLock(self.key):
+            load_osm_data_for_area.apply(args=(self.layer.pk, self.area.pk))
+        self.assertEqual(populate.call_count, 0)
+
+        self.assertTrue(load_osm_data_for_area(self.layer.pk, self.area.pk)['succeeded'])
+        self.assertEqual(populate.call_count, 1)
+
+
+class SpanTests(TestCase):
+    @override_settings(SPAN_TRACE_MEMORY=True)
+    def test_nested_spans_are_recorded(self):
+        with self.assertLogs('datahub.spans', level='INFO') as logs:
+            with SpanRecorder(layer=1) as recorder:
+                with span('outer', size=1) as outer:
+                    with span('inner'):
+                        OsmPoint.objects.count()
+                        data = [bytearray(1024) for _ in range(100)]
+                    outer.set(rows=len(data))
+
+        inner, outer = recorder.as_list()
+        self.assertEqual(inner['span'], 'outer.inner')
+        self.assertEqual(inner['queries'], 1)
+        self.assertGreater(inner['peak_memory'], 100 * 1024)
+        self.assertEqual(outer['queries'], 1)
+        self.assertGreaterEqual(outer['peak_memory'], inner['peak_memory'])
+        self.assertEqual((outer['layer'], outer['size'], outer['rows']), (1, 1, 100))
+        self.assertEqual(total_duration(recorder.as_list()), outer['duration'])
+        self.assertEqual(logs.records[1].span, outer)
+
+    def test_spans_without_recorder_are_not_recorded(self):
+        with span('outer') as outer:
+            outer.set(rows=1)
+        self.assertIsNone(outer.duration)
+
+
+@override_settings(OVERPASS_CACHE_ENABLED=False, OVERPASS_CIRCUIT_BREAKER_THRESHOLD=2)
+class OverpassEndpointTests(CampingLayerMixin, TestCase):
+    @patch("datahub.overpass_endpoints.random.choices", side_effect=lambda population, weights: population[:1])
+    def test_failing_endpoint_fails_over(self, mocked_choices):
+        with recorded_overpass([502]) as (failing_url, failing_queries):
+            with recorded_overpass(["firepit.osm"]) as (url, queries):
+                with self.settings(OVERPASS_API_URLS=[failing_url, url]):
+                    self.assertTrue(OsmLoader().populate(self.layer, self.area))
+
+        self.assertEqual((len(failing_queries), len(queries)), (1, 1))
+        self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 7)
+        failing = OverpassEndpoint.objects.get(url=failing_url)
+        self.assertEqual((failing.request_count, failing.failure_count, failing.consecutive_failures), (1, 1, 1))
+        endpoint = OverpassEndpoint.objects.get(url=url)
+        self.assertEqual((endpoint.request_count, endpoint.failure_count), (1, 0))
+        self.assertIsNotNone(endpoint.latency)
+
+    @patch("datahub.overpass_endpoints.random.choices", side_effect=lambda population, weights: population[:1])
+    def test_too_large_query_is_split_without_failing_over(self, mocked_choices):
+        with recorded_overpass([504, "firepit.osm"]) as (url, queries):
+            with recorded_overpass(["firepit.osm"]) as (other_url, other_queries):
+                with self.settings(OVERPASS_API_URLS=[url, other_url]):
+                    self.assertTrue(OsmLoader(max_split_depth=1).populate(self.layer, self.area))
+
+        # Quadrants are queried from the same endpoint
+        self.assertEqual((len(queries), len(other_queries)), (5, 0))
+        endpoint = OverpassEndpoint.objects.get(url=url)
+        self.assertEqual((endpoint.timeout_count, endpoint.failure_count, endpoint.consecutive_failures), (1, 0, 0))
+        self.assertIsNone(endpoint.circuit_open_until)
+
+    @patch("datahub.osm_loader.OsmLoader.CONNECT_TIMEOUT", 1)
+    @patch("datahub.overpass_endpoints.random.choices", side_effect=lambda population, weights: population[:1])
+    def test_slow_endpoint_fails_over_without_splitting(self, mocked_choices):
+        with recorded_overpass(["firepit.osm"], faults=Faults(latency=3)) as (slow_url, slow_queries):
+            with recorded_overpass(["firepit.osm"]) as (url, queries):
+                with self.settings(OVERPASS_API_URLS=[slow_url, url]):
+                    self.assertTrue(OsmLoader(timeout=0).populate(self.layer, self.area))
+
+        self.assertEqual((len(slow_queries), len(queries)), (1, 1))
+        slow = OverpassEndpoint.objects.get(url=slow_url)
+        self.assertEqual((slow.failure_count, slow.timeout_count, slow.consecutive_failures), (1, 1, 1))
+
+    def test_circuit_opens_after_consecutive_failures(self):
+        first = OverpassEndpoint.objects.create(url="http://first/api")
+        second = OverpassEndpoint.objects.create(url="http://second/api", latency=100)
+        pool = EndpointPool.from_settings()
+        failing = next(endpoint for endpoint in pool.endpoints if endpoint.url == first.url)
+        failing.record_failure("504 Gateway Timeout", timeout=True)
+        self.assertIsNotNone(pool.choose(exclude=[second.url]))
+        failing.record_failure("504 Gateway Timeout", timeout=True)
+        self.assertIsNone(pool.choose(exclude=[second.url]))
+        self.assertEqual(pool.choose().url, second.url)
+        pool.save()
+
+        first.refresh_from_db()
+        self.assertFalse(first.is_available)
+        self.assertEqual((first.request_count, first.failure_count, first.timeout_count), (2, 2, 2))
+        self.assertEqual(first.last_error, "504 Gateway Timeout")
+
+    def test_endpoint_statistics_api(self):
+        OverpassEndpoint.objects.create(url="http://first/api", request_count=3, latency=1.5,
+                                        last_error="ClientConnectorError('10.0.0.1:80')")
+        response = self.client.get(reverse('overpassendpoint-list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]['request_count'], 3)
+        self.assertTrue(response.json()[0]['is_available'])
+        self.assertNotIn('last_error', response.json()[0])
+
+
+class OsmExtractTests(CampingLayerMixin, TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.path = os.path.join(settings.TEST_DATA_DIR, "firepit.osm")
+
+    def test_import_osm_extract(self):
+        far_away = AreaOfInterest.objects.create(name="Far away", bbox=Polygon.from_bbox((20, 65, 21, 66)))
+        far_layer = OsmLayer.objects.create(name="Far", tags=["leisure=firepit"])
+        far_layer.areas.add(far_away)
+        OsmLayer.objects.create(name="Empty", tags=["shop"]).areas.add(self.area)
+
+        counts = import_osm_extract(self.path, processes=1)
+        self.assertEqual(counts[self.layer.pk], 7)
+        self.assertEqual(counts[far_layer.pk], 0)
+        self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 7)
+        self.assertEqual(self.layer.tilesets.count(), 1)
+        state = OsmSyncState.objects.get(layer=self.layer, area=self.area)
+        self.assertIsNotNone(state.last_full_sync)
+        self.assertEqual(state.tags, self.layer.tags)
+
+    def test_loading_pair_is_not_imported(self):
+        with LeasedLock(pair_key(self.layer.pk, self.area.pk)):
+            with self.assertRaises(LockNotAcquired):
+                import_osm_extract(self.path, processes=1)
+        self.assertFalse(OsmPoint.objects.exists())
+
+    def test_import_removes_missing_features(self):
+        OsmPoint.objects.create(osmid=1, tags={'leisure': 'firepit'}, geom=self.area.bbox.centroid).layers.add(
+            self.layer)
+        call_command('import_osm_extract', self.path, processes=1, stdout=io.StringIO())
+        self.assertFalse(OsmPoint.objects.filter(pk=1).exists())
+        self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 7)
+
+    def test_missing_extract_is_not_imported(self):
+        with self.assertRaises(CommandError):
+            call_command('import_osm_extract', "missing.osm.pbf", processes=1)
+
+
+@override_settings(OVERPASS_CACHE_ENABLED=False)
+class OverpassStandInTests(CampingLayerMixin, TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def test_scaled_dataset_has_distinct_features(self):
+        path = os.path.join(self.tmp_dir, "scaled.osm")
+        scale_osm_file(os.path.join(settings.TEST_DATA_DIR, "hiking_routes.osm"), path, 3)
+        with open(path) as f:
+            features = list(OsmLoader._read_features(f.read()))
+        original = list(OsmLoader._read_features(read_test_data("hiking_routes.osm")))
+        self.assertEqual(len(features), 3 * len(original))
+        self.assertEqual(len({(f.geom_type, f.osmid) for f in features}), 3 * len(original))
+
+    def test_load_osm_data_offline(self):
+        with recorded_overpass(["firepit.osm"], scale=2) as (url, queries):
+            with self.settings(OVERPASS_API_URLS=[url], IN_INTEGRATION_TEST=True, OSM_STAGING_DIR=self.tmp_dir):
+                load_osm_data()
+
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 14)
+
+    def test_injected_rate_limit_is_retried(self):
+        # With the seed, the first query is rate limited and the second one succeeds
+        with recorded_overpass(["firepit.osm"], faults=Faults(rate_limit_probability=0.5, seed=1)) as (url, queries):
+            with self.settings(OVERPASS_API_URLS=[url]):
+                self.assertTrue(OsmLoader().populate(self.layer, self.area))
+
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(OverpassEndpoint.objects.get().rate_limited_count, 1)
+
+    def test_json_and_count_responses(self):
+        loader = OsmLoader(output_format=OutputFormat.JSON, max_elements_per_query=100)
+        with recorded_overpass(["firepit.osm"], faults=Faults(drip_bytes_per_second=10 ** 6)) as (url, queries):
+            with self.settings(OVERPASS_API_URLS=[url]):
+                self.assertTrue(loader.populate(self.layer, self.area))
+
+        self.assertIn('out count;', queries[0])
+        self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 7)
+
+
+class OverpassCacheTests(CampingLayerMixin, TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def test_repeated_query_is_served_from_cache(self):
+        with self.settings(OVERPASS_CACHE_DIR=self.cache_dir):
+            with recorded_overpass(["firepit.osm"]) as (url, queries):
+                with self.settings(OVERPASS_API_URLS=[url]):
+                    OsmLoader().populate(self.layer, self.area)
+                    OsmLoader().populate(self.layer, self.area)
+                    self.assertEqual(len(queries), 1)
+                    OsmLoader(bypass_cache=True).populate(self.layer, self.area)
+                    self.assertEqual(len(queries), 2)
+        self.assertEqual(OsmPoint.objects.filter(layers=self.layer).count(), 7)
+
+    def test_query_normalization(self):
+        self.assertEqual(OverpassCache.get_key("// comment\n[out:xml];\n  node(1,2,3,4);"),
+                         OverpassCache.get_key("[out:xml]; node(1,2,3,4);"))
+        self.assertNotEqual(OverpassCache.get_key("node(1,2,3,4);"), OverpassCache.get_key("node(1,2,3,5);"))
+
+        loader = OsmLoader()
+        tags = ["website~https://"]
+        self.assertNotEqual(OverpassCache.get_key(loader._build_query(tags, (60.1, 24.5, 60.2, 24.6))),
+                            OverpassCache.get_key(loader._build_query(tags, (60.3, 24.5, 60.4, 24.6))))
+
+    def test_expiration_and_eviction(self):
+        data_path = os.path.join(settings.TEST_DATA_DIR, "firepit.osm")
+        out_path = os.path.join(self.cache_dir, "out.osm")
+        cache = OverpassCache(os.path.join(self.cache_dir, "cache"), ttl=60, max_bytes=10 ** 6)
+        cache.put("a", data_path)
+        self.assertTrue(cache.get("a", out_path))
+        with open(out_path) as f:
+            self.assertEqual(f.read(), read_test_data("firepit.osm"))
+
+        cache.ttl = -1
+        self.assertFalse(cache.get("a", out_path))
+
+        cache.ttl = 60
+        cache.max_bytes = 1
+        cache.put("b", data_path)
+        self.assertFalse(cache.get("b", out_path))
+
+
 # Helper functions
+def get_sample_value(name: str, labels: dict) -> float:
+    # Values are kept over test runs in multiprocess mode, so tests compare the changes
+    return get_registry().get_sample_value(name, labels) or 0
+
+
 def read_test_data(fixture: str) -> str:
     with open(os.path.join(settings.TEST_DATA_DIR, fixture)) as f:
         data = f.read()
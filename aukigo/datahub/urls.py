@@ -3,7 +3,8 @@ from django.urls import path, include
 from rest_framework import routers
 
 from .views import (is_authenticated, start_osm_task, TilesetViewSet, AreaViewSet, OsmLayerViewSet, WMTSBasemapViewSet,
-                    VectorTileBasemapViewSet, Capabilities, LayerViewSet, OsmGeojsons)
+                    VectorTileBasemapViewSet, Capabilities, LayerViewSet, OsmGeojsons, OverpassEndpointViewSet,
+                    metrics)
 
 router = routers.DefaultRouter()
 router.register(r'OsmLayers', OsmLayerViewSet)
@@ -12,6 +13,7 @@ router.register(r'areas', AreaViewSet)
 router.register(r'tilesets', TilesetViewSet)
 router.register(r'basemaps-wmts', WMTSBasemapViewSet)
 router.register(r'basemaps-vt', VectorTileBasemapViewSet)
+router.register(r'overpass-endpoints', OverpassEndpointViewSet)
 
 
 urlpatterns = [
@@ -19,6 +21,7 @@ urlpatterns = [
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     path('is_authenticated/', is_authenticated),
     path('populate_osm/', start_osm_task),
+    path('metrics/', metrics, name='metrics'),
     path('capabilities/', Capabilities.as_view(), name='capabilities'),
     path('osm_geojson/<int:layer>/<str:gtype>.geojson', OsmGeojsons.as_view(), name='osm_geojsons')
 ]
@@ -1,7 +1,7 @@
 import enum
 import logging
 import re
-from typing import Tuple
+from typing import Tuple, NamedTuple, Optional
 
 from django.contrib.gis.geos import Polygon
 
@@ -25,16 +25,6 @@ class GeomType(enum.Enum):
         elif self == GeomType.POLYGON:
             return OsmPolygon
 
-    @staticmethod
-    def from_feature(feature: {}):
-        t = feature['geometry']['type']
-        if t == 'Point':
-            return GeomType.POINT
-        elif t == 'MultiLineString':
-            return GeomType.LINE
-        else:
-            return GeomType.POLYGON
-
     @staticmethod
     def get_empty_dict():
         return {
@@ -44,6 +34,19 @@ class GeomType(enum.Enum):
         }
 
 
+class OutputFormat(enum.Enum):
+    XML = 'xml'  # Parsed with GDAL OSM driver
+    JSON = 'json'  # Geometries are built in Python from Overpass out geom
+
+
+class OsmFeatureRecord(NamedTuple):
+    osmid: int
+    geom_type: GeomType
+    geom: bytes  # WKB in EPSG:4326
+    tags: {str: str}
+    z_order: Optional[int] = None
+
+
 def polygon_to_overpass_bbox(geom: Polygon) -> Tuple[float, float, float, float]:
     """
     Converts GEOS polygon to bounding box understandable by Overpass API
@@ -98,6 +101,7 @@ def model_tag_to_overpass_tag(tag: str) -> str:
     return guess
 
 
+# Parses opening_hours on every call. Layer views use OPENING_HOURS_FUNCTIONS instead.
 # noinspection SqlNoDataSourceInspection
 IS_CURRENTLY_OPEN_FUNCTION = '''
 CREATE OR REPLACE FUNCTION is_currently_open(
@@ -105,7 +109,7 @@ CREATE OR REPLACE FUNCTION is_currently_open(
 ) 
 RETURNS bool 
 LANGUAGE plpgsql 
-IMMUTABLE 
+STABLE 
 RETURNS NULL ON NULL INPUT
 PARALLEL SAFE
 
@@ -164,3 +168,33 @@ EXCEPTION
 END;
 $is_currently_open$;
 '''
+
+# Functions are STABLE since they depend on the current time. Plain SQL functions are inlined to the view queries.
+# noinspection SqlNoDataSourceInspection
+OPENING_HOURS_FUNCTIONS = '''
+CREATE OR REPLACE FUNCTION minute_of_week()
+RETURNS integer
+LANGUAGE sql
+STABLE
+PARALLEL SAFE
+AS $minute_of_week$
+	SELECT ((extract(isodow FROM t) - 1) * 1440 + extract(hour FROM t) * 60 + extract(minute FROM t))::integer
+	FROM (SELECT NOW() AT TIME ZONE 'Europe/Helsinki' AS t) AS current_time_in_zone
+$minute_of_week$;
+
+CREATE OR REPLACE FUNCTION is_open(
+	feature_type varchar,
+	feature_id bigint
+)
+RETURNS bool
+LANGUAGE sql
+STABLE
+PARALLEL SAFE
+AS $is_open$
+	SELECT EXISTS (
+		SELECT 1 FROM datahub_openinghoursinterval
+		WHERE geom_type = feature_type AND osmid = feature_id
+		  AND start_minute <= minute_of_week() AND end_minute > minute_of_week()
+	)
+$is_open$;
+'''
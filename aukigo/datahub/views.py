@@ -1,25 +1,36 @@
+import hmac
+import ipaddress
+
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.core.cache import cache
+from django.http import JsonResponse, HttpResponse, HttpResponseForbidden
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from rest_framework import viewsets, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .models import Tileset, AreaOfInterest, WMTSBasemap, VectorTileBasemap, Layer
+from .capabilities_cache import get_capabilities_key, get_capabilities_etag, get_capabilities_last_modified
+from .metrics import get_registry
+from .models import Tileset, AreaOfInterest, WMTSBasemap, VectorTileBasemap, Layer, OverpassEndpoint
 from .serializers import (TilesetSerializer, AreaOfInterestSerializer, OsmLayer, OsmLayerSerializer,
                           WTMSBasemapSerializer, VectorTileBasemapSerializer, LayerSerializer, OsmPointSerializer,
-                          OsmPolygonSerializer, OsmLineSerializer)
+                          OsmPolygonSerializer, OsmLineSerializer, OverpassEndpointSerializer)
 from .tasks import load_osm_data
 # ViewSets define the view behavior.
 from .utils import GeomType
 
 
 class TilesetViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Tileset.objects.all()
+    queryset = Tileset.objects.select_related('layer__osmlayer').prefetch_related('layer__osmlayer__statistics')
     serializer_class = TilesetSerializer
 
 
 class LayerViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Layer.objects.all()
+    # Bounds and centers are read from the prefetched statistics
+    queryset = Layer.objects.select_related('osmlayer').prefetch_related('osmlayer__statistics')
     serializer_class = LayerSerializer
 
 
@@ -43,20 +54,32 @@ class VectorTileBasemapViewSet(viewsets.ModelViewSet):
     serializer_class = VectorTileBasemapSerializer
 
 
+class OverpassEndpointViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = OverpassEndpoint.objects.order_by('url')
+    serializer_class = OverpassEndpointSerializer
+
+
 class Capabilities(APIView):
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
 
+    # Clients that already have the current version get 304 Not Modified
+    @method_decorator(condition(etag_func=get_capabilities_etag, last_modified_func=get_capabilities_last_modified))
     def get(self, request):
         def serialize_all(view_set: viewsets.ModelViewSet) -> list:
             return view_set.as_view({'get': 'list'})(request._request).data
 
-        data = {
-            'basemaps': {
-                'WMTS': serialize_all(WMTSBasemapViewSet),
-                'vectorTile': serialize_all(VectorTileBasemapViewSet)
-            },
-            'tilesets': serialize_all(LayerViewSet)
-        }
+        key = get_capabilities_key(request)
+        data = cache.get(key)
+        if data is None:
+            data = {
+                'basemaps': {
+                    'WMTS': serialize_all(WMTSBasemapViewSet),
+                    'vectorTile': serialize_all(VectorTileBasemapViewSet)
+                },
+                'tilesets': serialize_all(LayerViewSet)
+            }
+            # Old versions are never read again, so they are left to expire
+            cache.set(key, data, settings.CAPABILITIES_CACHE_SECONDS)
 
         return Response(data)
 
@@ -96,3 +119,26 @@ def start_osm_task(request):
 
 def is_authenticated(request):
     return JsonResponse({"is_authenticated": request.user.is_authenticated})
+
+
+def metrics(request):
+    # Scrape endpoint for Prometheus, values are aggregated over all the worker processes
+    if not (request.user.is_staff or _has_metrics_token(request) or _is_metrics_client(request)):
+        return HttpResponseForbidden()
+    return HttpResponse(generate_latest(get_registry()), content_type=CONTENT_TYPE_LATEST)
+
+
+def _has_metrics_token(request) -> bool:
+    return bool(settings.METRICS_TOKEN) and hmac.compare_digest(
+        request.META.get('HTTP_AUTHORIZATION', ''), f"Bearer {settings.METRICS_TOKEN}")
+
+
+def _is_metrics_client(request) -> bool:
+    # Address of a forwarded request is the address of the proxy, which would let every client in
+    if 'HTTP_X_FORWARDED_FOR' in request.META:
+        return False
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR'))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network, strict=False) for network in settings.METRICS_ALLOWED_IPS)
@@ -12,6 +12,9 @@ then
 fi
 
 #python manage.py flush --no-input
+# Metrics of the previous run would be summed up with the new ones
+rm -rf "${PROMETHEUS_MULTIPROC_DIR:-cache/metrics}"
+
 python manage.py migrate
 python manage.py createcachetable
 python manage.py collectstatic --no-input --clear